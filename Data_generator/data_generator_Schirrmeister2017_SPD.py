@@ -5,7 +5,11 @@ import numpy as np
 from moabb.datasets import  Schirrmeister2017
 from moabb.paradigms import MotorImagery
 from pyriemann.estimation import Covariances
-import pickle
+from dataloader.spd_preprocess import save_packed, filter_bank_covariances
+# filter-bank mode: the covariances of each (low, high) band in Hz, e.g. [(4, 8), (8, 12), ..., (28, 32)], from one
+# FFT pass over the trials and stored as (trials, bands, chans, chans); None keeps the broadband covariances
+FILTER_BANK = None
+SFREQ = 250 # the trials are resampled to this rate in filter-bank mode
 ##########For cross subject -- more than one subject from source
 # setup the paradigm
 dataset = Schirrmeister2017()
@@ -13,6 +17,9 @@ dataset = Schirrmeister2017()
 dataset.subject_list = list((range(1, 15))) #
 #events=dict(right_hand=1, left_hand=2, rest=3, feet=4)
 paradigm=MotorImagery(events = ['right_hand', 'left_hand', 'rest', 'feet'],n_classes=4) #
+if FILTER_BANK:  # one paradigm pass over the whole range of the bank, the bands are split afterwards
+    paradigm = MotorImagery(events=['right_hand', 'left_hand', 'rest', 'feet'], n_classes=4,
+                            fmin=FILTER_BANK[0][0], fmax=FILTER_BANK[-1][1], resample=SFREQ)
 
 # get data from source
 for i in range(1,15):#
@@ -21,15 +28,17 @@ for i in range(1,15):#
     subject_source = [i]#
     X, labels, meta = paradigm.get_data(dataset_source, subjects=subject_source)
     source['org'] = {}
-    source['org']['covs'] = Covariances(estimator='lwf').fit_transform(X[:,2:,:])#
+    if FILTER_BANK:
+        source['org']['covs'] = filter_bank_covariances(X[:,2:,:], SFREQ, FILTER_BANK, estimator='lwf')
+    else:
+        source['org']['covs'] = Covariances(estimator='lwf').fit_transform(X[:,2:,:])#
     source['org']['labels'] = labels
 
     #### the code to save the object
     ## saveing obejct
     var_name = 'Schirrmeister2017Subject_' + str(i) + '_SPD'
-
-    with open(var_name,'wb') as file1:
-        pickle.dump(source,file1)
+    # float32 upper triangles listed in manifest.json, the loaders read these before any pickle
+    save_packed('.', var_name, source['org']['covs'], source['org']['labels'])
 
 
 
@@ -0,0 +1,811 @@
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+##
+## This source code is licensed under the MIT-style license found in the
+## LICENSE file in the root directory of this source tree
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+""" Benchmarks for the meta-learning pipeline on synthetic tasks. """
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import torch.nn.functional as F
+from dataloader.samplers import CategoriesSampler
+from models.mtl import MtlLearner, segmented_batchnorm
+from models.SPD_CNNnet import symmetrize
+from utils.metrics import episode_metrics, summarize
+from dataloader.spd_preprocess import pack_upper, packed_size, unpack_upper, normalize, recenter, riemannian_mean, \
+    log_euclidean_mean, ledoit_wolf, filter_bank_covariances
+from utils.export import adapt, export_onnx, OnnxPredictor
+from utils.quantize import quantize_static, calibration_subset, inference_latency
+from utils.misc import SavedTensorMeter, reset_peak_memory, peak_memory, memory_summary, count_acc, chunked_inference, grad_scaler
+
+
+def synthetic_task(args):
+    """Random SPD matrices shaped like one meta-train task (shot + query)."""
+    n = args.way * (args.shot + args.train_query)
+    x = torch.randn(n, args.in_chans, 2 * args.in_chans)
+    covs = x @ x.transpose(1, 2) / x.size(2)
+    data = covs.unsqueeze(1)
+    if torch.cuda.is_available():
+        data = data.cuda()
+    p = args.way * args.shot
+    return data[:p], data[p:]
+
+
+def class_task(args, mixing):
+    """Like synthetic_task, but the covariances of each class come from their own mixing matrix, so the
+    classes are separable. Samples are ordered as task_labels orders the labels."""
+    n = args.way * (args.shot + args.train_query)
+    label = torch.arange(args.way).repeat(n // args.way)
+    x = mixing[label] @ torch.randn(n, args.in_chans, 2 * args.in_chans)
+    covs = x @ x.transpose(1, 2) / x.size(2)
+    data = covs.unsqueeze(1)
+    if torch.cuda.is_available():
+        data = data.cuda()
+    p = args.way * args.shot
+    return data[:p], data[p:]
+
+
+def task_labels(args, n_per):
+    label = torch.arange(args.way).repeat(n_per)
+    if torch.cuda.is_available():
+        return label.type(torch.cuda.LongTensor)
+    return label.type(torch.LongTensor)
+
+
+def bench_inner_detach(args):
+    """Per-task time and retained graph memory of the meta forward/backward, with and without inner_detach."""
+    label_shot = task_labels(args, args.shot)
+    label_query = task_labels(args, args.train_query)
+    tasks = [synthetic_task(args) for _ in range(args.num_tasks)]
+    for inner_detach in [0, 1]:
+        args.inner_detach = inner_detach
+        model = MtlLearner(args, mode='meta', in_chans=args.in_chans, input_time_length=args.in_chans)
+        if torch.cuda.is_available():
+            model = model.cuda()
+        model.train()
+        # warm up
+        data_shot, data_query = tasks[0]
+        F.cross_entropy(model((data_shot, label_shot, data_query)), label_query).backward()
+        reset_peak_memory()
+        retained = []
+        graph_peak = []
+        start = time.time()
+        for data_shot, data_query in tasks:
+            with SavedTensorMeter() as meter:
+                logits = model((data_shot, label_shot, data_query))
+            retained.append(meter.item())
+            graph_peak.append(meter.peak / 1024 / 1024)
+            model.zero_grad()
+            F.cross_entropy(logits, label_query).backward()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        per_task = (time.time() - start) / args.num_tasks
+        print('inner_detach={}: {:.1f} ms per task, graph retained for the outer step {:.2f} MB '
+              '(peak {:.2f} MB), {}'.format(inner_detach, per_task * 1000, np.mean(retained), np.mean(graph_peak),
+                                            memory_summary()))
+
+
+def bench_meta_grad(args):
+    """Time and memory per outer step for every meta-gradient strategy."""
+    label_shot = task_labels(args, args.shot)
+    label_query = task_labels(args, args.train_query)
+    tasks = [synthetic_task(args) for _ in range(args.meta_batch_size)]
+    for meta_grad in ['inplace', 'first_order', 'truncated', 'implicit', 'second_order']:
+        args.meta_grad = meta_grad
+        model = MtlLearner(args, mode='meta', in_chans=args.in_chans, input_time_length=args.in_chans)
+        if torch.cuda.is_available():
+            model = model.cuda()
+        model.train()
+        optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.encoder.parameters()))
+        step_time = []
+        graph_peak = []
+        for step in range(args.num_outer_steps + 1):
+            reset_peak_memory()
+            start = time.time()
+            with SavedTensorMeter() as meter:
+                task_loss = [F.cross_entropy(model((data_shot, label_shot, data_query)), label_query)
+                             for data_shot, data_query in tasks]
+            optimizer.zero_grad()
+            torch.stack(task_loss).mean().backward()
+            optimizer.step()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            if step > 0:  # the first step is a warm-up
+                step_time.append(time.time() - start)
+                graph_peak.append(meter.peak / 1024 / 1024)
+        print('{:>12}: {:.1f} ms per outer step, graph peak {:.1f} MB, {}'.format(
+            meta_grad, np.mean(step_time) * 1000, np.mean(graph_peak), memory_summary()))
+
+
+def bench_accumulate(args):
+    """Graph peak of one outer step against meta_batch_size, holding the meta-batch graph or streaming per task."""
+    label_shot = task_labels(args, args.shot)
+    label_query = task_labels(args, args.train_query)
+    args.inner_detach = 1
+    model = MtlLearner(args, mode='meta', in_chans=args.in_chans, input_time_length=args.in_chans)
+    if torch.cuda.is_available():
+        model = model.cuda()
+    # eval mode keeps BatchNorm statistics fixed, so both modes see the same forward
+    model.eval()
+    for meta_batch_size in [1, 2, 4, 8]:
+        tasks = [synthetic_task(args) for _ in range(meta_batch_size)]
+        for meta_accumulate in [0, 1]:
+            model.zero_grad()
+            start = time.time()
+            task_loss = []
+            with SavedTensorMeter() as meter:
+                for data_shot, data_query in tasks:
+                    torch.manual_seed(args.seed)
+                    loss = F.cross_entropy(model((data_shot, label_shot, data_query)), label_query)
+                    if meta_accumulate:
+                        (loss / meta_batch_size).backward()
+                        loss = loss.detach()
+                    task_loss.append(loss)
+                if not meta_accumulate:
+                    torch.stack(task_loss).mean().backward()
+            print('meta_batch_size={} meta_accumulate={}: {:.1f} ms, graph peak {:.1f} MB'.format(
+                meta_batch_size, meta_accumulate, (time.time() - start) * 1000, meter.peak / 1024 / 1024))
+
+
+def bench_encode_batched(args):
+    """Encoder forward+backward throughput per task: two calls per task, or one call for the whole meta-batch."""
+    model = MtlLearner(args, mode='meta', in_chans=args.in_chans, input_time_length=args.in_chans)
+    if torch.cuda.is_available():
+        model = model.cuda()
+    model.train()
+    tasks = [synthetic_task(args) for _ in range(args.meta_batch_size)]
+    data = [d for pair in tasks for d in pair]
+    sizes = [d.size(0) for d in data]
+    for name in ['separate calls', 'one call, bn_segments=1', 'one call, bn_segments=0']:
+        for step in range(args.num_outer_steps + 1):
+            if step == 1:  # the first round is a warm-up
+                start = time.time()
+            if name == 'separate calls':
+                embedding = [model.encoder(d) for d in data]
+            elif name == 'one call, bn_segments=1':
+                with segmented_batchnorm(model.encoder, sizes):
+                    embedding = [model.encoder(torch.cat(data))]
+            else:
+                embedding = [model.encoder(torch.cat(data))]
+            sum(e.sum() for e in embedding).backward()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        per_task = (time.time() - start) / args.num_outer_steps / args.meta_batch_size
+        print('{}: {:.2f} ms per task, {:.0f} tasks/s'.format(name, per_task * 1000, 1 / per_task))
+
+
+def bench_inner_optim(args):
+    """Per-task time of the head adaptation with torch Adam and with the flat-buffer Adam."""
+    label_shot = task_labels(args, args.shot)
+    model = MtlLearner(args, mode='meta', in_chans=args.in_chans, input_time_length=args.in_chans)
+    if torch.cuda.is_available():
+        model = model.cuda()
+    model.eval()
+    with torch.no_grad():
+        embeddings = [model.encoder(synthetic_task(args)[0]) for _ in range(args.num_tasks)]
+    for inner_optim in ['adam', 'flat_adam']:
+        args.inner_optim = inner_optim
+        model.inner_loop(embeddings[0], label_shot)  # warm-up, flat_adam allocates its buffer
+        start = time.time()
+        for embedding_shot in embeddings:
+            model.inner_loop(embedding_shot, label_shot)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print('{}: {:.2f} ms per task'.format(inner_optim, (time.time() - start) / args.num_tasks * 1000))
+
+
+def bench_task_workers(args):
+    """Outer step time when the tasks of a meta-batch are adapted on 1..N worker threads (CPU)."""
+    label_shot = task_labels(args, args.shot)
+    label_query = task_labels(args, args.train_query)
+    tasks = [synthetic_task(args) for _ in range(args.meta_batch_size)]
+    data_shot = [shot for shot, _ in tasks]
+    data_query = [query for _, query in tasks]
+    num_cores = os.cpu_count()
+    workers = sorted(set([1, 2, 4, 8, 16, 32, num_cores]))
+    base_time = None
+    for task_workers in [n for n in workers if n <= num_cores]:
+        args.task_workers = task_workers
+        args.intra_op_threads = max(1, num_cores // task_workers)
+        torch.set_num_threads(num_cores if task_workers == 1 else args.intra_op_threads)
+        model = MtlLearner(args, mode='meta', in_chans=args.in_chans, input_time_length=args.in_chans)
+        if torch.cuda.is_available():
+            model = model.cuda()
+        model.train()
+        step_time = []
+        for step in range(args.num_outer_steps + 1):
+            start = time.time()
+            task_logits = model((data_shot, label_shot, data_query))
+            model.zero_grad()
+            torch.stack([F.cross_entropy(logits, label_query) for logits in task_logits]).mean().backward()
+            if step > 0:  # the first step is a warm-up
+                step_time.append(time.time() - start)
+        model.shutdown_task_pool()
+        base_time = base_time or np.mean(step_time)
+        print('task_workers={:>2} intra_op_threads={:>2}: {:.1f} ms per outer step, speedup {:.2f}x'.format(
+            task_workers, args.intra_op_threads, np.mean(step_time) * 1000, base_time / np.mean(step_time)))
+    torch.set_num_threads(num_cores)
+
+
+def bench_head_init(args):
+    """Meta-train with a random and with a meta-learned head initialization, then the query accuracy of
+    held-out tasks against the number of inner steps."""
+    label_shot = task_labels(args, args.shot)
+    label_query = task_labels(args, args.train_query)
+    mixing = torch.eye(args.in_chans) + 0.5 * torch.randn(args.way, args.in_chans, args.in_chans)
+    train_tasks = [class_task(args, mixing) for _ in range(args.meta_batch_size)]
+    test_tasks = [class_task(args, mixing) for _ in range(args.num_tasks)]
+    update_step = args.update_step
+    for head_init in ['random', 'meta']:
+        args.head_init = head_init
+        args.update_step = update_step
+        torch.manual_seed(args.seed)
+        model = MtlLearner(args, mode='meta', in_chans=args.in_chans, input_time_length=args.in_chans)
+        if torch.cuda.is_available():
+            model = model.cuda()
+        optimizer = torch.optim.Adam(
+            [{'params': filter(lambda p: p.requires_grad, model.encoder.parameters())},
+             {'params': model.base_learner.parameters(), 'lr': args.meta_lr2}], lr=args.meta_lr1)
+        model.train()
+        for _ in range(args.num_outer_steps):
+            task_loss = [F.cross_entropy(model((data_shot, label_shot, data_query)), label_query)
+                         for data_shot, data_query in train_tasks]
+            optimizer.zero_grad()
+            torch.stack(task_loss).mean().backward()
+            optimizer.step()
+        model.eval()
+        accs = []
+        for steps in args.eval_steps:
+            model.update_step = steps - 1  # the inner loop runs update_step + 1 steps
+            accs.append(np.mean([count_acc(model((data_shot, label_shot, data_query)), label_query)
+                                 for data_shot, data_query in test_tasks]))
+        final = accs[-1]
+        reached = [s for s, a in zip(args.eval_steps, accs) if a >= 0.95 * final]
+        print('head_init={}: '.format(head_init) + ', '.join('{} steps {:.3f}'.format(s, a)
+                                                            for s, a in zip(args.eval_steps, accs)))
+        print('head_init={}: {} steps to 95% of the accuracy at {} steps'.format(head_init, reached[0],
+                                                                             args.eval_steps[-1]))
+    args.update_step = update_step
+
+
+def bench_inner_lr(args):
+    """Per-task adaptation time and held-out accuracy after meta-training: Adam with update_step steps against
+    Meta-SGD with learned per-layer or per-parameter step sizes and sgd_steps steps."""
+    label_shot = task_labels(args, args.shot)
+    label_query = task_labels(args, args.train_query)
+    mixing = torch.eye(args.in_chans) + 0.5 * torch.randn(args.way, args.in_chans, args.in_chans)
+    train_tasks = [class_task(args, mixing) for _ in range(args.meta_batch_size)]
+    test_tasks = [class_task(args, mixing) for _ in range(args.num_tasks)]
+    update_step = args.update_step
+    for inner_lr_mode in ['none', 'per_layer', 'per_param']:
+        args.inner_lr_mode = inner_lr_mode
+        args.update_step = update_step if inner_lr_mode == 'none' else args.sgd_steps - 1
+        torch.manual_seed(args.seed)
+        model = MtlLearner(args, mode='meta', in_chans=args.in_chans, input_time_length=args.in_chans)
+        if torch.cuda.is_available():
+            model = model.cuda()
+        optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.encoder.parameters()), lr=args.meta_lr1)
+        if model.inner_lrs is not None:
+            optimizer.add_param_group({'params': model.inner_lrs.parameters()})
+        model.train()
+        for _ in range(args.num_outer_steps):
+            task_loss = [F.cross_entropy(model((data_shot, label_shot, data_query)), label_query)
+                         for data_shot, data_query in train_tasks]
+            optimizer.zero_grad()
+            torch.stack(task_loss).mean().backward()
+            optimizer.step()
+        model.eval()
+        with torch.no_grad():
+            embeddings = [(model.encoder(data_shot), model.encoder(data_query)) for data_shot, data_query in test_tasks]
+        start = time.time()
+        accs = [count_acc(model.meta_head_forward(shot, label_shot, query), label_query) for shot, query in embeddings]
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print('inner_lr_mode={} ({} steps): {:.2f} ms per task adaptation, query acc {:.3f}'.format(
+            inner_lr_mode, args.update_step + 1, (time.time() - start) / args.num_tasks * 1000, np.mean(accs)))
+    args.inner_lr_mode = 'none'
+    args.update_step = update_step
+
+
+def bench_eval_batched(args):
+    """Meta-test time of num_tasks episodes drawn from one pool of trials: one episode at a time, or every trial
+    encoded once and all episode heads adapted together."""
+    label_shot = task_labels(args, args.shot)
+    pool = torch.cat(synthetic_task(args) + synthetic_task(args))
+    label = torch.arange(args.way).repeat(pool.size(0) // args.way)
+    sampler = CategoriesSampler(label, args.num_tasks, args.way, args.shot + args.train_query)
+    episodes = torch.stack(list(sampler))
+    model = MtlLearner(args, mode='meta', in_chans=args.in_chans, input_time_length=args.in_chans)
+    if torch.cuda.is_available():
+        model = model.cuda()
+        episodes = episodes.cuda()
+    model.eval()
+    p = args.way * args.shot
+    start = time.time()
+    for e in episodes:
+        model((pool[e[:p]], label_shot, pool[e[p:]]))
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    looped_time = time.time() - start
+    start = time.time()
+    model.eval_episodes(pool, episodes, label_shot)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    batched_time = time.time() - start
+    print('per episode: {:.1f} ms, batched: {:.1f} ms, speedup {:.1f}x'.format(
+        looped_time * 1000, batched_time * 1000, looped_time / batched_time))
+
+
+def bench_metrics(args):
+    """Time of the meta-test metrics of num_tasks episodes: sklearn per episode on hard predictions as the trainers
+    did, against utils.metrics on the stacked logits."""
+    from sklearn.metrics import roc_auc_score, f1_score
+    from sklearn.preprocessing import LabelBinarizer
+    label = torch.arange(args.way).repeat(args.train_query)
+    logits = torch.randn(args.num_tasks, label.size(0), args.way) + 2 * F.one_hot(label, args.way)
+    start = time.time()
+    y = label.numpy()
+    for episode_logits in logits:
+        predicted = np.argmax(episode_logits.numpy(), axis=1)
+        f1_score(y, predicted, average='macro')
+        lb = LabelBinarizer()
+        lb.fit(y)
+        roc_auc_score(lb.transform(y), lb.transform(predicted), average='macro')
+    sklearn_time = time.time() - start
+    start = time.time()
+    summarize(episode_metrics(logits, label, args.way))
+    batched_time = time.time() - start
+    print('{} episodes: sklearn per episode {:.1f} ms, batched {:.1f} ms, speedup {:.0f}x'.format(
+        args.num_tasks, sklearn_time * 1000, batched_time * 1000, sklearn_time / batched_time))
+
+
+def _split_inference(args, n, chunk_size):
+    """Runs in a fresh process: peak memory of val_orig-style inference over a split of n samples."""
+    time_step = args.time_step or args.in_chans
+    model = MtlLearner(args, mode='pre', num_cls=args.way, in_chans=args.in_chans, input_time_length=time_step)
+    if torch.cuda.is_available():
+        model = model.cuda()
+    model.eval()
+    model.mode = 'origval'
+    inputs = np.random.randn(n, 1, time_step, args.in_chans).astype(np.float32)
+    labels = np.arange(n) % args.way
+    base = peak_memory()
+    reset_peak_memory()
+    start = time.time()
+    chunked_inference(model, inputs, labels, chunk_size or n)
+    return peak_memory() - (0 if torch.cuda.is_available() else base), time.time() - start
+
+
+def bench_val_chunk(args):
+    """Peak memory of inference over a whole split against its size, in one forward or in chunks of val_chunk."""
+    context = multiprocessing.get_context('spawn')
+    for n in [256, 1024, 4096]:
+        for chunk_size in [0, args.val_chunk]:
+            # a fresh process per run, the CPU peak (max RSS) cannot be reset
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                peak, seconds = pool.submit(_split_inference, args, n, chunk_size).result()
+            print('{} samples, {}: peak memory {:.0f} MB, {:.2f} s'.format(
+                n, 'chunks of {}'.format(chunk_size) if chunk_size else 'one forward', peak, seconds))
+
+
+def bench_output_shape(args):
+    """MtlLearner construction time with the analytic encoder shape, against the num_batch dummy forward it
+    replaced."""
+    time_step = args.time_step or args.in_chans
+    for mode in ['meta', 'pre']:
+        start = time.time()
+        model = MtlLearner(args, mode=mode, num_cls=args.way, in_chans=args.in_chans, input_time_length=time_step)
+        build_time = time.time() - start
+        model.eval()
+        start = time.time()
+        with torch.no_grad():
+            model.encoder(torch.ones(args.num_batch, 1, time_step, args.in_chans))
+        forward_time = time.time() - start
+        print('{} mode: construction {:.1f} ms, the dummy forward took {:.1f} ms'.format(
+            mode, build_time * 1000, forward_time * 1000))
+
+
+def bench_precision(args):
+    """Pre-train throughput, inference throughput and test accuracy of the pre-mode model for every precision,
+    on synthetic raw trials shaped like BNCI2014001 (22 channels, 1125 samples, 4 classes by default). The classes
+    differ in their spatial mixing, every precision starts from the same weights and sees the same batches."""
+    time_step = args.time_step or args.in_chans
+    mixing = torch.eye(args.in_chans) + 0.5 * torch.randn(args.way, args.in_chans, args.in_chans)
+
+    def trials(n):
+        label = torch.arange(n) % args.way
+        x = torch.randn(n, time_step, args.in_chans) @ mixing[label].transpose(1, 2)
+        return x.unsqueeze(1), label
+
+    train_x, train_y = trials(args.num_batch * args.num_outer_steps)
+    test_x, test_y = trials(4 * args.num_batch)
+    if torch.cuda.is_available():
+        train_x, train_y, test_x, test_y = train_x.cuda(), train_y.cuda(), test_x.cuda(), test_y.cuda()
+    torch.manual_seed(args.seed)
+    init = MtlLearner(args, mode='pre', num_cls=args.way, in_chans=args.in_chans, input_time_length=time_step).state_dict()
+    for precision in ['fp32', 'bf16']:
+        args.precision = precision
+        model = MtlLearner(args, mode='pre', num_cls=args.way, in_chans=args.in_chans, input_time_length=time_step)
+        model.load_state_dict(init)
+        if torch.cuda.is_available():
+            model = model.cuda()
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        scaler = grad_scaler(args)
+        model.train()
+        start = time.time()
+        for i in range(0, train_x.size(0), args.num_batch):
+            loss = F.cross_entropy(model(train_x[i:i + args.num_batch]), train_y[i:i + args.num_batch])
+            optimizer.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        train_time = time.time() - start
+        model.eval()
+        start = time.time()
+        with torch.no_grad():
+            logits = torch.cat([model(test_x[i:i + args.num_batch]) for i in range(0, test_x.size(0), args.num_batch)])
+        test_time = time.time() - start
+        print('{}: train {:.0f} samples/s, inference {:.0f} samples/s, test acc {:.3f}'.format(
+            precision, train_x.size(0) / train_time, test_x.size(0) / test_time, count_acc(logits, test_y)))
+    args.precision = 'fp32'
+
+
+def bench_compile(args):
+    """Latency of the pre-mode model (encoder and classifier) in eval mode, eager against every compile backend,
+    at batch sizes 1, 16 and 256."""
+    time_step = args.time_step or args.in_chans
+    for backend in ['none', 'trace', 'script', 'compile']:
+        torch.manual_seed(args.seed)
+        model = MtlLearner(args, mode='pre', num_cls=args.way, in_chans=args.in_chans, input_time_length=time_step)
+        model.eval()
+        start = time.time()
+        used = model.compile_inference(backend)
+        compile_time = time.time() - start
+        results = []
+        for batch_size in [1, 16, 256]:
+            x = torch.randn(batch_size, 1, time_step, args.in_chans)
+            with torch.no_grad():
+                for _ in range(3):  # warm-up, also the first calls that specialize the graphs
+                    model(x)
+                repeats = max(3, 256 // batch_size)
+                start = time.time()
+                for _ in range(repeats):
+                    model(x)
+            latency = (time.time() - start) / repeats
+            results.append('batch {}: {:.2f} ms'.format(batch_size, latency * 1000))
+        print('{} -> {} (compiled in {:.1f} s): {}'.format(backend, used, compile_time, ', '.join(results)))
+
+
+def bench_quantize(args):
+    """Latency of the int8 pre-mode model against float32 at batch sizes 1, 16 and 256, calibrated on a subset of
+    random trials."""
+    time_step = args.time_step or args.in_chans
+    model = MtlLearner(args, mode='pre', num_cls=args.way, in_chans=args.in_chans, input_time_length=time_step)
+    float_model = torch.nn.Sequential(model.encoder, model.classifier).eval()
+    data = torch.randn(512, 1, time_step, args.in_chans)
+    start = time.time()
+    int8_model = quantize_static(float_model, calibration_subset(data, args.calib_samples))
+    print('calibrated on {} samples in {:.1f} s'.format(args.calib_samples, time.time() - start))
+    for batch_size in [1, 16, 256]:
+        repeats = max(3, 256 // batch_size)
+        print('batch {}: float32 {:.2f} ms, int8 {:.2f} ms'.format(
+            batch_size, inference_latency(float_model, data, batch_size, repeats),
+            inference_latency(int8_model, data, batch_size, repeats)))
+
+
+def bench_onnx(args):
+    """Throughput of the ONNX exports against PyTorch at batch sizes 1, 16 and 256: the pre-mode model,
+    and the fused encoder with a base learner adapted to one random task."""
+    import tempfile
+    time_step = args.time_step or args.in_chans
+    data = torch.randn(256, 1, time_step, args.in_chans)
+    pre_model = MtlLearner(args, mode='pre', num_cls=args.way, in_chans=args.in_chans, input_time_length=time_step)
+    pre_model.eval()
+    meta_model = MtlLearner(args, mode='meta', num_cls=args.way, in_chans=args.in_chans, input_time_length=time_step)
+    label_shot = torch.arange(args.way).repeat(args.shot)
+    adapted = adapt(meta_model, torch.randn(label_shot.size(0), 1, time_step, args.in_chans), label_shot)
+    for name, model, torch_model in [('pre', pre_model, torch.nn.Sequential(pre_model.encoder, pre_model.classifier)),
+                                     ('adapted', adapted, adapted)]:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, name + '.onnx')
+            start = time.time()
+            export_onnx(model, path, data[:2])
+            export_time = time.time() - start
+            predictor = OnnxPredictor(path, threads=args.intra_op_threads)
+            results = []
+            for batch_size in [1, 16, 256]:
+                x = data[:batch_size]
+                repeats = max(3, 256 // batch_size)
+                torch_time = inference_latency(torch_model, x, batch_size, repeats)
+                start = time.time()
+                for _ in range(repeats):
+                    predictor(x)
+                onnx_time = (time.time() - start) / repeats * 1000
+                results.append('batch {}: torch {:.0f}/s, onnxruntime {:.0f}/s'.format(
+                    batch_size, batch_size * 1000 / torch_time, batch_size * 1000 / onnx_time))
+        print('{} (exported in {:.1f} s): {}'.format(name, export_time, ', '.join(results)))
+
+
+def bench_spd_packed(args):
+    """The full-matrix SPD_CNNnet against the packed upper-triangular input path: input bytes per trial, conv1
+    multiply-adds and time, the pre-train step time and the test accuracy after pre-training both from the same
+    initial weights on the same class-separable covariances."""
+    n = args.in_chans
+    mixing = torch.eye(n) + 0.05 * torch.randn(args.way, n, n)
+
+    def trials(count):
+        label = torch.arange(count) % args.way
+        x = mixing[label] @ torch.randn(count, n, 2 * n)
+        covs = x @ x.transpose(1, 2) / x.size(2)
+        covs = (covs - covs.mean((1, 2), keepdim=True)) / covs.std((1, 2), keepdim=True)
+        return covs.unsqueeze(1), label
+
+    train_x, train_y = trials(args.num_batch * args.num_outer_steps)
+    test_x, test_y = trials(4 * args.num_batch)
+    torch.manual_seed(args.seed)
+    init = MtlLearner(args, mode='pre', num_cls=args.way, in_chans=n, input_time_length=n).state_dict()
+    # a symmetric conv1 kernel, so that both paths start from the same function
+    init['encoder.conv1.weight'] = symmetrize(init['encoder.conv1.weight'])
+    for packed in [0, 1]:
+        args.spd_packed = packed
+        model = MtlLearner(args, mode='pre', num_cls=args.way, in_chans=n, input_time_length=n)
+        model.load_state_dict(init)
+        prepare = (lambda x: torch.from_numpy(pack_upper(x.numpy()))) if packed else (lambda x: x)
+        data, test_data = prepare(train_x), prepare(test_x)
+        conv1 = model.encoder.packed_conv1 if packed else model.encoder.conv1
+        positions = packed_size(n - 1) if packed else (n - 1) ** 2
+        with torch.no_grad():
+            conv1(data[:args.num_batch])
+            start = time.time()
+            for _ in range(10):
+                conv1(data[:args.num_batch])
+            conv1_time = (time.time() - start) / 10
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        model.train()
+        start = time.time()
+        for i in range(0, data.size(0), args.num_batch):
+            loss = F.cross_entropy(model(data[i:i + args.num_batch]), train_y[i:i + args.num_batch])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        step_time = (time.time() - start) / args.num_outer_steps
+        model.eval()
+        with torch.no_grad():
+            acc = count_acc(model(test_data), test_y)
+        print('{}: {} bytes per trial, conv1 {} multiply-adds per filter, {:.2f} ms; train step {:.1f} ms; '
+              'test acc {:.3f}'.format('packed' if packed else 'full', data[0].numel() * 4, positions * 4,
+                                      conv1_time * 1000, step_time * 1000, acc))
+    args.spd_packed = 0
+
+
+def bench_spdnet(args):
+    """SPD_CNNnet against the SPDNet encoder at 12, 22 and 44 channels (BNCI2015004 here, BNCI2014001,
+    Schirrmeister2017): parameters, embedding size, pre-train step time, inference throughput and the test accuracy
+    after pre-training on the same class-separable standardized covariances."""
+    model_type = args.model_type
+    for n in [12, 22, 44]:
+        mixing = torch.eye(n) + 0.05 * torch.randn(args.way, n, n)
+
+        def trials(count):
+            label = torch.arange(count) % args.way
+            x = mixing[label] @ torch.randn(count, n, 2 * n)
+            covs = x @ x.transpose(1, 2) / x.size(2)
+            covs = (covs - covs.mean((1, 2), keepdim=True)) / covs.std((1, 2), keepdim=True)
+            return covs.unsqueeze(1), label
+
+        train_x, train_y = trials(args.num_batch * args.num_outer_steps)
+        test_x, test_y = trials(4 * args.num_batch)
+        for args.model_type in ['SPD_CNNnet', 'SPDNet']:
+            torch.manual_seed(args.seed)
+            model = MtlLearner(args, mode='pre', num_cls=args.way, in_chans=n, input_time_length=n)
+            optimizer = torch.optim.Adam(model.parameters(), lr=args.pre_lr)
+            model.train()
+            start = time.time()
+            for i in range(0, train_x.size(0), args.num_batch):
+                loss = F.cross_entropy(model(train_x[i:i + args.num_batch]), train_y[i:i + args.num_batch])
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            step_time = (time.time() - start) / args.num_outer_steps
+            model.eval()
+            with torch.no_grad():
+                model(test_x[:args.num_batch])
+                start = time.time()
+                logits = model(test_x)
+                test_time = time.time() - start
+            print('{} channels, {}: {} parameters, {} features; train step {:.1f} ms, inference {:.0f} samples/s, '
+                  'test acc {:.3f}'.format(n, args.model_type, sum(p.numel() for p in model.parameters()),
+                                          model.final_layer_length, step_time * 1000, test_x.size(0) / test_time,
+                                          count_acc(logits, test_y)))
+    args.model_type = model_type
+
+
+def bench_recenter(args):
+    """Inner steps needed with and without per-subject re-centering. Six synthetic subjects share the class
+    structure but each has its own spatial shift; tasks are meta-trained from the pooled trials of five subjects and
+    tested on the sixth, with the covariances standardized as is or first whitened by each subject's log-Euclidean
+    or Riemannian mean. Prints the held-out query accuracy against the number of inner steps, and the steps each
+    needs to reach 95% of the accuracy without re-centering at the last of eval_steps."""
+    n, subjects, rounds = args.in_chans, 6, 4 * (args.shot + args.train_query)
+    mixing = torch.eye(n) + 0.5 * torch.randn(args.way, n, n)
+    raw = []
+    for _ in range(subjects):
+        # trials ordered as task_labels orders the labels: round by round, one trial per class
+        label = torch.arange(args.way).repeat(rounds)
+        x = (torch.eye(n) + 0.3 * torch.randn(n, n)) @ mixing[label] @ torch.randn(len(label), n, 2 * n)
+        raw.append((x @ x.transpose(1, 2) / x.size(2)).double().numpy())
+    label_shot = task_labels(args, args.shot)
+    label_query = task_labels(args, args.train_query)
+
+    def task(x):
+        picked = torch.randperm(x.size(0) // args.way)[:args.shot + args.train_query]
+        data = x[(picked.unsqueeze(1) * args.way + torch.arange(args.way)).reshape(-1)]
+        if torch.cuda.is_available():
+            data = data.cuda()
+        return data[:args.way * args.shot], data[args.way * args.shot:]
+
+    update_step = args.update_step
+    target = None
+    for mean in ['none', 'logeuclid', 'riemann']:
+        start = time.time()
+        iterations, xs = [], []
+        for covs in raw:
+            if mean == 'riemann':
+                reference, used = riemannian_mean(covs)
+                iterations.append(used)
+            elif mean == 'logeuclid':
+                reference = log_euclidean_mean(covs)
+            x = covs if mean == 'none' else unpack_upper(recenter(covs, reference), n)
+            xs.append(torch.from_numpy(normalize(x)).float().unsqueeze(1))
+        prepare_time = time.time() - start
+        pooled, held_out = torch.cat(xs[:-1]), xs[-1]
+        torch.manual_seed(args.seed)
+        args.update_step = update_step
+        model = MtlLearner(args, mode='meta', in_chans=n, input_time_length=n)
+        if torch.cuda.is_available():
+            model = model.cuda()
+        optimizer = torch.optim.Adam(
+            [{'params': filter(lambda p: p.requires_grad, model.encoder.parameters())},
+             {'params': model.base_learner.parameters(), 'lr': args.meta_lr2}], lr=args.meta_lr1)
+        model.train()
+        for _ in range(args.num_outer_steps):
+            task_loss = []
+            for _ in range(args.meta_batch_size):
+                data_shot, data_query = task(pooled)
+                task_loss.append(F.cross_entropy(model((data_shot, label_shot, data_query)), label_query))
+            optimizer.zero_grad()
+            torch.stack(task_loss).mean().backward()
+            optimizer.step()
+        model.eval()
+        test_tasks = [task(held_out) for _ in range(args.num_tasks)]
+        accs = []
+        for steps in args.eval_steps:
+            model.update_step = steps - 1  # the inner loop runs update_step + 1 steps
+            accs.append(np.mean([count_acc(model((data_shot, label_shot, data_query)), label_query)
+                                 for data_shot, data_query in test_tasks]))
+        target = target or 0.95 * accs[-1]
+        reached = [s for s, a in zip(args.eval_steps, accs) if a >= target]
+        print('recenter={} (prepared in {:.2f} s{}): '.format(
+            mean, prepare_time, ', {} mean iterations'.format(max(iterations)) if iterations else '') +
+            ', '.join('{} steps {:.3f}'.format(s, a) for s, a in zip(args.eval_steps, accs)))
+        print('recenter={}: {} steps to acc {:.3f}'.format(mean, reached[0] if reached else 'more than {}'.format(
+            args.eval_steps[-1]), target))
+    args.update_step = update_step
+
+
+def bench_filter_bank(args):
+    """Filter-bank covariances of synthetic trials, 4 s at 250 Hz, in seven 4 Hz bands from 4 to 32 Hz: one band at a
+    time, each band re-reading the trials for its own FFT, band-pass and inverse FFT before the Ledoit-Wolf
+    covariances, against filter_bank_covariances with one FFT shared by all bands ('lwf', and 'scm' without any
+    inverse FFT). The band-by-band time includes the sample covariances, which cost little next to the
+    transforms."""
+    sfreq, bands = 250, [(low, low + 4) for low in range(4, 32, 4)]
+    x = np.random.RandomState(args.seed).randn(args.num_tasks * args.way * (args.shot + args.train_query),
+                                               args.in_chans, 4 * sfreq)
+    freqs = np.fft.rfftfreq(x.shape[-1], 1. / sfreq)
+    start = time.time()
+    for low, high in bands:
+        mask = (freqs >= low) & (freqs < high) & (freqs > 0)
+        band = np.fft.irfft(np.fft.rfft(x, axis=-1) * mask, n=x.shape[-1], axis=-1)
+        ledoit_wolf(band), band @ np.swapaxes(band, -1, -2) / x.shape[-1]
+    separate_time = time.time() - start
+    print('{} trials of {} channels, {} bands: one band at a time {:.2f} s'.format(
+        len(x), args.in_chans, len(bands), separate_time))
+    for estimator in ['lwf', 'scm']:
+        start = time.time()
+        filter_bank_covariances(x, sfreq, bands, estimator)
+        single_time = time.time() - start
+        print('single pass, {}: {:.2f} s ({:.1f}x)'.format(estimator, single_time, separate_time / single_time))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', type=str, default='inner_detach', choices=['inner_detach', 'meta_grad', 'accumulate', 'encode_batched', 'inner_optim', 'task_workers', 'head_init', 'inner_lr', 'eval_batched', 'metrics', 'val_chunk', 'output_shape', 'precision', 'compile', 'quantize', 'onnx', 'spd_packed', 'spdnet', 'recenter', 'filter_bank'])
+    parser.add_argument('--model_type', type=str, default='SPD_CNNnet')
+    parser.add_argument('--in_chans', type=int, default=22)  # size of the synthetic covariance matrices
+    parser.add_argument('--time_step', type=int, default=0)  # input length for val_chunk with raw-signal models, 0: in_chans
+    parser.add_argument('--num_tasks', type=int, default=10)
+    parser.add_argument('--MTL', type=int, default=1)
+    parser.add_argument('--num_batch', type=int, default=60)
+    parser.add_argument('--way', type=int, default=4)
+    parser.add_argument('--shot', type=int, default=10)
+    parser.add_argument('--train_query', type=int, default=10)
+    parser.add_argument('--base_lr', type=float, default=1e-3)
+    parser.add_argument('--update_step', type=int, default=75)
+    parser.add_argument('--inner_detach', type=int, default=0)
+    parser.add_argument('--inner_optim', type=str, default='adam')
+    parser.add_argument('--head', type=str, default='linear')
+    parser.add_argument('--precision', type=str, default='fp32')
+    parser.add_argument('--head_init', type=str, default='random')
+    parser.add_argument('--inner_lr_mode', type=str, default='none')
+    parser.add_argument('--inner_lr_init', type=float, default=0.01)
+    parser.add_argument('--sgd_steps', type=int, default=5)  # Meta-SGD inner steps for inner_lr
+    parser.add_argument('--meta_grad', type=str, default='inplace')
+    parser.add_argument('--truncate_steps', type=int, default=5)
+    parser.add_argument('--implicit_lam', type=float, default=1.0)
+    parser.add_argument('--cg_steps', type=int, default=5)
+    parser.add_argument('--inner_tol', type=float, default=0.)
+    parser.add_argument('--inner_patience', type=int, default=5)
+    parser.add_argument('--inner_grad_tol', type=float, default=0.)
+    parser.add_argument('--meta_batch_size', type=int, default=5)
+    parser.add_argument('--encode_batched', type=int, default=0)
+    parser.add_argument('--bn_segments', type=int, default=1)
+    parser.add_argument('--task_workers', type=int, default=1)
+    parser.add_argument('--intra_op_threads', type=int, default=1)
+    parser.add_argument('--num_outer_steps', type=int, default=3)
+    parser.add_argument('--eval_steps', type=int, nargs='+', default=[0, 1, 2, 5, 10, 25, 50, 75])  # inner steps for head_init
+    parser.add_argument('--meta_lr1', type=float, default=1e-4)
+    parser.add_argument('--meta_lr2', type=float, default=5e-3)
+    parser.add_argument('--num_cls_lay', type=int, default=1)
+    parser.add_argument('--num_cls_hidden', type=int, default=32)
+    parser.add_argument('--val_chunk', type=int, default=256)
+    parser.add_argument('--calib_samples', type=int, default=256)
+    parser.add_argument('--spd_packed', type=int, default=0)  # SPD_CNNnet's conv1 kernel is symmetrized, see main.py
+    parser.add_argument('--pre_lr', type=float, default=1e-3)  # pre-train learning rate for spdnet
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+
+    if args.bench == 'inner_detach':
+        bench_inner_detach(args)
+    elif args.bench == 'meta_grad':
+        bench_meta_grad(args)
+    elif args.bench == 'accumulate':
+        bench_accumulate(args)
+    elif args.bench == 'encode_batched':
+        bench_encode_batched(args)
+    elif args.bench == 'inner_optim':
+        bench_inner_optim(args)
+    elif args.bench == 'task_workers':
+        bench_task_workers(args)
+    elif args.bench == 'head_init':
+        bench_head_init(args)
+    elif args.bench == 'inner_lr':
+        bench_inner_lr(args)
+    elif args.bench == 'eval_batched':
+        bench_eval_batched(args)
+    elif args.bench == 'metrics':
+        bench_metrics(args)
+    elif args.bench == 'val_chunk':
+        bench_val_chunk(args)
+    elif args.bench == 'output_shape':
+        bench_output_shape(args)
+    elif args.bench == 'precision':
+        bench_precision(args)
+    elif args.bench == 'compile':
+        bench_compile(args)
+    elif args.bench == 'quantize':
+        bench_quantize(args)
+    elif args.bench == 'onnx':
+        bench_onnx(args)
+    elif args.bench == 'spd_packed':
+        bench_spd_packed(args)
+    elif args.bench == 'spdnet':
+        bench_spdnet(args)
+    elif args.bench == 'recenter':
+        bench_recenter(args)
+    elif args.bench == 'filter_bank':
+        bench_filter_bank(args)
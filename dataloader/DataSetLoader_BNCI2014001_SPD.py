@@ -4,7 +4,7 @@
 
 import numpy as np
 from torch.utils.data import Dataset
-import pickle
+from dataloader.spd_preprocess import load_spd, normalize, matrix_size, model_input
 import moabb
 from moabb.datasets import BNCI2014001
 from moabb.paradigms import MotorImagery
@@ -14,14 +14,11 @@ class DataSetLoader_BNCI2014001_SPD(Dataset):
         RawData={}
         for i in range(1,10):# B
             # 9subjects
-            var_name = './dataloader/BNCI2014001_SPD/'+'BNCI2014Subject_' + str(i)+'_SPD'
-
-            with open(var_name,'rb') as file1:
-                name = 'BNCI2014001Subject' + str(i) +'_Trails'
-                SubjectData=pickle.load(file1)
-                RawData[name]=SubjectData['org']['covs']
-                name = 'BNCI2014001Subject' + str(i) + '_labels'
-                RawData[name] = SubjectData['org']['labels']
+            # packed float32 upper triangles when the folder has a manifest, else the full matrices of the pickle;
+            # with args.spd_tangent or args.spd_recenter the cached tangent vectors or re-centred covariances
+            covs, labels = load_spd('./dataloader/BNCI2014001_SPD/', 'BNCI2014Subject_' + str(i)+'_SPD', args)
+            RawData['BNCI2014001Subject' + str(i) +'_Trails'] = covs
+            RawData['BNCI2014001Subject' + str(i) + '_labels'] = labels
         #Choose Subject
         train_x = None#
         subject_divide={}#
@@ -58,21 +55,11 @@ class DataSetLoader_BNCI2014001_SPD(Dataset):
                 val_y = np.concatenate((val_y, RawData[var_label]), axis=0)
         del RawData
         ###### normalize the matrix
-        i = 0
-        for X in train_x:
-            X_minMax = (X - X.mean()) / X.std()
-            train_x[i, :, :] = X_minMax  #
-            i = i + 1
-        i = 0
-        for X in test_x:
-            X_minMax = (X - X.mean()) / X.std()
-            test_x[i, :, :] = X_minMax
-            i = i + 1
-        i = 0
-        for X in val_x:
-            X_minMax = (X - X.mean()) / X.std()
-            val_x[i, :, :] = X_minMax
-            i = i + 1
+        packed = train_x.ndim == 3  # (N, bands, n * (n + 1) / 2) upper triangles, else (N, bands, n, n)
+        if args.spd_standardize and not args.spd_tangent:  # the tangent vectors are already centred at each subject's mean
+            train_x = normalize(train_x, packed)
+            test_x = normalize(test_x, packed)
+            val_x = normalize(val_x, packed)
         ###### end of debug
         #pytorch 需要 input-float32 label-int64
         train_x = train_x.astype('float32')
@@ -97,18 +84,19 @@ class DataSetLoader_BNCI2014001_SPD(Dataset):
         ## for the network input number
         classs_set =set(test_y)
         self.num_class = len(classs_set)
-        self.in_chans=np.size(test_x,1)
-        self.time_step=np.size(test_x,2)
+        self.bands = np.size(test_x, 1)  # the input channels of SPD_CNNnet
+        self.in_chans=matrix_size(test_x) if packed else np.size(test_x,2)
+        self.time_step=matrix_size(test_x) if packed else np.size(test_x,3)
         ###
-        train_raw_x = np.transpose(train_x, [0, 2, 1])
-        test_raw_x = np.transpose(test_x, [0, 2, 1])
-        val_raw_x  = np.transpose(val_x, [0, 2, 1])
+        train_raw_x = train_x if packed else np.transpose(train_x, [0, 1, 3, 2])
+        test_raw_x = test_x if packed else np.transpose(test_x, [0, 1, 3, 2])
+        val_raw_x  = val_x if packed else np.transpose(val_x, [0, 1, 3, 2])
 
 
         #
-        train_win_x = np.expand_dims(train_raw_x, axis=1)
-        test_win_x = np.expand_dims(test_raw_x, axis=1)
-        val_win_x  = np.expand_dims(val_raw_x, axis=1)
+        train_win_x = train_raw_x  # the band axis is already the channel axis
+        test_win_x = test_raw_x
+        val_win_x  = val_raw_x
         train_win_y = train_y
         test_win_y = test_y
         val_win_y=val_y
@@ -142,6 +130,9 @@ class DataSetLoader_BNCI2014001_SPD(Dataset):
         elif setname == 'test':
             self.data=test_win_x
             self.label=test_win_y
+        # upper triangles (N, 1, chans * (chans + 1) / 2) for args.spd_packed, otherwise full matrices, which packed
+        # storage expands per batch
+        self.data, self.X_val, self.X_test = [model_input(x, args.spd_packed) for x in (self.data, self.X_val, self.X_test)]
         print('End of Preparing')
 
 
@@ -5,6 +5,7 @@
 """ Sampler for dataloader. """
 import torch
 import numpy as np
+from torch.utils.data.dataloader import default_collate
 
 class CategoriesSampler():
     """The class to generate  data"""
@@ -37,3 +38,13 @@ class CategoriesSampler():
             yield batch #
 
 
+def episode_batch(dataset, sampler):
+    """Stack all episodes of a batch sampler for batched evaluation.
+    Returns:
+      the data of the unique trials the episodes use, each loaded once, and for every episode the indices of
+      its trials into that data, shaped (n_batch, n_cls * n_per) in the order the sampler yields them
+    """
+    episodes = torch.stack([torch.as_tensor(batch) for batch in sampler])
+    unique, inverse = torch.unique(episodes, return_inverse=True)
+    data = default_collate([dataset[i] for i in unique.tolist()])[0]
+    return data, inverse
@@ -0,0 +1,327 @@
+""" Preprocessing and storage of the SPD (covariance) datasets. """
+import hashlib
+import json
+import os
+import os.path as osp
+import pickle
+import sys
+import numpy as np
+
+MANIFEST = 'manifest.json'
+
+
+def packed_size(n):
+    """Entries of the upper triangle, diagonal included, of an n x n matrix."""
+    return n * (n + 1) // 2
+
+
+def pack_upper(x):
+    """The upper triangles, row by row, of a batch of symmetric matrices.
+    Args:
+      x: array shaped (..., n, n)
+    Returns:
+      float32 array shaped (..., n * (n + 1) / 2)
+    """
+    rows, cols = np.triu_indices(x.shape[-1])
+    return np.ascontiguousarray(x[..., rows, cols], dtype=np.float32)
+
+
+def unpack_upper(packed, n):
+    """The symmetric matrices back from pack_upper, shaped (..., n, n)."""
+    rows, cols = np.triu_indices(n)
+    x = np.empty(packed.shape[:-1] + (n, n), dtype=packed.dtype)
+    x[..., rows, cols] = packed
+    x[..., cols, rows] = packed
+    return x
+
+
+def matrix_size(x):
+    """The side n of the matrices of packed upper triangles, shaped (..., n * (n + 1) / 2)."""
+    return int(round((np.sqrt(8 * x.shape[-1] + 1) - 1) / 2))
+
+
+def normalize(x, packed=False):
+    """Standardize every matrix by the mean and std of all its entries, as the loaders did matrix by matrix.
+    Args:
+      x: matrices shaped (..., n, n), or their upper triangles shaped (..., n * (n + 1) / 2) with packed
+    """
+    if not packed:
+        axes = (-2, -1)
+        return (x - x.mean(axes, keepdims=True)) / x.std(axes, keepdims=True)
+    n = matrix_size(x)
+    rows, cols = np.triu_indices(n)
+    # every off-diagonal entry stands for two entries of the full matrix
+    weight = np.where(rows == cols, 1., 2.) / (n * n)
+    mean = (x * weight).sum(-1, keepdims=True)
+    std = np.sqrt((np.square(x - mean) * weight).sum(-1, keepdims=True))
+    return (x - mean) / std
+
+
+def with_bands(x, packed):
+    """The covariances of a subject with a band axis after the trials, (N, K, n * (n + 1) / 2) packed or
+    (N, K, n, n); single-band data gets K = 1."""
+    return x[:, None] if x.ndim == (2 if packed else 3) else x
+
+
+def ledoit_wolf(x):
+    """sklearn's ledoit_wolf for a batch of signals shaped (..., chans, samples): the empirical covariance of the
+    centred samples shrunk towards mu * I by the Ledoit-Wolf coefficient."""
+    x = x - x.mean(-1, keepdims=True)
+    p, t = x.shape[-2:]
+    cov = x @ np.swapaxes(x, -1, -2) / t
+    mu = np.trace(cov, axis1=-2, axis2=-1) / p
+    x2 = np.square(x)
+    delta_ = np.square(cov).sum((-2, -1))
+    beta = ((x2 @ np.swapaxes(x2, -1, -2)).sum((-2, -1)) / t - delta_) / (p * t)
+    delta = (delta_ - p * np.square(mu)) / p
+    shrinkage = np.where(delta > 0, np.minimum(beta, delta) / np.where(delta > 0, delta, 1), 0)[..., None, None]
+    return (1 - shrinkage) * cov + shrinkage * mu[..., None, None] * np.eye(p)
+
+
+def filter_bank_covariances(x, sfreq, bands, estimator='lwf', chunk=64):
+    """The covariances of the trials in K frequency bands, from one real FFT of the trials shared by all bands.
+    'scm' takes the band covariances straight from the spectrum (Parseval): every band sums only its own bins
+    and no inverse transform is needed. 'lwf', as the broadband generators use, needs the band signals for the
+    shrinkage: one batched inverse FFT of the K masked spectra, then ledoit_wolf. The bands are ideal zero-phase
+    band-passes; the DC bin is always left out, which centres the signals.
+    Args:
+      x: the trials shaped (N, chans, samples)
+      sfreq: the sampling rate in Hz
+      bands: K (low, high) edges in Hz, a bin at f belongs to a band when low <= f < high
+      estimator: 'lwf' or 'scm'
+      chunk: trials transformed at a time, bounds the memory of the K band signals with 'lwf'
+    Returns:
+      the covariances shaped (N, K, chans, chans)
+    """
+    n_times = x.shape[-1]
+    freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+    masks = np.stack([(freqs >= low) & (freqs < high) for low, high in bands]) & (freqs > 0)
+    # a real signal's bins between DC and Nyquist stand for a conjugate pair
+    weight = np.where(freqs == sfreq / 2, 1., 2.) / n_times ** 2
+    covs = []
+    for i in range(0, len(x), chunk):
+        spectrum = np.fft.rfft(np.asarray(x[i:i + chunk], dtype=np.float64), axis=-1)
+        if estimator == 'scm':
+            band_covs = []
+            for mask in masks:
+                band = spectrum[..., mask] * np.sqrt(weight[mask])
+                band_covs.append((band @ np.swapaxes(band, -1, -2).conj()).real)
+            covs.append(np.stack(band_covs, 1))
+        elif estimator == 'lwf':
+            signals = np.fft.irfft(spectrum[:, None] * masks[None, :, None], n=n_times, axis=-1)
+            covs.append(ledoit_wolf(signals))
+        else:
+            raise ValueError('Unknown covariance estimator {}.'.format(estimator))
+    return np.concatenate(covs)
+
+
+def save_packed(directory, name, covs, labels):
+    """Write the covariances of one subject as float32 upper triangles with their labels, and list them in the
+    manifest of the directory.
+    Args:
+      directory: the dataset folder, e.g. ./dataloader/BNCI2015004_SPD/
+      name: the subject file name the loaders ask for, e.g. BNCI2015004_1_SPD
+      covs: the covariances shaped (N, n, n), or (N, K, n, n) for K bands
+      labels: the N labels
+    """
+    np.save(osp.join(directory, name + '_covs.npy'), pack_upper(np.asarray(covs)))
+    np.save(osp.join(directory, name + '_labels.npy'), np.asarray(labels).astype(str))
+    manifest = read_manifest(directory)
+    manifest['subjects'][name] = {'covs': name + '_covs.npy', 'labels': name + '_labels.npy',
+                                  'trials': len(covs), 'chans': int(np.shape(covs)[-1]),
+                                  'bands': int(np.shape(covs)[1]) if np.ndim(covs) == 4 else 1}
+    write_manifest(directory, manifest)
+
+
+def read_manifest(directory):
+    """The manifest of a dataset folder, an empty one if it has none."""
+    path = osp.join(directory, MANIFEST)
+    if not osp.exists(path):
+        return {'format': 'spd_upper_triangle', 'dtype': 'float32', 'subjects': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    with open(osp.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def load_subject(directory, name):
+    """The covariances and labels of one subject: float32 upper triangles shaped (N, K, n * (n + 1) / 2) if the
+    manifest of the directory lists the subject, otherwise the full (N, K, n, n) matrices of its pickle; K = 1
+    unless the subject was generated with a filter bank."""
+    entry = read_manifest(directory)['subjects'].get(name)
+    if entry is not None:
+        covs = np.load(osp.join(directory, entry['covs']))
+        return with_bands(covs, True), np.load(osp.join(directory, entry['labels']))
+    covs, labels = load_pickle(directory, name)
+    return with_bands(np.asarray(covs), False), labels
+
+
+def load_pickle(directory, name):
+    """The full covariances and labels of one subject from the pickle of the data generators."""
+    with open(osp.join(directory, name), 'rb') as f:
+        data = pickle.load(f)
+    return data['org']['covs'], data['org']['labels']
+
+
+def eig_map(x, fn):
+    """U diag(fn(S)) U^T for a batch of symmetric matrices X = U diag(S) U^T, from one batched eigh."""
+    s, u = np.linalg.eigh(x)
+    return (u * fn(s)[..., None, :]) @ np.swapaxes(u, -1, -2)
+
+
+def log_euclidean_mean(covs):
+    """expm of the mean over the trials of the matrix logarithms of covariances shaped (N, ..., n, n), one mean per
+    band."""
+    return eig_map(eig_map(covs, np.log).mean(0), np.exp)
+
+
+def tangent_space(covs, reference):
+    """The tangent vectors of covariances shaped (N, ..., n, n) at an SPD reference point (one per band), log(R^-1/2 C
+    R^-1/2), as packed float32 upper triangles shaped (N, ..., n * (n + 1) / 2) like the packed covariances."""
+    whiten = eig_map(reference, lambda s: 1 / np.sqrt(s))
+    return pack_upper(eig_map(whiten @ covs @ whiten, np.log))
+
+
+def riemannian_mean(covs, tol=1e-8, max_iter=100):
+    """The Karcher mean over the trials of covariances shaped (N, ..., n, n) under the affine-invariant metric, by the
+    fixed point M <- M^1/2 expm(nu * mean log(M^-1/2 C M^-1/2)) M^1/2 from the log-Euclidean mean. Every iteration
+    is one batched eigh over all the matrices. The step size nu shrinks slowly while the steps get shorter and is halved when one
+    gets longer: with a unit step the iteration diverges on widely spread, ill-conditioned covariances. It stops
+    when the Frobenius norm of the mean log falls below tol.
+    Returns:
+      the mean, and the number of iterations used
+    """
+    mean = log_euclidean_mean(covs)
+    nu, shortest = 1., np.inf
+    for i in range(1, max_iter + 1):
+        sqrt = eig_map(mean, np.sqrt)
+        whiten = eig_map(mean, lambda s: 1 / np.sqrt(s))
+        step = eig_map(whiten @ covs @ whiten, np.log).mean(0)
+        mean = sqrt @ eig_map(nu * step, np.exp) @ sqrt
+        norm = np.linalg.norm(step)
+        if norm < tol:
+            break
+        if nu * norm < shortest:
+            nu, shortest = 0.95 * nu, nu * norm
+        else:
+            nu = 0.5 * nu
+    return mean, i
+
+
+def recenter(covs, reference):
+    """R^-1/2 C R^-1/2 for covariances shaped (N, ..., n, n): with R the subject's mean, the subject's matrices are
+    centred at the identity. Returns packed float32 upper triangles like the packed covariances."""
+    whiten = eig_map(reference, lambda s: 1 / np.sqrt(s))
+    return pack_upper(whiten @ covs @ whiten)
+
+
+SUBJECT_MEANS = {'logeuclid': log_euclidean_mean, 'riemann': lambda covs: riemannian_mean(covs)[0]}
+
+
+def load_cached(directory, name, stage, compute):
+    """A per-subject preprocessing stage, computed once and cached next to the covariances as <name>_<stage>.npy.
+    The manifest records the digest of the covariances the result came from, so it is recomputed only when the
+    subject's data changes.
+    Args:
+      stage: the cache name of the stage, also its manifest section
+      compute: maps the subject's full float64 covariances (N, K, n, n) to the float32 result
+    Returns:
+      the result, and the N labels
+    """
+    covs, labels = load_subject(directory, name)
+    digest = hashlib.sha1(np.ascontiguousarray(covs).tobytes()).hexdigest()
+    manifest = read_manifest(directory)
+    entry = manifest.setdefault(stage, {}).get(name)
+    path = osp.join(directory, '{}_{}.npy'.format(name, stage))
+    if entry is not None and entry['source'] == digest and osp.exists(path):
+        return with_bands(np.load(path), True), labels
+    covs = np.asarray(covs, dtype=np.float64)
+    if covs.ndim == 3:
+        covs = unpack_upper(covs, matrix_size(covs))
+    result = compute(covs)
+    np.save(path, result)
+    manifest[stage][name] = {'file': osp.basename(path), 'source': digest}
+    write_manifest(directory, manifest)
+    return result, labels
+
+
+def load_tangent(directory, name):
+    """The tangent vectors of one subject at its log-Euclidean mean, cached (load_cached), and its labels.
+    Returns:
+      packed float32 upper triangles shaped (N, K, n * (n + 1) / 2), and the N labels
+    """
+    return load_cached(directory, name, 'tangent', lambda covs: tangent_space(covs, log_euclidean_mean(covs)))
+
+
+def load_recentered(directory, name, mean='riemann'):
+    """The covariances of one subject re-centred at its Riemannian ('riemann') or log-Euclidean ('logeuclid') mean,
+    cached (load_cached), and its labels.
+    Returns:
+      packed float32 upper triangles shaped (N, K, n * (n + 1) / 2), and the N labels
+    """
+    if mean not in SUBJECT_MEANS:
+        raise ValueError('Unknown subject mean {}.'.format(mean))
+    return load_cached(directory, name, 'recenter_' + mean, lambda covs: recenter(covs, SUBJECT_MEANS[mean](covs)))
+
+
+def load_spd(directory, name, args):
+    """The subject data a loader asks for: the tangent vectors with args.spd_tangent, the re-centred covariances
+    with args.spd_recenter, otherwise the stored covariances (load_subject). The tangent vectors are taken at the
+    log-Euclidean subject mean, which already centres them, so the two options cannot be combined."""
+    if args.spd_tangent and args.spd_recenter != 'none':
+        raise ValueError('spd_tangent and spd_recenter {} cannot be combined, the tangent vectors are taken at the '
+                         'log-Euclidean subject mean.'.format(args.spd_recenter))
+    if args.spd_tangent:
+        return load_tangent(directory, name)
+    if args.spd_recenter != 'none':
+        return load_recentered(directory, name, args.spd_recenter)
+    return load_subject(directory, name)
+
+
+def model_input(x, packed):
+    """The (N, K, ...) split of a loader as the model takes it, the K bands being its input channels: packed upper
+    triangles with args.spd_packed, otherwise full matrices, expanded lazily per batch when the split is stored
+    packed."""
+    stored_packed = x.ndim == 3
+    if packed:
+        return x if stored_packed else pack_upper(x)
+    return PackedSPD(x) if stored_packed else x
+
+
+class PackedSPD(object):
+    """Full matrices on demand from packed upper triangles shaped (N, K, n * (n + 1) / 2). Indexing expands only
+    the selected samples, so a split stays packed in memory and each batch is expanded when it is drawn."""
+    def __init__(self, packed):
+        self.packed = packed
+        self.n = matrix_size(packed)
+        self.shape = packed.shape[:-1] + (self.n, self.n)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, index):
+        return unpack_upper(self.packed[index], self.n)
+
+    def __array__(self, dtype=None, copy=None):
+        x = unpack_upper(self.packed, self.n)
+        return x if dtype is None else x.astype(dtype)
+
+
+if __name__ == '__main__':
+    # convert the pickled subjects of a dataset folder: python -m dataloader.spd_preprocess ./dataloader/BNCI2015004_SPD
+    # with --tangent, --recenter_riemann or --recenter_logeuclid, also fill that cache for every subject
+    directory = sys.argv[1]
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('_SPD') and osp.isfile(osp.join(directory, name)):
+            covs, labels = load_pickle(directory, name)
+            save_packed(directory, name, covs, labels)
+            print(name, np.shape(covs), '->', osp.getsize(osp.join(directory, name + '_covs.npy')), 'bytes')
+            if '--tangent' in sys.argv[2:]:
+                load_tangent(directory, name)
+            for mean in SUBJECT_MEANS:
+                if '--recenter_' + mean in sys.argv[2:]:
+                    load_recentered(directory, name, mean)
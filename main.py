@@ -10,14 +10,14 @@ from utils.misc import pprint
 from utils.gpu_tools import set_gpu
 from trainer.meta_update import MetaTrainer  #
 from trainer.pre import PreTrainer
-from trainer.TraditionalTest import TestModel
+from trainer.TraditionalTest import TestModel, RiemannTest
 import time
 
 if __name__ == '__main__':
     start = time.time()  # calculate time
     parser = argparse.ArgumentParser()
     # Basic parameters
-    parser.add_argument('--model_type', type=str, default='EEGNet', choices=['EEGNet'])  # The network architecture
+    parser.add_argument('--model_type', type=str, default='EEGNet', choices=['EEGNet', 'Deep4', 'SPD_CNNnet', 'SPDNet', 'Tangent'])  # The network architecture
     parser.add_argument('--dataset', type=str, default='BNCI2015004')  # Dataset
     parser.add_argument('--P300', type=int, default=0)  # if P300=1 ,else==0 MI etc==0
     parser.add_argument('--MTL', type=int, default=1)  # if MTL=1 ,(MAML) MTL=0
@@ -43,6 +43,11 @@ if __name__ == '__main__':
     parser.add_argument('--max_epoch', type=int, default=12)    # The number for different tasks used for meta-train
     parser.add_argument('--num_batch', type=int, default=20)    # meta-batch size : like 4 task into 1 meta-batch ,20task into 5 meta task
     parser.add_argument('--meta_batch_size', type=int, default=4)
+    parser.add_argument('--meta_accumulate', type=int, default=0)    # 1: back-propagate each task as it comes, step at meta-batch boundaries
+    parser.add_argument('--encode_batched', type=int, default=0)    # 1: one encoder call for the shot and query samples of a whole meta-batch
+    parser.add_argument('--bn_segments', type=int, default=1)    # with encode_batched, 1: BatchNorm statistics per shot/query chunk as in separate calls, 0: joint statistics
+    parser.add_argument('--task_workers', type=int, default=1)    # >1: adapt the tasks of a meta-batch concurrently on this many threads (CPU)
+    parser.add_argument('--intra_op_threads', type=int, default=1)    # intra-op threads of each task worker
     parser.add_argument('--shot', type=int, default=5)    # Shot number, how many samples for one class in a task-ol
     parser.add_argument('--way', type=int, default=3)    # Way number, how many classes in a task
     parser.add_argument('--train_query', type=int, default=10)    # The number of training samples for each class in a task
@@ -52,6 +57,37 @@ if __name__ == '__main__':
     parser.add_argument('--meta_lr2', type=float, default=0.005)    # Learning rate for the inner loop
     parser.add_argument('--base_lr', type=float,default=0.005)  #
     parser.add_argument('--update_step', type=int, default=100)   #The number of updates for the inner loop
+    parser.add_argument('--inner_detach', type=int, default=0)   # 1: adapt the head on shot embeddings detached from the encoder graph
+    parser.add_argument('--inner_optim', type=str, default='adam', choices=['adam', 'flat_adam'])   # flat_adam: head weights and Adam state in one preallocated buffer
+    # Autocast precision of the encoders in every phase; the heads and inner loops stay in float32, fp16 uses loss scaling on CUDA
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    # Inference graphs for meta-eval and the tests: TorchScript trace/script (frozen, optimized for inference) or torch.compile; falls back to eager
+    # script only compiles EEGNet and Deep4: SPD_CNNnet (the Conv2dMtl check of packed_conv1) and SPDNet (lambdas) run eagerly
+    parser.add_argument('--compile', type=str, default='none', choices=['none', 'trace', 'script', 'compile'])
+    parser.add_argument('--quantize', type=int, default=0)   # 1: also report the int8 pre-train model against float32 on every test subject (SPD_CNNnet, EEGNet)
+    parser.add_argument('--calib_samples', type=int, default=256)   # training-split trials used to calibrate the int8 model
+    parser.add_argument('--spd_packed', type=int, default=0)   # 1: SPD datasets keep only the upper triangles and SPD_CNNnet's conv1 computes only the upper half of its map; this needs a symmetric conv1 kernel, it is symmetrized at init and on loading a checkpoint (with a warning if it was not)
+    parser.add_argument('--spd_tangent', type=int, default=0)   # 1: SPD datasets give the tangent vectors of each subject at its log-Euclidean mean, computed once and cached next to the data; not with --spd_recenter
+    parser.add_argument('--spd_standardize', type=int, default=1)   # 1: SPD loaders standardize every matrix by the mean and std of its entries, 0: keep the covariances SPD
+    parser.add_argument('--spd_recenter', type=str, default='none', choices=['none', 'riemann', 'logeuclid'])   # whiten each subject's covariances by its Riemannian or log-Euclidean mean, computed once and cached next to the data
+    parser.add_argument('--baselines', type=int, default=1)   # 1: on SPD datasets also report the MDM and tangent-space logistic regression baselines for every test subject
+    parser.add_argument('--eval_batched', type=int, default=0)   # 1: meta-eval/meta-test encode every trial once and adapt all episode heads together
+    parser.add_argument('--head', type=str, default='linear', choices=['linear', 'proto'])   # proto: classify by distance to the shot class means, no inner loop
+    # Meta-SGD: plain SGD inner steps with meta-learned step sizes, per weight entry or per base learner layer
+    parser.add_argument('--inner_lr_mode', type=str, default='none', choices=['none', 'per_param', 'per_layer'])
+    parser.add_argument('--inner_lr_init', type=float, default=0.01)   # initial value of the learned step sizes
+    parser.add_argument('--head_init', type=str, default='random', choices=['random', 'meta'])   # meta: every task starts from a copy of the meta-learned base learner
+    # What the outer backward differentiates: 'inplace' keeps the Adam inner loop on leaf tensors (gradient only
+    # through the query logits), the others run functional head updates
+    parser.add_argument('--meta_grad', type=str, default='inplace',
+                        choices=['inplace', 'first_order', 'second_order', 'truncated', 'implicit'])
+    parser.add_argument('--truncate_steps', type=int, default=5)   # differentiated inner steps for meta_grad=truncated
+    parser.add_argument('--implicit_lam', type=float, default=1.0)   # proximal weight for meta_grad=implicit
+    parser.add_argument('--cg_steps', type=int, default=5)   # conjugate gradient steps for meta_grad=implicit
+    # Early exit of the inner loop, update_step stays the cap. 0 disables a criterion
+    parser.add_argument('--inner_tol', type=float, default=0.)   # stop when the shot loss improves by less than this for inner_patience steps
+    parser.add_argument('--inner_patience', type=int, default=5)
+    parser.add_argument('--inner_grad_tol', type=float, default=0.)   # stop when the head gradient norm drops below this
 
     parser.add_argument('--step_size', type=int, default=3)    # The number of epochs to reduce the meta learning rates
     parser.add_argument('--gamma', type=float, default=0.8)    # Gamma for the meta-train learning rate decay
@@ -84,6 +120,9 @@ if __name__ == '__main__':
     #####################3
     # Weight decay for the optimizer during pre-train
     parser.add_argument('--pre_custom_weight_decay', type=float, default=0.0005)  #
+    # Chunked inference over a whole split (val_orig): samples per forward, or an activation budget in MB that sets it
+    parser.add_argument('--val_chunk', type=int, default=256)
+    parser.add_argument('--val_memory_mb', type=float, default=0)
     # Additional label for pre-train
     parser.add_argument('--pre_train_label', type=str, default='2021111601')  # label for date
 
@@ -97,6 +136,8 @@ if __name__ == '__main__':
     # args.model_type="EEGNet"
     # args.model_type="Deep4"
     args.model_type = "SPD_CNNnet"
+    # args.model_type = "SPDNet"  # BiMap/ReEig/LogEig encoder on the SPD datasets
+    # args.model_type = "Tangent"  # linear head on the tangent vectors, with args.spd_tangent = 1
     args.TrainSubjects = [1,2,5,8,10,12,13,14]  ##选定测试subject与训练subjects 当选定为同一个时候触发intersubject学习,这个需要根据数据集合来选择
     args.ValSubject = [4,9,11]
     args.TestSubject = [7,8]  # 开始debug
@@ -194,7 +235,18 @@ if __name__ == '__main__':
         for i in TestSubject:
             args.TestSubject = [i]
             originaltest.meta_test()
+
+        if args.quantize:
+            for i in TestSubject:
+                args.TestSubject = [i]
+                originaltest.quantized_test()
         del originaltest
+        if args.baselines and args.dataset.endswith('_SPD'):
+            baselines = RiemannTest(args)
+            for i in TestSubject:
+                args.TestSubject = [i]
+                baselines.test()
+            del baselines
         torch.cuda.empty_cache()
 
     print('-----------------meta-val-----------------------')
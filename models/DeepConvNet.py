@@ -73,10 +73,17 @@ class DeepConvNet(nn.Module):
 
 
 
+    @staticmethod
+    def output_shape(in_chans, time_step):
+        """Per-sample output shape for (1, time_step, in_chans) inputs: every block is a valid length-10 conv
+        and a length-3, stride-3 pool along time, the spatial conv collapses the channels."""
+        length = time_step
+        for _ in range(4):
+            length = (length - 9 - 3) // 3 + 1
+        return (200, length, 1)
+
     def forward(self, x):
-        x = x.permute(0, 3, 2, 1)#swap dimensions
-        #
-        x=x.permute(0, 3, 2, 1)# transpose time to spat
+        # the input is already (batch, 1, time, channels), the time conv runs along dim 2
         x = self.conv1_1(x)
         x = self.conv1_2(x)
         x = self.batchnorm1(x)#
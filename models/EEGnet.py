@@ -40,22 +40,30 @@ class EEGnet(nn.Module):
         self.batchnorm3 = nn.BatchNorm2d(4, False)
         self.pooling3 = nn.MaxPool2d((2, 4))
 
+    @staticmethod
+    def output_shape(in_chans, time_step):
+        """Per-sample output shape for (1, time_step, in_chans) inputs. After the permute the time axis goes through
+        the padded (2, 32) conv, the (2, 4)-strided pool, the padded (8, 4) conv and the (2, 4) pool; the 16 filters
+        of conv1 end up as 2 rows."""
+        w = (time_step // 4 + 1 - 4) // 4 + 1
+        return (4 * 2 * w,)
+
     def forward(self, x):
         x = F.elu(self.conv1(x))
         x = self.batchnorm1(x)
-        x = F.dropout(x, 0.25)
+        x = F.dropout(x, 0.25, training=self.training)
         x = x.permute(0, 3, 1, 2)
         # Layer 2
         x = self.padding1(x)
         x = F.elu(self.conv2(x))
         x = self.batchnorm2(x)
-        x = F.dropout(x, 0.25)
+        x = F.dropout(x, 0.25, training=self.training)
         x = self.pooling2(x)
         # Layer 3
         x = self.padding2(x)
         x = F.elu(self.conv3(x))
         x = self.batchnorm3(x)
-        x = F.dropout(x, 0.25)
+        x = F.dropout(x, 0.25, training=self.training)
         x = self.pooling3(x)
 
         x = x.contiguous().view(x.size(0), -1)
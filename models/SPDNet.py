@@ -0,0 +1,192 @@
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+## After: Huang and Van Gool, A Riemannian Network for SPD Matrix Learning, AAAI 2017
+##
+## This source code is licensed under the MIT-style license found in the
+## LICENSE file in the root directory of this source tree
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+""" Feature Extractor: SPDNet layers on batches of SPD matrices """
+import math
+import torch
+import torch.nn as nn
+from torch.autograd.function import once_differentiable
+from torch.nn.parameter import Parameter
+
+
+def _spectral_map(s, u, fs):
+    """U diag(f(S)) U^T for a batch of eigendecompositions."""
+    return (u * fs.unsqueeze(-2)) @ u.transpose(-1, -2)
+
+
+def _loewner(s, fs, dfs, tol=1e-5):
+    """The Loewner matrix of f at the eigenvalues s: (f(s_i) - f(s_j)) / (s_i - s_j), and the mean of the
+    derivatives where s_i and s_j are within tol (relative to the largest eigenvalue) of each other, so the
+    backward stays finite at repeated eigenvalues where the plain eigh backward divides by zero."""
+    diff = s.unsqueeze(-1) - s.unsqueeze(-2)
+    close = diff.abs() <= tol * s.abs().amax(-1, keepdim=True).unsqueeze(-1).clamp(min=1)
+    quotient = (fs.unsqueeze(-1) - fs.unsqueeze(-2)) / torch.where(close, torch.ones_like(diff), diff)
+    return torch.where(close, (dfs.unsqueeze(-1) + dfs.unsqueeze(-2)) / 2, quotient)
+
+
+class _EigFunction(torch.autograd.Function):
+    """f applied to the eigenvalues of a batch of symmetric matrices, X = U diag(S) U^T -> U diag(f(S)) U^T, with
+    the Daleckii-Krein backward dX = U (L o U^T sym(dY) U) U^T, L the Loewner matrix of f."""
+    @staticmethod
+    def forward(ctx, x, fn, dfn):
+        s, u = torch.linalg.eigh(x)
+        fs = fn(s)
+        ctx.save_for_backward(s, u, fs)
+        ctx.dfn = dfn
+        return _spectral_map(s, u, fs)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad):
+        s, u, fs = ctx.saved_tensors
+        grad = (grad + grad.transpose(-1, -2)) / 2
+        inner = _loewner(s, fs, ctx.dfn(s)) * (u.transpose(-1, -2) @ grad @ u)
+        return u @ inner @ u.transpose(-1, -2), None, None
+
+
+def _eig_apply(x, fn, dfn):
+    # eigh has no half-precision kernels, the spectral layers always run in float32
+    with torch.autocast(x.device.type, enabled=False):
+        x = x.float()
+        if torch.is_grad_enabled() and x.requires_grad:
+            return _EigFunction.apply(x, fn, dfn)
+        s, u = torch.linalg.eigh(x)
+        return _spectral_map(s, u, fn(s))
+
+
+class BiMap(nn.Module):
+    """X -> W^T X W with W (in_size, out_size) semi-orthogonal at initialization, mapping SPD matrices to smaller
+    SPD matrices."""
+    def __init__(self, in_size, out_size):
+        super(BiMap, self).__init__()
+        if out_size > in_size:
+            raise ValueError('BiMap cannot map {0}x{0} matrices to larger {1}x{1} ones.'.format(in_size, out_size))
+        self.in_size = in_size
+        self.out_size = out_size
+        self.weight = Parameter(torch.empty(in_size, out_size))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.orthogonal_(self.weight)
+
+    def effective_weights(self):
+        return self.weight
+
+    def forward(self, x):
+        weight = self.effective_weights()
+        return weight.t() @ x @ weight
+
+    def extra_repr(self):
+        return '{in_size}, {out_size}'.format(**self.__dict__)
+
+
+class BiMapMtl(BiMap):
+    """BiMap with a frozen weight and a meta-learned SS scale per output dimension: W diag(s) keeps the output
+    SPD for any non-zero s and, like the conv SS weights, starts from ones."""
+    def __init__(self, in_size, out_size):
+        super(BiMapMtl, self).__init__(in_size, out_size)
+        self.weight.requires_grad = False
+        self.mtl_weight = Parameter(torch.ones(1, out_size))
+
+    def effective_weights(self):
+        return self.weight * self.mtl_weight
+
+
+class ReEig(nn.Module):
+    """Eigenvalue rectification max(S, eps): the non-linearity of SPDNet, also lifting matrices that lost positive
+    definiteness (e.g. through the loaders' standardization) back onto the SPD cone."""
+    def __init__(self, eps=1e-4):
+        super(ReEig, self).__init__()
+        self.eps = eps
+
+    def forward(self, x):
+        eps = self.eps
+        return _eig_apply(x, lambda s: s.clamp(min=eps), lambda s: (s > eps).to(s.dtype))
+
+
+class LogEig(nn.Module):
+    """Matrix logarithm to the tangent space at the identity, of the eigenvalues rectified to at least eps, returned
+    as the upper triangle with the off-diagonal entries scaled by sqrt(2), so the Euclidean norm of the vector is the
+    Frobenius norm of the log."""
+    def __init__(self, size, eps=1e-4):
+        super(LogEig, self).__init__()
+        self.eps = eps
+        rows, cols = torch.triu_indices(size, size)
+        self.register_buffer('rows', rows, persistent=False)
+        self.register_buffer('cols', cols, persistent=False)
+        self.register_buffer('scale', torch.where(rows == cols, 1., math.sqrt(2.)), persistent=False)
+
+    def forward(self, x):
+        eps = self.eps
+        x = _eig_apply(x, lambda s: s.clamp(min=eps).log(), lambda s: (s > eps).to(s.dtype) / s)
+        return x[..., self.rows, self.cols] * self.scale
+
+
+class SPDNet(nn.Module):
+    """BiMap -> ReEig blocks down to a small SPD matrix, then LogEig. The first BiMap projects the in_chans x in_chans
+    covariances to at most dims[0], so the eigendecompositions and everything after cost the same for any number
+    of channels.
+    Args:
+      in_chans: the size of the input matrices, (batch, 1, in_chans, in_chans)
+      dims: the output sizes of the BiMap layers, each clipped to the size before it
+      mtl: frozen BiMap weights with SS scales (BiMapMtl)
+    """
+    dims = (16, 12, 8)
+
+    def __init__(self, in_chans=12, mtl=True, dims=None):
+        super(SPDNet, self).__init__()
+        self.BiMap = BiMapMtl if mtl else BiMap
+        sizes = self.layer_sizes(in_chans, dims or self.dims)
+        layers = []
+        for i in range(len(sizes) - 1):
+            layers.append(self.BiMap(sizes[i], sizes[i + 1]))
+            if i < len(sizes) - 2:
+                layers.append(ReEig())
+        self.layers = nn.Sequential(*layers)
+        self.logeig = LogEig(sizes[-1])
+
+    @staticmethod
+    def layer_sizes(in_chans, dims):
+        sizes = [in_chans]
+        for d in dims:
+            sizes.append(min(d, sizes[-1]))
+        return sizes
+
+    @staticmethod
+    def output_shape(in_chans, time_step):
+        """Per-sample output shape for (1, in_chans, in_chans) inputs: the upper triangle of the last BiMap output."""
+        d = SPDNet.layer_sizes(in_chans, SPDNet.dims)[-1]
+        return (d * (d + 1) // 2,)
+
+    def forward(self, x):
+        x = x[:, 0]
+        x = (x + x.transpose(-1, -2)) / 2  # exact symmetry for eigh
+        return self.logeig(self.layers(x))
+
+
+class TangentVector(nn.Module):
+    """The tangent-space matrices of args.spd_tangent as vectors for a linear head: the upper triangle with the
+    off-diagonal entries scaled by sqrt(2), as LogEig returns them. It has no weights, the base learner or the
+    pre-train classifier is the whole model.
+    Args:
+      in_chans: the size of the input matrices, (batch, 1, in_chans, in_chans)
+      packed: the inputs are already upper triangles, (batch, 1, in_chans * (in_chans + 1) / 2)
+    """
+    def __init__(self, in_chans=12, packed=False):
+        super(TangentVector, self).__init__()
+        self.packed = packed
+        rows, cols = torch.triu_indices(in_chans, in_chans)
+        self.register_buffer('rows', rows, persistent=False)
+        self.register_buffer('cols', cols, persistent=False)
+        self.register_buffer('scale', torch.where(rows == cols, 1., math.sqrt(2.)), persistent=False)
+
+    @staticmethod
+    def output_shape(in_chans, time_step):
+        return (in_chans * (in_chans + 1) // 2,)
+
+    def forward(self, x):
+        x = x[:, 0] if self.packed else x[:, 0, self.rows, self.cols]
+        return x * self.scale
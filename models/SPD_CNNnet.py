@@ -1,5 +1,6 @@
 
 """ Feature Extractor """
+import warnings
 import torch.nn as nn
 import numpy as np
 from sklearn.metrics import roc_auc_score, precision_score, recall_score, accuracy_score
@@ -12,17 +13,23 @@ import torch.optim as optim
 from models.conv2d_mtl import Conv2dMtl
 
 
+def symmetrize(weight):
+    """The symmetric part of a (out, in, k, k) conv kernel, (W + W^T) / 2 over the spatial dimensions."""
+    return (weight + weight.transpose(2, 3)) / 2
+
+
 class SPD_CNNnet(nn.Module):
 
-    def __init__(self, in_chans=12, mtl=True):  #
+    def __init__(self, in_chans=12, mtl=True, packed=False, bands=1):  # bands: the filter-bank covariances, one input channel each
         super(SPD_CNNnet, self).__init__()
+        self.packed = packed
         if mtl:
             self.Conv2d = Conv2dMtl
         else:
             self.Conv2d = nn.Conv2d
         #
         # layer1-:
-        self.conv1 = self.Conv2d(1, 4, (2, 2), padding=0)  #
+        self.conv1 = self.Conv2d(bands, 4, (2, 2), padding=0)  #
         self.batchnorm1 = nn.BatchNorm2d(4, False)
 
         # Layer 2  #
@@ -43,9 +50,60 @@ class SPD_CNNnet(nn.Module):
         #
         self.conv5 = self.Conv2d(32, 64, (2, 2))
         self.batchnorm5 = nn.BatchNorm2d(64, False)
+        if packed:
+            self.register_packed_indices(in_chans)
+            with torch.no_grad():
+                self.conv1.weight.copy_(symmetrize(self.conv1.weight))
+
+    def register_packed_indices(self, in_chans):
+        """Index buffers of the packed input path. With a symmetric kernel, conv1 on a symmetric matrix gives a
+        symmetric map, so only its upper triangle is computed: patch_index picks the 2x2 input patch of every upper
+        output position from the packed input, unpack_index fills the full map from the upper positions."""
+        n, m = in_chans, in_chans - 1
+        self.side = m
+        def position(rows, cols, size):
+            # index of (min, max) in the row-major upper triangle of a size x size matrix
+            lo, hi = torch.min(rows, cols), torch.max(rows, cols)
+            return lo * size - lo * (lo - 1) // 2 + hi - lo
+        rows, cols = torch.triu_indices(m, m)
+        patch = [position(rows + a, cols + b, n) for a in range(2) for b in range(2)]
+        self.register_buffer('patch_index', torch.stack(patch, 1), persistent=False)
+        full_rows, full_cols = torch.meshgrid(torch.arange(m), torch.arange(m), indexing='ij')
+        self.register_buffer('unpack_index', position(full_rows, full_cols, m).reshape(-1), persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the packed path only computes conv1 with a symmetric kernel, a full-matrix checkpoint may hold any kernel
+        key = prefix + 'conv1.weight'
+        if self.packed and key in state_dict:
+            weight = state_dict[key]
+            if not torch.allclose(weight, weight.transpose(2, 3), rtol=1e-5, atol=1e-6):
+                warnings.warn('{} is not symmetric, spd_packed symmetrizes it, so the packed encoder computes a '
+                              'different function than the full-matrix one it was trained as'.format(key))
+                state_dict[key] = symmetrize(weight)
+        super(SPD_CNNnet, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def packed_conv1(self, x):
+        """conv1 with its kernel symmetrized, on (batch, bands, n * (n + 1) / 2) packed upper triangles; about half
+        the FLOPs of the full-matrix conv."""
+        if isinstance(self.conv1, Conv2dMtl):
+            weight, bias = self.conv1.effective_weights()
+        else:
+            weight, bias = self.conv1.weight, self.conv1.bias
+        weight = symmetrize(weight)
+        # (batch, bands, positions, 4) -> (batch, positions, bands * 4), in the order of the flattened kernel
+        patches = x[:, :, self.patch_index].transpose(1, 2).reshape(x.size(0), self.patch_index.size(0), -1)
+        out = torch.matmul(patches, weight.reshape(weight.size(0), -1).t()) + bias
+        return out.transpose(1, 2).index_select(2, self.unpack_index).reshape(x.size(0), weight.size(0), self.side, self.side)
+
+    @staticmethod
+    def output_shape(in_chans, time_step):
+        """Per-sample output shape for (bands, time_step, in_chans) inputs: three 2x2/3x3 valid convs, a 2x2 pool,
+        then a 3x3 and a 2x2 valid conv."""
+        h, w = (time_step - 4) // 2 - 3, (in_chans - 4) // 2 - 3
+        return (64 * h * w,)
 
     def forward(self, x):
-        x = F.elu(self.conv1(x))
+        x = F.elu(self.packed_conv1(x) if self.packed else self.conv1(x))
         x = self.batchnorm1(x)
 
         # Layer 2
@@ -65,7 +123,7 @@ class SPD_CNNnet(nn.Module):
         x = F.elu(self.conv5(x))
         x = self.batchnorm5(x)
 
-        x = x.view(x.size(0),-1)  #
+        x = x.reshape(x.size(0), -1)  # reshape: quantized activations are channels-last
         return x
 
 
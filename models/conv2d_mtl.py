@@ -90,12 +90,17 @@ class Conv2dMtl(_ConvNdMtl):
             in_channels, out_channels, kernel_size, stride, padding, dilation,
             False, _pair(0), groups, bias)
         # a=1; #for debug ,breakpoing
-    def forward(self, inp):
+    def effective_weights(self):
+        """The frozen weight scaled by the SS weight and the frozen bias shifted by the SS bias."""
         new_mtl_weight = self.mtl_weight.expand(self.weight.shape) #
         new_weight = self.weight.mul(new_mtl_weight)#
         if self.bias is not None:   #
             new_bias = self.bias + self.mtl_bias #
         else:
             new_bias = None
+        return new_weight, new_bias
+
+    def forward(self, inp):
+        new_weight, new_bias = self.effective_weights()
         return F.conv2d(inp, new_weight, new_bias, self.stride,  #
                         self.padding, self.dilation, self.groups)
@@ -0,0 +1,213 @@
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+##
+## This source code is licensed under the MIT-style license found in the
+## LICENSE file in the root directory of this source tree
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+""" Functional inner-loop updates for the meta-gradient strategies. """
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def adam_step(weights, grads, state, lr, betas=(0.9, 0.999), eps=1e-8):
+    """One Adam step written with out-of-place ops, so it can be differentiated through.
+    Args:
+      weights: list of the current fast weights
+      grads: list of the gradients for the fast weights
+      state: the state returned by the previous step, None for the first step
+      lr: the inner learning rate
+    Returns:
+      the updated fast weights and the new state
+    """
+    beta1, beta2 = betas
+    if state is None:
+        state = {'step': 0,
+                 'exp_avg': [torch.zeros_like(w) for w in weights],
+                 'exp_avg_sq': [torch.zeros_like(w) for w in weights]}
+    step = state['step'] + 1
+    exp_avg = [beta1 * m + (1 - beta1) * g for m, g in zip(state['exp_avg'], grads)]
+    exp_avg_sq = [beta2 * v + (1 - beta2) * g * g for v, g in zip(state['exp_avg_sq'], grads)]
+    bias_correction1 = 1 - beta1 ** step
+    bias_correction2 = 1 - beta2 ** step
+    # the clamp keeps the derivative of sqrt finite where the second moment is zero
+    new_weights = [w - lr * (m / bias_correction1) / ((v / bias_correction2).clamp(min=eps ** 2).sqrt() + eps)
+                   for w, m, v in zip(weights, exp_avg, exp_avg_sq)]
+    return new_weights, {'step': step, 'exp_avg': exp_avg, 'exp_avg_sq': exp_avg_sq}
+
+
+def sgd_step(weights, grads, lrs):
+    """One plain SGD step with learned step sizes (Meta-SGD), per parameter or broadcast per layer."""
+    return [w - lr * g for w, g, lr in zip(weights, grads, lrs)]
+
+
+class EarlyExit():
+    """Convergence test for the inner loop, called once per step with the shot loss and its gradients.
+    Args:
+      tol: the shot loss has to drop by more than tol below its best value to count as progress, 0 disables
+      patience: the number of steps without progress after which the loop stops
+      grad_tol: the loop stops once the gradient norm falls below grad_tol, 0 disables
+    """
+    def __init__(self, tol=0., patience=5, grad_tol=0.):
+        self.tol = tol
+        self.patience = patience
+        self.grad_tol = grad_tol
+        self.best = float('inf')
+        self.wait = 0
+
+    def enabled(self):
+        return self.tol > 0 or self.grad_tol > 0
+
+    def __call__(self, loss, grads):
+        """Whether the inner loop has converged. Every check syncs the loss/gradient norm to the host."""
+        if self.grad_tol > 0:
+            grad_norm = torch.sqrt(sum((g.detach() ** 2).sum() for g in grads)).item()
+            if grad_norm < self.grad_tol:
+                return True
+        if self.tol > 0:
+            loss = loss.item()
+            if loss < self.best - self.tol:
+                self.best = loss
+                self.wait = 0
+            else:
+                self.wait += 1
+                if self.wait >= self.patience:
+                    return True
+        return False
+
+
+class BatchedEarlyExit(EarlyExit):
+    """EarlyExit for many episodes adapted side by side, each with its own best loss and patience counter. Every
+    check is one host sync for all the episodes.
+    Args:
+      n: the number of episodes
+    """
+    def __init__(self, n, tol=0., patience=5, grad_tol=0.):
+        super().__init__(tol, patience, grad_tol)
+        self.best = torch.full((n,), float('inf'), dtype=torch.float64)
+        self.wait = torch.zeros(n, dtype=torch.long)
+
+    def __call__(self, loss, grads, mask):
+        """Which of the episodes in mask have converged, from their shot losses shaped (n,) and the gradients of
+        their weights shaped (n, ...). The state of the episodes outside mask is left as it is."""
+        loss, mask = loss.detach().double().cpu(), mask.cpu()
+        stop = torch.zeros_like(mask)
+        if self.grad_tol > 0:
+            grad_norm = torch.sqrt(sum((g.detach() ** 2).flatten(1).sum(1) for g in grads)).cpu()
+            stop = stop | (grad_norm < self.grad_tol)
+        if self.tol > 0:
+            progress = loss < self.best - self.tol
+            self.best = torch.where(mask & progress, loss, self.best)
+            self.wait = torch.where(mask, torch.where(progress, torch.zeros_like(self.wait), self.wait + 1), self.wait)
+            stop = stop | (self.wait >= self.patience)
+        return stop & mask
+
+
+class FlatAdam():
+    """Adam for the base learner with the weights and both moments in one preallocated buffer.
+    The buffer is re-initialized in place for every task, and a step is a few ops over flat tensors.
+    Args:
+      shapes: the shapes of the base learner weights
+      device: the device of the buffer
+      lr: the inner learning rate
+    """
+    def __init__(self, shapes, device, lr, betas=(0.9, 0.999), eps=1e-8):
+        self.shapes = [torch.Size(s) for s in shapes]
+        self.numels = [int(np.prod(s)) for s in self.shapes]
+        self.device = device
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        n = sum(self.numels)
+        self.buffer = torch.zeros(3 * n, device=device)
+        # the weights are a leaf sharing storage with the buffer, so gradients come back flat
+        self.flat = self.buffer[:n].detach().requires_grad_()
+        self.exp_avg = self.buffer[n:2 * n]
+        self.exp_avg_sq = self.buffer[2 * n:]
+        self.step_count = 0
+
+    def weights(self):
+        """The weights as views into the buffer, in the order of BaseLearner.vars."""
+        return [w.view(shape) for w, shape in zip(torch.split(self.flat, self.numels), self.shapes)]
+
+    def reset(self, init=None):
+        """Zero the moments and set the weights to init, or initialize them as BaseLearner does."""
+        with torch.no_grad():
+            self.buffer.zero_()
+            if init is not None:
+                self.flat.copy_(torch.cat([w.reshape(-1) for w in init]))
+            else:
+                for w in self.weights():
+                    if w.dim() > 1:
+                        torch.nn.init.kaiming_normal_(w)
+        self.step_count = 0
+
+    def step(self, grad):
+        beta1, beta2 = self.betas
+        self.step_count += 1
+        bias_correction1 = 1 - beta1 ** self.step_count
+        bias_correction2 = 1 - beta2 ** self.step_count
+        with torch.no_grad():
+            self.exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            self.exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            denom = (self.exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(self.eps)
+            self.flat.addcdiv_(self.exp_avg, denom, value=-self.lr / bias_correction1)
+
+
+def conjugate_gradient(matvec, b, n_steps, tol=1e-10):
+    """Solve A x = b for a symmetric positive definite A given as a matrix-vector product on tensor lists."""
+    x = [torch.zeros_like(t) for t in b]
+    r = [t.clone() for t in b]
+    p = [t.clone() for t in b]
+    rs = sum((t * t).sum() for t in r)
+    for _ in range(n_steps):
+        if rs < tol:
+            break
+        ap = matvec(p)
+        alpha = rs / sum((u * v).sum() for u, v in zip(p, ap))
+        x = [u + alpha * v for u, v in zip(x, p)]
+        r = [u - alpha * v for u, v in zip(r, ap)]
+        rs_new = sum((t * t).sum() for t in r)
+        p = [u + (rs_new / rs) * v for u, v in zip(r, p)]
+        rs = rs_new
+    return x
+
+
+class ImplicitMetaGrad(torch.autograd.Function):
+    """Identity on the adapted head weights whose backward applies the implicit (iMAML) meta-gradient.
+
+    The adapted weights w* minimize L_shot(w) + lam/2 ||w - w0||^2, so with H the Hessian of L_shot at w*
+    and g the gradient of the query loss w.r.t. w*, v = (H + lam I)^-1 g gives
+    dL/dw0 = lam v and dL/d(embedding_shot) = -d/d(embedding_shot) <grad_w L_shot, v>.
+    """
+
+    @staticmethod
+    def forward(ctx, head, label_shot, lam, cg_steps, embedding_shot, *weights):
+        n = len(weights) // 2
+        ctx.head = head
+        ctx.label_shot = label_shot
+        ctx.lam = lam
+        ctx.cg_steps = cg_steps
+        ctx.save_for_backward(embedding_shot, *weights[n:])
+        return tuple(w.clone() for w in weights[n:])
+
+    @staticmethod
+    def backward(ctx, *grad_outputs):
+        embedding_shot, *adapted = ctx.saved_tensors
+        lam = ctx.lam
+        with torch.enable_grad():
+            embedding = embedding_shot.detach().requires_grad_(ctx.needs_input_grad[4])
+            weights = [w.detach().requires_grad_() for w in adapted]
+            loss = F.cross_entropy(ctx.head(embedding, weights), ctx.label_shot)
+            grads = torch.autograd.grad(loss, weights, create_graph=True)
+
+            def matvec(v):
+                hv = torch.autograd.grad(grads, weights, v, retain_graph=True)
+                return [h + lam * t for h, t in zip(hv, v)]
+
+            v = conjugate_gradient(matvec, [g.detach() for g in grad_outputs], ctx.cg_steps)
+            grad_embedding = None
+            if ctx.needs_input_grad[4]:
+                grad_embedding = torch.autograd.grad(grads, embedding, [-t for t in v])[0]
+        grad_init = [lam * t for t in v]
+        return (None, None, None, None, grad_embedding) + tuple(grad_init) + (None,) * len(adapted)
@@ -14,7 +14,45 @@ from models.EEGnet import EEGnet
 from models.DeepConvNet import DeepConvNet
 from models.ConvClassifier import ConvClassifier
 from models.SPD_CNNnet import SPD_CNNnet
-from utils.util import np_to_var
+from models.SPDNet import SPDNet, TangentVector
+from utils.misc import autocast, compile_for_inference
+from dataloader.spd_preprocess import packed_size
+from models.inner_loop import adam_step, sgd_step, EarlyExit, BatchedEarlyExit, FlatAdam, ImplicitMetaGrad
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def encoder_output_shape(model_type, in_chans, time_step):
+    """Per-sample output shape of an encoder, computed from its layer arithmetic and cached."""
+    encoders = {'EEGNet': EEGnet, 'Deep4': DeepConvNet, 'SPD_CNNnet': SPD_CNNnet, 'SPDNet': SPDNet,
+                'Tangent': TangentVector}
+    if model_type not in encoders:
+        raise ValueError('Unknown model_type {}.'.format(model_type))
+    shape = encoders[model_type].output_shape(in_chans, time_step)
+    if min(shape) < 1:
+        raise ValueError('Inputs of {} x {} are too small for {}.'.format(time_step, in_chans, model_type))
+    return shape
+
+
+@contextmanager
+def segmented_batchnorm(module, sizes):
+    """Make the BatchNorm layers of module normalize each chunk of the batch (split by sizes) with its own
+    statistics and update the running statistics once per chunk, as separate forward calls would."""
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    def chunked(bn):
+        forward = type(bn).forward
+        return lambda x: torch.cat([forward(bn, chunk) for chunk in torch.split(x, sizes)])
+    for bn in bns:
+        bn.forward = chunked(bn)
+    try:
+        yield
+    finally:
+        for bn in bns:
+            del bn.forward
+
 class BaseLearner(nn.Module):
     """The class for inner loop."""
     def __init__(self, args, z_dim):
@@ -67,7 +105,7 @@ class BaseLearner(nn.Module):
 
 class MtlLearner(nn.Module):
     """The class for outer loop."""
-    def __init__(self, args, mode='meta', num_cls=4,in_chans=30,input_time_length=1793):
+    def __init__(self, args, mode='meta', num_cls=4,in_chans=30,input_time_length=1793,in_bands=1):
         super().__init__()
         self.args = args
         self.mode = mode
@@ -75,118 +113,497 @@ class MtlLearner(nn.Module):
         self.update_lr = args.base_lr
         self.update_step = args.update_step
 
+        if args.spd_packed and self.model_type not in ('SPD_CNNnet', 'Tangent'):
+            raise ValueError('spd_packed needs the SPD_CNNnet or Tangent encoder, not {}.'.format(self.model_type))
+        if in_bands > 1 and self.model_type != 'SPD_CNNnet':
+            raise ValueError('Filter-bank inputs ({} bands) need the SPD_CNNnet encoder, not {}.'.format(in_bands, self.model_type))
+        # the encoder output shape comes from the layer arithmetic, no dummy forward is needed
+        out_shape = encoder_output_shape(self.model_type, in_chans, input_time_length)
+        final_layer_length = int(np.prod(out_shape))
         if self.model_type=="EEGNet":
             if self.mode == 'meta':  #
                 self.encoder = EEGnet(in_chans = in_chans,mtl=args.MTL)#if args.MTL=false，then use the MAML without SS
-                self.encoder.eval()
-                out = self.encoder(np_to_var(np.ones((args.num_batch,1, input_time_length,in_chans),dtype=np.float32)))
-                final_layer_length = out.cpu().data.numpy().shape[1]
             else:
                 self.encoder = EEGnet(in_chans = in_chans,mtl=False)
-                self.encoder.eval()
-                out = self.encoder(np_to_var(np.ones((args.num_batch,1, input_time_length,in_chans),dtype=np.float32)))
-                final_layer_length = out.cpu().data.numpy().shape[1]
                 self.classifier = nn.Sequential(nn.Linear(final_layer_length, num_cls))
         elif self.model_type=='Deep4':
             if self.mode == 'meta': #
                 self.encoder = DeepConvNet(in_chans=in_chans,mtl=args.MTL)
-                self.encoder.eval()
-                out = self.encoder(np_to_var(np.ones((args.num_batch, 1, input_time_length, in_chans),dtype=np.float32)))
-                out= out.view(out.size(0),-1)#
-                final_layer_length=out.shape[1]
             else:
                 self.encoder = DeepConvNet(in_chans=in_chans,mtl=False)
-                self.encoder.eval()
-                out = self.encoder(np_to_var(np.ones((args.num_batch, 1, input_time_length, in_chans),dtype=np.float32)))
-                final_layer_length= out.cpu().data.numpy().shape[2]
-                self.classifier = ConvClassifier(mtl=False,n_classes=num_cls,final_conv_length=final_layer_length )
-                out= out.view(out.size(0),-1)#
-                final_layer_length=out.shape[1]
+                self.classifier = ConvClassifier(mtl=False,n_classes=num_cls,final_conv_length=out_shape[1] )
         elif self.model_type=='SPD_CNNnet':
             if self.mode == 'meta':
-                self.encoder = SPD_CNNnet(in_chans=in_chans,mtl=args.MTL)
-                self.encoder.eval()
-                out = self.encoder(np_to_var(np.ones((args.num_batch,1, input_time_length,in_chans),dtype=np.float32)))
-                final_layer_length = out.cpu().data.numpy().shape[1]
+                self.encoder = SPD_CNNnet(in_chans=in_chans,mtl=args.MTL,packed=args.spd_packed,bands=in_bands)
             else:
-                self.encoder = SPD_CNNnet(in_chans=in_chans,mtl=False)
-                self.encoder.eval()
-                out = self.encoder(np_to_var(np.ones((args.num_batch,1, input_time_length,in_chans),dtype=np.float32)))
-                final_layer_length = out.cpu().data.numpy().shape[1]#
+                self.encoder = SPD_CNNnet(in_chans=in_chans,mtl=False,packed=args.spd_packed,bands=in_bands)
                 self.classifier = nn.Sequential(nn.Linear(final_layer_length , num_cls))
-        else:
-            print("wrong input of ")#
-            assert print("wrong input of NetworkStructure")
+        elif self.model_type=='SPDNet':
+            if self.mode == 'meta':
+                self.encoder = SPDNet(in_chans=in_chans,mtl=args.MTL)
+            else:
+                self.encoder = SPDNet(in_chans=in_chans,mtl=False)
+                self.classifier = nn.Sequential(nn.Linear(final_layer_length, num_cls))
+        elif self.model_type=='Tangent':
+            # a linear model on the tangent vectors, no SS weights to meta-learn
+            self.encoder = TangentVector(in_chans=in_chans,packed=args.spd_packed)
+            if self.mode != 'meta':
+                self.classifier = nn.Sequential(nn.Linear(final_layer_length, num_cls))
         self.final_layer_length =final_layer_length
+        self.input_shape = (in_bands, packed_size(in_chans)) if args.spd_packed else (in_bands, input_time_length, in_chans)
+        self.compiled = {} # inference graphs of the encoder and classifier, set by compile_inference and kept out of the state_dict
         self.base_learner = BaseLearner(args, z_dim=self.final_layer_length)
+        # the step sizes only exist where they are meta-learned: the pre-train model keeps the Adam inner loop for
+        # its preval and test episodes
+        if mode != 'meta':
+            self.inner_lrs = None
+        elif args.inner_lr_mode == 'per_param':
+            # Meta-SGD step sizes, meta-learned with the SS weights
+            self.inner_lrs = nn.ParameterList([nn.Parameter(torch.full_like(w, args.inner_lr_init))
+                                               for w in self.base_learner.parameters()])
+        elif args.inner_lr_mode == 'per_layer':
+            self.inner_lrs = nn.ParameterList([nn.Parameter(torch.tensor(args.inner_lr_init))
+                                               for _ in range(len(self.base_learner.parameters()) // 2)])
+        else:
+            self.inner_lrs = None
+        self.flat_adam = {} # FlatAdam per thread, allocated on first use on the device of the embeddings
+        self.task_pool = None # thread pool for args.task_workers, created on first use
+        self.inner_steps = [] # the number of inner steps each task used, read and cleared by the trainers
+        self.saved_tensor_meter = None # SavedTensorMeter of the graphs built by meta forwards, set by the trainers
     def forward(self, inp):
         if self.mode=='pre' or self.mode=='origval':
             return self.pretrain_forward(inp)
         elif self.mode=='meta':
             data_shot, label_shot, data_query = inp
-            return self.meta_forward(data_shot, label_shot, data_query)
+            with self.meter_hooks():
+                if isinstance(data_shot, (list, tuple)):
+                    return self.meta_forward_batch(data_shot, label_shot, data_query)
+                return self.meta_forward(data_shot, label_shot, data_query)
         elif self.mode=='preval':
             data_shot, label_shot, data_query = inp
             return self.preval_forward(data_shot, label_shot, data_query)
         else:
             raise ValueError('Please set the correct mode.')
 
+    def meter_hooks(self):
+        """The hooks of self.saved_tensor_meter for the calling thread, the task pool threads enter them too."""
+        if self.saved_tensor_meter is None:
+            return nullcontext()
+        return self.saved_tensor_meter.hooks()
+
+    def encode(self, x):
+        """The encoder forward under the args.precision autocast. The embeddings come back in float32, so the
+        heads and the inner loop always run in float32."""
+        encoder = self.encoder if self.training else self.compiled.get('encoder', self.encoder)
+        with autocast(self.args):
+            return encoder(x).float()
+
     def pretrain_forward(self, inp):
+        classifier = self.classifier if self.training else self.compiled.get('classifier', self.classifier)
+        return classifier(self.encode(inp))
 
-        return self.classifier(self.encoder(inp))
+    def compile_inference(self, backend, batch_size=16):
+        """Compile the encoder, and the classifier of the pre-train model, into inference graphs of the current
+        weights; they replace the eager modules in eval mode until train() is called."""
+        self.eval()
+        device = next(self.parameters()).device
+        example = torch.randn((batch_size,) + self.input_shape, device=device)
+        with autocast(self.args):
+            self.compiled['encoder'], used = compile_for_inference(self.encoder, example, backend)
+            if hasattr(self, 'classifier'):
+                with torch.no_grad():
+                    embedding = self.encoder(example)
+                self.compiled['classifier'], _ = compile_for_inference(self.classifier, embedding, used)
+        return used
 
+    def train(self, mode=True):
+        if mode:
+            # the compiled graphs hold the weights they were compiled with
+            self.compiled = {}
+        return super().train(mode)
 
-    def preval_forward(self, data_shot, label_shot, data_query):
-        embedding_query = self.encoder(data_query)
-        embedding_shot = self.encoder(data_shot)
-        self.base_learner = BaseLearner(self.args, z_dim=self.final_layer_length) #re-initialize the parameter of classifier block
-        # Set base_learner to GPU
+
+    def flat_inner_loop(self, embedding_shot, label_shot):
+        """inner_loop with FlatAdam: no per-task allocation of the base learner and its optimizer."""
+        # one buffer per thread, so tasks adapted on the task pool do not share it
+        flat_adam = self.flat_adam.get(threading.get_ident())
+        if flat_adam is None or flat_adam.device != embedding_shot.device:
+            shapes = [w.shape for w in self.base_learner.parameters()]
+            flat_adam = FlatAdam(shapes, embedding_shot.device, self.args.base_lr)
+            self.flat_adam[threading.get_ident()] = flat_adam
+        if self.args.head_init == 'meta':
+            flat_adam.reset([w.detach() for w in self.base_learner.parameters()])
+        else:
+            flat_adam.reset()
+        retain_graph = embedding_shot.requires_grad
+        early_exit = self.early_exit()
+        for _ in range(self.update_step + 1):
+            loss = F.cross_entropy(self.base_learner(embedding_shot, flat_adam.weights()), label_shot)
+            grad = torch.autograd.grad(loss, flat_adam.flat, retain_graph=retain_graph)[0]
+            if early_exit.enabled() and early_exit(loss, [grad]):
+                break
+            flat_adam.step(grad)
+        self.inner_steps.append(flat_adam.step_count)
+        # the buffer is overwritten by the next task while this task's query graph may still be alive
+        return [w.detach().clone() for w in flat_adam.weights()]
+
+    def early_exit(self):
+        """A fresh convergence test for one task's inner loop, self.update_step stays the cap."""
+        return EarlyExit(self.args.inner_tol, self.args.inner_patience, self.args.inner_grad_tol)
+
+    def new_base_learner(self):
+        """The base learner a task starts from: with args.head_init='meta' a copy of the meta-learned
+        self.base_learner, otherwise a freshly initialized one. self.base_learner is not modified, tasks adapted
+        concurrently on the task pool each get their own."""
+        if self.args.head_init == 'meta':
+            return copy.deepcopy(self.base_learner)
+        base_learner = BaseLearner(self.args, z_dim=self.final_layer_length)
         if torch.cuda.is_available():
-            torch.backends.cudnn.benchmark = True
-            self.base_learner = self.base_learner.cuda()
-        #
-        params=self.base_learner.parameters()
-        optimizer=optim.Adam(params,lr=self.args.base_lr) #
-        logits = self.base_learner(embedding_shot)
-        loss = F.cross_entropy(logits, label_shot)
-        loss.backward(retain_graph=True)#
-        optimizer.step()
-        logits_q = self.base_learner(embedding_query)
-        for _ in range(self.update_step):  #
-            optimizer.zero_grad()
-            logits = self.base_learner(embedding_shot)
-            loss = F.cross_entropy(logits, label_shot)
-            loss.backward(retain_graph=True) #
-            optimizer.step()
-            logits_q = self.base_learner(embedding_query)
-        return logits_q
+            base_learner = base_learner.cuda()
+        return base_learner
 
-    def meta_forward(self, data_shot, label_shot, data_query):
-        embedding_shot=self.encoder(data_shot)
-        embedding_query = self.encoder(data_query)
-        self.base_learner = BaseLearner(self.args, z_dim=self.final_layer_length)#TODO:改正之后,这里重新定义了一一遍，防止每个epoch记住一次数据
-        # Set base_learner to GPU
+    def shutdown_task_pool(self):
+        """Stop the threads of args.task_workers; the next meta_forward_batch starts a new pool if needed."""
+        if self.task_pool is not None:
+            self.task_pool.shutdown(wait=True)
+            self.task_pool = None
+
+    def __del__(self):
+        if getattr(self, 'task_pool', None) is not None:  # __init__ may have raised before setting it
+            self.shutdown_task_pool()
+
+    def from_head_init(self, fast_weights):
+        """With args.head_init='meta', pass the query gradient of the in-place adapted weights straight to the
+        meta-learned initialization (first-order), so the meta_lr2 group of the optimizer trains it."""
+        if self.args.head_init != 'meta':
+            return fast_weights
+        return [w.detach() + w0 - w0.detach() for w, w0 in zip(fast_weights, self.base_learner.parameters())]
+
+    def inner_loop(self, embedding_shot, label_shot):
+        """Re-initialize the base learner and adapt it on the shot embeddings with Adam.
+        The loop stops early once the early_exit criterion is met.
+        Args:
+          embedding_shot: the encoder output for the shot samples
+          label_shot: the labels for the shot samples
+        Returns:
+          the adapted weights of the base learner
+        """
+        if self.inner_lrs is not None:
+            return [w.detach() for w in self.unrolled_inner_loop(embedding_shot.detach(), label_shot)]
+        if self.args.inner_optim == 'flat_adam':
+            return self.flat_inner_loop(embedding_shot, label_shot)
+        base_learner = self.new_base_learner() #re-initialize the parameter of classifier block
         if torch.cuda.is_available():
             torch.backends.cudnn.benchmark = True
-            self.base_learner = self.base_learner.cuda()
-        #
-        params=self.base_learner.parameters()
+        # without the encoder graph the inner backward only touches the base learner, nothing to retain
+        retain_graph = embedding_shot.requires_grad
+        params=base_learner.parameters()
         optimizer=optim.Adam(params,lr=self.args.base_lr) #直接用adam，这里用默认的参数
-        logits = self.base_learner(embedding_shot)
-        loss = F.cross_entropy(logits, label_shot)
-        loss.backward(retain_graph=True)#这里参数表明保留backward后的中间参数。
-        optimizer.step()
-        logits_q = self.base_learner(embedding_query)
-
-        for _ in range(self.update_step):  #直接用训练十代(self.update_step=10)，不用手动赋值过程，直接用原始的adam训练,这里就是innerLoop的过程
+        early_exit = self.early_exit()
+        steps = 0
+        for _ in range(self.update_step + 1):  #直接用原始的adam训练,这里就是innerLoop的过程
             optimizer.zero_grad()
-            logits = self.base_learner(embedding_shot)
+            logits = base_learner(embedding_shot)
             loss = F.cross_entropy(logits, label_shot)
-            loss.backward(retain_graph=True) #这里参数表明保留backward后的中间参数。
-            # loss.backward#好像没什么不同
+            loss.backward(retain_graph=retain_graph) #这里参数表明保留backward后的中间参数。
+            if early_exit.enabled() and early_exit(loss, [p.grad for p in base_learner.parameters()]):
+                break
             optimizer.step()
-            logits_q = self.base_learner(embedding_query)
+            steps += 1
+        self.inner_steps.append(steps)
+        return list(base_learner.parameters())
+
+    def proto_forward(self, embedding_shot, label_shot, embedding_query):
+        """Prototype head: the query logits are the negative distances to the class means of the shot
+        embeddings, no inner steps. The distance is the mean over the embedding, which keeps the logits on a
+        similar scale for every encoder."""
+        embedding_shot = embedding_shot.view(embedding_shot.size(0), -1)
+        embedding_query = embedding_query.view(embedding_query.size(0), -1)
+        one_hot = F.one_hot(label_shot, self.args.way).type_as(embedding_shot)
+        prototypes = one_hot.t() @ embedding_shot / one_hot.sum(0).unsqueeze(1)
+        self.inner_steps.append(0)
+        return -((embedding_query.unsqueeze(1) - prototypes.unsqueeze(0)) ** 2).mean(2)
+
+    def eval_episodes(self, data, episodes, label_shot, chunk=256):
+        """Evaluate many episodes in one pass: every trial is encoded once, then the heads of all episodes are
+        adapted together with batched weights. The update is the one of the per-episode path run side by side:
+        the Adam steps of inner_loop (or of unrolled_inner_loop for the functional heads of the meta model, with
+        the implicit proximal term or the learned step sizes) are elementwise, and an episode stopped by the early
+        exit criterion is held fixed while the others go on.
+        Args:
+          data: the trials used by the episodes
+          episodes: for every episode the indices of its shot and query trials into data, shot first
+          label_shot: the labels for the shot samples, shared by the episodes
+        Returns:
+          the query logits, shaped (episodes, queries, way)
+        """
+        with torch.no_grad():
+            embedding = torch.cat([self.encode(data[i:i + chunk]) for i in range(0, data.size(0), chunk)])
+        embedding = embedding.view(embedding.size(0), -1)
+        k = label_shot.size(0)
+        n_episodes = episodes.size(0)
+        embedding_shot = embedding[episodes[:, :k]]
+        embedding_query = embedding[episodes[:, k:]]
+        if self.args.head == 'proto':
+            one_hot = F.one_hot(label_shot, self.args.way).type_as(embedding)
+            prototypes = torch.einsum('kc,ekd->ecd', one_hot, embedding_shot) / one_hot.sum(0).unsqueeze(1)
+            self.inner_steps.extend([0] * n_episodes)
+            return -((embedding_query.unsqueeze(2) - prototypes.unsqueeze(1)) ** 2).mean(3)
+
+        def head(x, weights):
+            for i in range(0, len(weights), 2):
+                x = torch.baddbmm(weights[i + 1].unsqueeze(1), x, weights[i].transpose(1, 2))
+            return x
+
+        if self.args.head_init == 'meta':
+            weights = [w.detach().unsqueeze(0).repeat(n_episodes, *[1] * w.dim()) for w in self.base_learner.parameters()]
+        else:
+            weights = [torch.zeros((n_episodes,) + w.shape, device=embedding.device) for w in self.base_learner.parameters()]
+            for w in weights:
+                if w.dim() > 2:
+                    for episode_w in w:
+                        torch.nn.init.kaiming_normal_(episode_w)
+        # the per-episode path: unrolled_inner_loop for the functional heads of the meta model, inner_loop otherwise
+        functional = self.mode == 'meta' and self.functional_head()
+        steps = self.update_step + 1
+        if functional and self.args.meta_grad == 'second_order':
+            n_unroll = steps
+        elif functional and self.args.meta_grad == 'truncated':
+            n_unroll = min(self.args.truncate_steps, steps)
+        else:
+            n_unroll = 0
+        proximal = functional and self.args.meta_grad == 'implicit'
+        step_sizes = [lr.detach() for lr in self.step_sizes()] if functional and self.inner_lrs is not None else None
+        init = [w.clone() for w in weights]
+        exp_avg = [torch.zeros_like(w) for w in weights]
+        exp_avg_sq = [torch.zeros_like(w) for w in weights]
+        beta1, beta2, eps, lr = 0.9, 0.999, 1e-8, self.args.base_lr
+        device = embedding.device
+        # the steps taken by every episode, and its steps before the differentiated ones, cut by the early exit
+        taken = torch.zeros(n_episodes, dtype=torch.long, device=device)
+        plain = torch.full((n_episodes,), steps - n_unroll, dtype=torch.long, device=device)
+        early_exit = BatchedEarlyExit(n_episodes, self.args.inner_tol, self.args.inner_patience, self.args.inner_grad_tol)
+        label = label_shot.repeat(n_episodes)
+        for _ in range(steps):
+            with torch.enable_grad():
+                weights = [w.detach().requires_grad_() for w in weights]
+                loss = F.cross_entropy(head(embedding_shot, weights).reshape(-1, self.args.way), label,
+                                       reduction='none').view(n_episodes, -1).mean(1)
+                if proximal:
+                    loss = loss + self.args.implicit_lam / 2 * sum(((w - w0) ** 2).flatten(1).sum(1)
+                                                                   for w, w0 in zip(weights, init))
+                # the sum of the per-episode losses, so every episode gets the gradient of its own loss
+                grads = torch.autograd.grad(loss.sum(), weights)
+            with torch.no_grad():
+                if early_exit.enabled():
+                    # as in the per-episode loops, only the steps before the differentiated ones are checked
+                    stop = early_exit(loss, grads, taken < plain).to(device)
+                    plain = torch.where(stop, taken, plain)
+                active = taken < plain + n_unroll
+                if not bool(active.any()):
+                    break
+                taken = taken + active
+                count = taken.to(embedding.dtype)
+                updated = []
+                for i, (w, g) in enumerate(zip(weights, grads)):
+                    mask = active.view((-1,) + (1,) * (w.dim() - 1))
+                    if step_sizes is not None:
+                        updated.append(torch.where(mask, w - step_sizes[i] * g, w))
+                        continue
+                    exp_avg[i] = torch.where(mask, beta1 * exp_avg[i] + (1 - beta1) * g, exp_avg[i])
+                    exp_avg_sq[i] = torch.where(mask, beta2 * exp_avg_sq[i] + (1 - beta2) * g * g, exp_avg_sq[i])
+                    bias_correction1 = (1 - beta1 ** count).view(mask.shape)
+                    bias_correction2 = (1 - beta2 ** count).view(mask.shape)
+                    if functional:
+                        # adam_step
+                        denom = (exp_avg_sq[i] / bias_correction2).clamp(min=eps ** 2).sqrt() + eps
+                    else:
+                        # torch.optim.Adam and FlatAdam
+                        denom = exp_avg_sq[i].sqrt() / bias_correction2.sqrt() + eps
+                    updated.append(torch.where(mask, w - lr / bias_correction1 * exp_avg[i] / denom, w))
+                weights = updated
+        self.inner_steps.extend(taken.tolist())
+        with torch.no_grad():
+            return head(embedding_query, weights)
+
+    def preval_forward(self, data_shot, label_shot, data_query):
+        if self.args.head == 'proto':
+            with torch.no_grad():
+                return self.proto_forward(self.encode(data_shot), label_shot, self.encode(data_query))
+        if self.args.inner_detach:
+            # nothing is back-propagated to the encoder in preval, so no encoder graph is built
+            with torch.no_grad():
+                embedding_query = self.encode(data_query)
+                embedding_shot = self.encode(data_shot)
+            with torch.enable_grad():
+                fast_weights = self.inner_loop(embedding_shot, label_shot)
+            return self.base_learner(embedding_query, fast_weights)
+        embedding_query = self.encode(data_query)
+        embedding_shot = self.encode(data_shot)
+        fast_weights = self.inner_loop(embedding_shot, label_shot)
+        return self.base_learner(embedding_query, fast_weights)
 
-        return logits_q
+    def unrolled_inner_loop(self, embedding_shot, label_shot):
+        """Adapt a re-initialized base learner with functional Adam steps for the selected meta-gradient.
+        With args.inner_lr_mode the steps are plain SGD with the learned self.inner_lrs instead, and the
+        non-differentiated steps keep the path from the fast weights to the initial weights and the step sizes.
+          first_order: no step is differentiated, the query gradient is passed straight to the initial weights
+          second_order: every step is differentiated, back to the shot embeddings and the initial weights
+          truncated: only the last args.truncate_steps steps are differentiated
+          implicit: the inner problem is proximally regularized and ImplicitMetaGrad supplies the meta-gradient
+        The early_exit criterion can only end the non-differentiated steps: truncated still differentiates its
+        last args.truncate_steps steps after them, second_order always runs all steps.
+        Returns:
+          the adapted fast weights of the base learner
+        """
+        if self.args.head_init == 'meta':
+            # start from the meta-learned weights themselves, the meta-gradient reaches them through the steps
+            base_learner = self.base_learner
+        else:
+            base_learner = self.new_base_learner()
+        meta_grad = self.args.meta_grad
+        init_weights = list(base_learner.parameters())
+        steps = self.update_step + 1
+        if meta_grad == 'second_order':
+            n_unroll = steps
+        elif meta_grad == 'truncated':
+            n_unroll = min(self.args.truncate_steps, steps)
+        else:
+            n_unroll = 0
+        fast_weights = init_weights
+        state = None
+        early_exit = self.early_exit()
+        plain_steps = steps - n_unroll
+        step = 0
+        while step < plain_steps + n_unroll:
+            create_graph = step >= plain_steps
+            shot = embedding_shot if create_graph else embedding_shot.detach()
+            loss = F.cross_entropy(base_learner(shot, fast_weights), label_shot)
+            if meta_grad == 'implicit':
+                loss = loss + self.args.implicit_lam / 2 * sum(((w - w0.detach()) ** 2).sum()
+                                                               for w, w0 in zip(fast_weights, init_weights))
+            grads = torch.autograd.grad(loss, fast_weights, create_graph=create_graph)
+            if not create_graph and early_exit.enabled() and early_exit(loss, grads):
+                # go on with the differentiated steps, if any
+                plain_steps = step
+                continue
+            if self.inner_lrs is not None:
+                fast_weights = sgd_step(fast_weights, grads, self.step_sizes())
+                step += 1
+                continue
+            fast_weights, state = adam_step(fast_weights, grads, state, self.args.base_lr)
+            if not create_graph:
+                fast_weights = [w.detach().requires_grad_() for w in fast_weights]
+                state = {k: v if k == 'step' else [t.detach() for t in v] for k, v in state.items()}
+            step += 1
+        self.inner_steps.append(step)
+        if meta_grad == 'implicit':
+            return list(ImplicitMetaGrad.apply(base_learner, label_shot, self.args.implicit_lam,
+                                               self.args.cg_steps, embedding_shot, *init_weights, *fast_weights))
+        if plain_steps > 0 and self.inner_lrs is None:
+            # first-order path from the adapted weights back to the initial weights
+            fast_weights = [w + w0 - w0.detach() for w, w0 in zip(fast_weights, init_weights)]
+        return fast_weights
+
+    def step_sizes(self):
+        """The learned inner step size of every base learner weight."""
+        if self.args.inner_lr_mode == 'per_layer':
+            return [self.inner_lrs[i // 2] for i in range(len(self.base_learner.parameters()))]
+        return list(self.inner_lrs)
+
+    def functional_head(self):
+        """Whether the head is adapted by unrolled_inner_loop rather than the in-place Adam loop."""
+        return self.args.meta_grad != 'inplace' or self.inner_lrs is not None
+
+    def detach_shot(self):
+        """Whether the meta-gradient never reaches the shot embeddings, so they need no encoder graph."""
+        if self.args.head == 'proto':
+            # the prototypes are differentiated like the query embeddings
+            return False
+        if self.args.meta_grad == 'inplace':
+            # with learned step sizes the in-place mode runs the functional loop without differentiated steps
+            return bool(self.args.inner_detach) or self.inner_lrs is not None
+        return self.args.meta_grad == 'first_order'
+
+    def meta_head_forward(self, embedding_shot, label_shot, embedding_query):
+        """Adapt the base learner on the shot embeddings and return the query logits."""
+        if self.args.head == 'proto':
+            return self.proto_forward(embedding_shot, label_shot, embedding_query)
+        if self.functional_head():
+            fast_weights = self.unrolled_inner_loop(embedding_shot, label_shot)
+            return self.base_learner(embedding_query, fast_weights)
+        if self.args.inner_detach:
+            # The Adam steps update the head in place, so the meta-gradient never reaches the shot
+            # embeddings: it is dL_query/d(encoder) through embedding_query, with the adapted head
+            # held fixed. Adapting on detached shot embeddings keeps the inner backward passes out
+            # of the encoder.
+            fast_weights = self.inner_loop(embedding_shot.detach(), label_shot)
+            fast_weights = [w.detach() for w in fast_weights]
+            return self.base_learner(embedding_query, self.from_head_init(fast_weights))
+        fast_weights = self.inner_loop(embedding_shot, label_shot)#TODO:改正之后,这里重新定义了一一遍，防止每个epoch记住一次数据
+        return self.base_learner(embedding_query, self.from_head_init(fast_weights))
+
+    def encode_shot(self, data_shot):
+        if self.detach_shot():
+            # no encoder graph is kept for the shot samples
+            with torch.no_grad():
+                return self.encode(data_shot)
+        return self.encode(data_shot)
+
+    def meta_forward(self, data_shot, label_shot, data_query):
+        embedding_shot = self.encode_shot(data_shot)
+        embedding_query = self.encode(data_query)
+        return self.meta_head_forward(embedding_shot, label_shot, embedding_query)
+
+    def encode_batch(self, data):
+        """The embeddings of a list of sample chunks from one encoder call, split back into the chunks."""
+        sizes = [d.size(0) for d in data]
+        data = torch.cat(data)
+        if self.training and self.args.bn_segments:
+            # BatchNorm normalizes every chunk with its own statistics, as the per-task calls did
+            with segmented_batchnorm(self.encoder, sizes):
+                embedding = self.encode(data)
+        else:
+            # BatchNorm normalizes with the statistics of the whole meta-batch
+            embedding = self.encode(data)
+        return torch.split(embedding, sizes)
+
+    def meta_forward_batch(self, data_shot, label_shot, data_query):
+        """meta_forward for a whole meta-batch. With args.encode_batched the shot and query samples of every task
+        go through one encoder call, with args.task_workers > 1 the heads are adapted concurrently on a thread pool.
+        Args:
+          data_shot: list with the shot samples of each task
+          label_shot: the labels for the shot samples, shared by the tasks
+          data_query: list with the query samples of each task
+        Returns:
+          list with the query logits of each task
+        """
+        if self.args.encode_batched and self.detach_shot():
+            # the shot samples need no encoder graph, as in encode_shot: one call without grad for the shots of all
+            # tasks, one for the queries
+            with torch.no_grad():
+                embedding_shot = self.encode_batch(data_shot)
+            embedding_query = self.encode_batch(data_query)
+        elif self.args.encode_batched:
+            embedding = self.encode_batch([d for pair in zip(data_shot, data_query) for d in pair])
+            embedding_shot, embedding_query = embedding[0::2], embedding[1::2]
+        else:
+            embedding_shot, embedding_query = [], []
+            for shot, query in zip(data_shot, data_query):
+                embedding_shot.append(self.encode_shot(shot))
+                embedding_query.append(self.encode(query))
+        if self.args.task_workers > 1:
+            if self.task_pool is None:
+                # each worker runs its small head ops on a few intra-op threads instead of all cores
+                self.task_pool = ThreadPoolExecutor(max_workers=self.args.task_workers, initializer=torch.set_num_threads,
+                                                    initargs=(self.args.intra_op_threads,))
+            # grad mode is thread local, the workers take the caller's
+            grad_enabled = torch.is_grad_enabled()
 
+            def adapt(shot, query):
+                with torch.set_grad_enabled(grad_enabled), self.meter_hooks():
+                    return self.meta_head_forward(shot, label_shot, query)
 
+            tasks = [self.task_pool.submit(adapt, shot, query) for shot, query in zip(embedding_shot, embedding_query)]
+            return [task.result() for task in tasks]
+        return [self.meta_head_forward(shot, label_shot, query) for shot, query in zip(embedding_shot, embedding_query)]
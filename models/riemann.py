@@ -0,0 +1,77 @@
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+##
+## This source code is licensed under the MIT-style license found in the
+## LICENSE file in the root directory of this source tree
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+""" Riemannian baseline classifiers on covariance matrices: minimum distance to mean and tangent-space logistic
+regression. Both work on whole splits at once, shaped (N, K, n, n) with K filter bands, with batched
+eigendecompositions. """
+import numpy as np
+import torch
+import torch.nn.functional as F
+from dataloader.spd_preprocess import riemannian_mean, tangent_space, matrix_size, unpack_upper, eig_map
+
+
+def as_covariances(x):
+    """A loader split, (N, K, n, n) matrices or (N, K, n * (n + 1) / 2) packed upper triangles, as float64
+    (N, K, n, n)."""
+    x = np.asarray(x, dtype=np.float64)
+    return unpack_upper(x, matrix_size(x)) if x.ndim == 3 else x
+
+
+class MDM(object):
+    """Minimum distance to mean: every class is its Riemannian mean, one per band, a trial goes to the class at the
+    smallest affine-invariant distance ||log(M^-1/2 C M^-1/2)||_F, summed in squares over the bands. The distances
+    of all trials to all means come from one batched eigvalsh."""
+    def fit(self, covs, labels):
+        self.classes = np.unique(labels)
+        self.means = np.stack([riemannian_mean(covs[labels == c])[0] for c in self.classes])
+        self.whiten = eig_map(self.means, lambda s: 1 / np.sqrt(s))
+        return self
+
+    def distances(self, covs):
+        whitened = self.whiten[None] @ covs[:, None] @ self.whiten[None]
+        return np.sqrt(np.square(np.log(np.linalg.eigvalsh(whitened))).sum((-2, -1)))
+
+    def predict_proba(self, covs):
+        """The softmax of the negative squared distances, shaped (N, classes)."""
+        return F.softmax(-torch.from_numpy(self.distances(covs)) ** 2, dim=1).numpy()
+
+
+class TangentSpaceLR(object):
+    """Logistic regression on the tangent vectors at the Riemannian mean of the training trials, the off-diagonal
+    entries scaled by sqrt(2) and the bands concatenated. The multinomial model is fitted full-batch with L-BFGS and an L2 penalty of
+    1 / (2 C N) as in sklearn.
+    Args:
+      C: the inverse regularization strength
+      max_iter: the L-BFGS iterations
+    """
+    def __init__(self, C=1.0, max_iter=200):
+        self.C = C
+        self.max_iter = max_iter
+
+    def features(self, covs):
+        x = torch.from_numpy(tangent_space(covs, self.reference)).double()
+        rows, cols = np.triu_indices(covs.shape[-1])
+        return (x * torch.from_numpy(np.where(rows == cols, 1., np.sqrt(2.)))).reshape(len(x), -1)
+
+    def fit(self, covs, labels):
+        self.classes = np.unique(labels)
+        self.reference = riemannian_mean(covs)[0]
+        x = self.features(covs)
+        y = torch.from_numpy(np.searchsorted(self.classes, labels))
+        self.weight = torch.zeros(x.size(1), len(self.classes), dtype=torch.float64, requires_grad=True)
+        self.bias = torch.zeros(len(self.classes), dtype=torch.float64, requires_grad=True)
+        optimizer = torch.optim.LBFGS([self.weight, self.bias], max_iter=self.max_iter, line_search_fn='strong_wolfe')
+
+        def closure():
+            optimizer.zero_grad()
+            loss = F.cross_entropy(x @ self.weight + self.bias, y) + self.weight.pow(2).sum() / (2 * self.C * len(y))
+            loss.backward()
+            return loss
+        optimizer.step(closure)
+        return self
+
+    def predict_proba(self, covs):
+        with torch.no_grad():
+            return F.softmax(self.features(covs) @ self.weight + self.bias, dim=1).numpy()
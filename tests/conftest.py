@@ -0,0 +1,24 @@
+import argparse
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _make_args(**kwargs):
+    """The main.py arguments the models read, with small defaults for tests."""
+    args = argparse.Namespace(
+        model_type='SPDNet', MTL=1, way=3, shot=2, train_query=3, base_lr=1e-2, update_step=3, meta_batch_size=3,
+        num_cls_lay=1, num_cls_hidden=16, precision='fp32', spd_packed=0, head='linear', head_init='random',
+        inner_lr_mode='none', inner_lr_init=0.01, inner_optim='adam', inner_detach=0, meta_grad='inplace',
+        truncate_steps=2, implicit_lam=1.0, cg_steps=3, inner_tol=0., inner_patience=5, inner_grad_tol=0.,
+        encode_batched=0, bn_segments=1, task_workers=1, intra_op_threads=1, eval_batched=0)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+@pytest.fixture
+def make_args():
+    return _make_args
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import torch
+from models.mtl import MtlLearner
+from utils.export import adapt, export_onnx, OnnxPredictor
+
+pytest.importorskip('onnxruntime')
+
+SHAPES = {'EEGNet': (22, 256), 'SPD_CNNnet': (22, 22)}
+
+
+@pytest.mark.parametrize('model_type', sorted(SHAPES))
+@pytest.mark.parametrize('mode', ['pre', 'meta'])
+def test_onnx_matches_torch(make_args, tmp_path, model_type, mode):
+    torch.manual_seed(0)
+    in_chans, time_step = SHAPES[model_type]
+    args = make_args(model_type=model_type)
+    model = MtlLearner(args, mode=mode, num_cls=args.way, in_chans=in_chans, input_time_length=time_step)
+    data = torch.randn(256, 1, time_step, in_chans)
+    if mode == 'pre':
+        model.eval()
+        torch_model = torch.nn.Sequential(model.encoder, model.classifier)
+    else:
+        label_shot = torch.arange(args.way).repeat(args.shot)
+        model = torch_model = adapt(model, torch.randn(label_shot.size(0), 1, time_step, in_chans), label_shot)
+    path = str(tmp_path / 'model.onnx')
+    export_onnx(model, path, data[:2])
+    predictor = OnnxPredictor(path, max_batch=64, threads=1)
+    for batch_size in [1, 16, 256]:
+        with torch.no_grad():
+            expected = torch_model(data[:batch_size]).numpy()
+        np.testing.assert_allclose(predictor(data[:batch_size]), expected, rtol=1e-4, atol=1e-5)
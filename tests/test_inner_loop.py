@@ -0,0 +1,127 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from models.inner_loop import conjugate_gradient, EarlyExit, BatchedEarlyExit
+from models.mtl import MtlLearner
+
+
+def test_conjugate_gradient_solves_spd_system():
+    generator = torch.Generator().manual_seed(0)
+    m = torch.randn(7, 7, generator=generator, dtype=torch.float64)
+    a = m @ m.t() + torch.eye(7, dtype=torch.float64)
+    b = torch.randn(7, generator=generator, dtype=torch.float64)
+    # the unknowns as a list of two tensors, like the weights of a head
+    x = conjugate_gradient(lambda v: list((a @ torch.cat(v)).split([4, 3])), list(b.split([4, 3])), n_steps=7)
+    torch.testing.assert_close(torch.cat(x), torch.linalg.solve(a, b), rtol=1e-8, atol=1e-8)
+
+
+def head_task(make_args, **kwargs):
+    """A meta-mode learner starting every task from its meta-learned head, and shot and query embeddings."""
+    args = make_args(head_init='meta', **kwargs)
+    torch.manual_seed(0)
+    model = MtlLearner(args, mode='meta', num_cls=args.way, in_chans=8, input_time_length=8)
+    generator = torch.Generator().manual_seed(1)
+    label_shot = torch.arange(args.way).repeat(args.shot)
+    label_query = torch.arange(args.way).repeat(args.train_query)
+    embedding_shot = torch.randn(label_shot.size(0), model.base_learner.z_dim, generator=generator)
+    embedding_query = torch.randn(label_query.size(0), model.base_learner.z_dim, generator=generator)
+    return model, embedding_shot.requires_grad_(), label_shot, embedding_query, label_query
+
+
+def meta_gradient(model, embedding_shot, label_shot, embedding_query, label_query):
+    """The gradients of the query loss after unrolled_inner_loop w.r.t. the initial head and the shot embeddings."""
+    weights = model.unrolled_inner_loop(embedding_shot, label_shot)
+    loss = F.cross_entropy(model.base_learner(embedding_query, weights), label_query)
+    return torch.autograd.grad(loss, list(model.base_learner.parameters()) + [embedding_shot])
+
+
+def test_second_order_matches_explicit_unrolled_adam(make_args):
+    model, embedding_shot, label_shot, embedding_query, label_query = head_task(
+        make_args, meta_grad='second_order', update_step=4)
+    grads = meta_gradient(model, embedding_shot, label_shot, embedding_query, label_query)
+    # Adam written out step by step, every step differentiated
+    weights = list(model.base_learner.parameters())
+    exp_avg = [torch.zeros_like(w) for w in weights]
+    exp_avg_sq = [torch.zeros_like(w) for w in weights]
+    for step in range(1, model.update_step + 2):
+        loss = F.cross_entropy(model.base_learner(embedding_shot, weights), label_shot)
+        step_grads = torch.autograd.grad(loss, weights, create_graph=True)
+        exp_avg = [0.9 * m + 0.1 * g for m, g in zip(exp_avg, step_grads)]
+        exp_avg_sq = [0.999 * v + 0.001 * g * g for v, g in zip(exp_avg_sq, step_grads)]
+        weights = [w - model.args.base_lr * (m / (1 - 0.9 ** step)) / ((v / (1 - 0.999 ** step)).sqrt() + 1e-8)
+                   for w, m, v in zip(weights, exp_avg, exp_avg_sq)]
+    loss = F.cross_entropy(model.base_learner(embedding_query, weights), label_query)
+    expected = torch.autograd.grad(loss, list(model.base_learner.parameters()) + [embedding_shot])
+    for grad, reference in zip(grads, expected):
+        torch.testing.assert_close(grad, reference, rtol=1e-4, atol=1e-6)
+
+
+def test_implicit_approaches_regularized_second_order(make_args):
+    # plain gradient steps (Meta-SGD step sizes) converge to the minimizer of the proximal shot loss, which is
+    # strongly convex for the linear head
+    lam = 1.0
+    model, embedding_shot, label_shot, embedding_query, label_query = head_task(
+        make_args, meta_grad='implicit', implicit_lam=lam, cg_steps=100, update_step=200,
+        inner_lr_mode='per_layer', inner_lr_init=0.2)
+    grads = meta_gradient(model, embedding_shot, label_shot, embedding_query, label_query)
+    # every step of the proximal problem differentiated
+    init = list(model.base_learner.parameters())
+    weights = init
+    for _ in range(model.update_step + 1):
+        loss = F.cross_entropy(model.base_learner(embedding_shot, weights), label_shot) + \
+            lam / 2 * sum(((w - w0) ** 2).sum() for w, w0 in zip(weights, init))
+        step_grads = torch.autograd.grad(loss, weights, create_graph=True)
+        weights = [w - 0.2 * g for w, g in zip(weights, step_grads)]
+    loss = F.cross_entropy(model.base_learner(embedding_query, weights), label_query)
+    # the unrolled loop differentiates the prox term w.r.t. the initial weights as well, which the implicit
+    # gradient at the minimizer accounts for through lam (H + lam I)^-1
+    expected = torch.autograd.grad(loss, init + [embedding_shot])
+    for grad, reference in zip(grads, expected):
+        torch.testing.assert_close(grad, reference, rtol=1e-3, atol=1e-5)
+
+
+LOSSES = [[1.0, 0.8, 0.75, 0.72, 0.5, 0.45, 0.44, 0.43],
+          [1.2, 1.05, 0.9, 0.75, 0.6, 0.45, 0.3, 0.15],
+          [1.0, 1.0, 0.95, 0.8, 0.79, 0.78, 0.6, 0.59]]
+GRAD_NORMS = [[3., 2., 0.5, 0.4, 0.3, 0.2, 0.1, 0.1],
+              [3., 3., 3., 3., 3., 3., 3., 3.],
+              [3., 2., 1.5, 1.2, 0.9, 0.5, 0.1, 0.1]]
+
+
+def first_stop(early_exit, losses, grad_norms):
+    for step, (loss, norm) in enumerate(zip(losses, grad_norms)):
+        if early_exit(torch.tensor(loss), [torch.tensor([norm, 0.])]):
+            return step
+    return None
+
+
+@pytest.mark.parametrize('options, stops', [
+    (dict(tol=0.1, patience=2), [3, None, 2]),
+    (dict(tol=0.1, patience=1), [2, None, 1]),
+    (dict(grad_tol=1.0), [2, None, 4]),
+    (dict(tol=0.1, patience=2, grad_tol=1.0), [2, None, 2]),
+    (dict(), [None, None, None]),
+])
+def test_early_exit_stops_at_the_expected_step(options, stops):
+    for losses, grad_norms, stop in zip(LOSSES, GRAD_NORMS, stops):
+        assert first_stop(EarlyExit(**options), losses, grad_norms) == stop
+
+
+@pytest.mark.parametrize('options', [dict(tol=0.1, patience=2), dict(tol=0.1, patience=1), dict(grad_tol=1.0),
+                                     dict(tol=0.1, patience=2, grad_tol=1.0)])
+def test_batched_early_exit_matches_per_episode(options):
+    expected = [first_stop(EarlyExit(**options), losses, norms) for losses, norms in zip(LOSSES, GRAD_NORMS)]
+    early_exit = BatchedEarlyExit(len(LOSSES), **options)
+    active = torch.ones(len(LOSSES), dtype=torch.bool)
+    stops = [None] * len(LOSSES)
+    losses, grad_norms = torch.tensor(LOSSES), torch.tensor(GRAD_NORMS)
+    for step in range(losses.size(1)):
+        # a stopped episode keeps its state and is never reported again, whatever its loss does
+        best, wait = early_exit.best.clone(), early_exit.wait.clone()
+        stop = early_exit(losses[:, step], [torch.stack([grad_norms[:, step], torch.zeros(3)], 1)], active)
+        assert not (stop & ~active).any()
+        assert torch.equal(early_exit.best[~active], best[~active]) and torch.equal(early_exit.wait[~active], wait[~active])
+        for i in stop.nonzero().flatten().tolist():
+            stops[i] = step
+        active = active & ~stop
+    assert stops == expected
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from utils.metrics import confusion_matrix, precision_recall_f1, roc_auc, episode_metrics
+
+sklearn_metrics = pytest.importorskip('sklearn.metrics')
+
+
+def episodes(n_episodes=20, samples=24, num_cls=4, seed=0):
+    """Random labels with every class present, and predictions that never give the last class in half the episodes."""
+    rng = np.random.RandomState(seed)
+    y_true = np.stack([rng.permutation(np.arange(samples) % num_cls) for _ in range(n_episodes)])
+    y_pred = rng.randint(0, num_cls, (n_episodes, samples))
+    y_pred[::2] %= num_cls - 1
+    return y_true, y_pred
+
+
+def test_confusion_matrix_matches_sklearn():
+    y_true, y_pred = episodes()
+    cm = confusion_matrix(y_true, y_pred, 4).numpy()
+    for i in range(len(y_true)):
+        np.testing.assert_array_equal(cm[i], sklearn_metrics.confusion_matrix(y_true[i], y_pred[i], labels=range(4)))
+
+
+def test_precision_recall_f1_match_sklearn():
+    y_true, y_pred = episodes()
+    precision, recall, f1 = precision_recall_f1(confusion_matrix(y_true, y_pred, 4))
+    for i in range(len(y_true)):
+        kwargs = dict(average='macro', zero_division=0)
+        assert precision[i] == pytest.approx(sklearn_metrics.precision_score(y_true[i], y_pred[i], **kwargs))
+        assert recall[i] == pytest.approx(sklearn_metrics.recall_score(y_true[i], y_pred[i], **kwargs))
+        assert f1[i] == pytest.approx(sklearn_metrics.f1_score(y_true[i], y_pred[i], **kwargs))
+
+
+def test_roc_auc_matches_sklearn():
+    y_true, _ = episodes()
+    generator = torch.Generator().manual_seed(0)
+    logits = torch.randn(y_true.shape + (4,), generator=generator)
+    # integer logits give ties between samples
+    logits[::3] = torch.randint(0, 3, logits[::3].shape, generator=generator).float()
+    probs = F.softmax(logits, 2).numpy()
+    auc = roc_auc(probs, y_true)
+    for i in range(len(y_true)):
+        assert auc[i] == pytest.approx(sklearn_metrics.roc_auc_score(y_true[i], probs[i], multi_class='ovr'))
+
+
+def test_episode_metrics_batched_matches_per_episode():
+    y_true, _ = episodes()
+    logits = torch.randn(y_true.shape + (4,), generator=torch.Generator().manual_seed(1))
+    batched = episode_metrics(logits, torch.from_numpy(y_true), 4)
+    for i in range(len(y_true)):
+        single = episode_metrics(logits[i], torch.from_numpy(y_true[i]), 4)
+        for key, value in single.items():
+            assert batched[key][i] == pytest.approx(value[0])
+    # labels shared by the episodes broadcast over them
+    shared = episode_metrics(logits, torch.from_numpy(y_true[0]), 4)
+    single = episode_metrics(logits[3], torch.from_numpy(y_true[0]), 4)
+    assert shared['f1'][3] == pytest.approx(single['f1'][0])
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from models.mtl import MtlLearner
+from utils.misc import compile_for_inference, chunked_inference, activation_bytes
+
+
+@pytest.mark.parametrize('backend', ['trace', 'script'])
+@pytest.mark.parametrize('model_type, in_chans, time_step', [
+    ('EEGNet', 22, 256), ('Deep4', 22, 1125), ('SPD_CNNnet', 22, 22)])
+def test_compile_inference_matches_eager(make_args, backend, model_type, in_chans, time_step):
+    torch.manual_seed(0)
+    model = MtlLearner(make_args(model_type=model_type), mode='pre', num_cls=4, in_chans=in_chans,
+                       input_time_length=time_step)
+    used = model.compile_inference(backend)
+    # SPD_CNNnet annotates its layers with Conv2dMtl, which TorchScript can't resolve, so script runs it eagerly
+    assert used == ('none' if (model_type, backend) == ('SPD_CNNnet', 'script') else backend)
+    for batch_size in [1, 16, 256]:
+        x = torch.randn(batch_size, 1, time_step, in_chans)
+        with torch.no_grad():
+            torch.testing.assert_close(model(x), model.classifier(model.encoder(x)), rtol=1e-4, atol=1e-4)
+    # train() drops the graphs, they hold the weights they were compiled with
+    model.train()
+    assert model.compiled == {}
+
+
+class _Untraceable(torch.nn.Module):
+    def forward(self, x):
+        return x * float(np.abs(x.detach().numpy()).max())
+
+
+def test_compile_falls_back_to_eager():
+    module = _Untraceable()
+    compiled, used = compile_for_inference(module, torch.randn(4, 3), 'script')
+    assert used == 'none' and compiled is module
+
+
+class _Counting(torch.nn.Module):
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(x.size(0))
+        return self.module(x)
+
+
+def test_chunked_inference_matches_one_forward(make_args):
+    torch.manual_seed(0)
+    model = MtlLearner(make_args(model_type='SPD_CNNnet'), mode='pre', num_cls=4, in_chans=22,
+                       input_time_length=22).eval()
+    counting = _Counting(model)
+    inputs = np.random.RandomState(0).randn(50, 1, 22, 22).astype(np.float32)
+    labels = np.arange(50) % 4
+    with torch.no_grad():
+        expected = model(torch.from_numpy(inputs))
+    expected_loss = F.cross_entropy(expected, torch.from_numpy(labels))
+    logits, loss = chunked_inference(counting, inputs, labels, chunk_size=16, device='cpu')
+    # the last chunk holds the 2 samples left over
+    assert counting.batch_sizes == [16, 16, 16, 2]
+    torch.testing.assert_close(logits, expected, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(loss, expected_loss, rtol=1e-5, atol=1e-6)
+    # a budget of 10.5 samples' activations gives chunks of 10 instead of chunk_size
+    memory_mb = 10.5 * activation_bytes(model, torch.from_numpy(inputs[:1])) / (1024 * 1024)
+    counting.batch_sizes = []
+    logits, loss = chunked_inference(counting, inputs, labels, chunk_size=256, memory_mb=memory_mb, device='cpu')
+    # after one sample through activation_bytes
+    assert counting.batch_sizes == [1] + [10] * 5
+    torch.testing.assert_close(logits, expected, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(loss, expected_loss, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,243 @@
+import copy
+import torch
+import torch.nn.functional as F
+import pytest
+from models.mtl import MtlLearner, segmented_batchnorm, encoder_output_shape
+from utils.misc import SavedTensorMeter, autocast, grad_scaler
+
+
+def spd_batch(n, size=8, seed=0):
+    x = torch.randn(n, size, 2 * size, generator=torch.Generator().manual_seed(seed))
+    return (x @ x.transpose(1, 2) / x.size(2)).unsqueeze(1)
+
+
+def meta_batch(args, size=8):
+    shots = [spd_batch(args.way * args.shot, size, seed=2 * i) for i in range(args.meta_batch_size)]
+    queries = [spd_batch(args.way * args.train_query, size, seed=2 * i + 1) for i in range(args.meta_batch_size)]
+    return shots, torch.arange(args.way).repeat(args.shot), queries, torch.arange(args.way).repeat(args.train_query)
+
+
+def meta_gradients(args, batched, size=8):
+    """The encoder gradients of one meta-batch, from one meta_forward_batch call or from one call per task, and
+    the graph peak of the forward."""
+    torch.manual_seed(0)
+    model = MtlLearner(args, mode='meta', in_chans=size, input_time_length=size)
+    data_shot, label_shot, data_query, label_query = meta_batch(args, size)
+    torch.manual_seed(1)
+    with SavedTensorMeter() as meter:
+        if batched:
+            logits = model((data_shot, label_shot, data_query))
+        else:
+            logits = [model((shot, label_shot, query)) for shot, query in zip(data_shot, data_query)]
+    torch.stack([F.cross_entropy(l, label_query) for l in logits]).mean().backward()
+    return [p.grad.clone() for p in model.encoder.parameters() if p.grad is not None], meter.peak
+
+
+@pytest.mark.parametrize('options', [dict(inner_detach=1), dict(meta_grad='first_order'), dict(meta_grad='second_order')])
+def test_encode_batched_matches_per_task(make_args, options):
+    grads, _ = meta_gradients(make_args(**options), batched=False)
+    batched_grads, _ = meta_gradients(make_args(encode_batched=1, **options), batched=True)
+    assert len(grads) == len(batched_grads) > 0
+    for g, b in zip(grads, batched_grads):
+        torch.testing.assert_close(b, g, rtol=1e-5, atol=1e-7)
+
+
+def test_encode_batched_keeps_no_shot_graph(make_args):
+    # with inner_detach the shot embeddings are encoded without a graph, also in the joint encoder call
+    _, detached = meta_gradients(make_args(encode_batched=1, inner_detach=1), batched=True)
+    _, kept = meta_gradients(make_args(encode_batched=1, inner_detach=0), batched=True)
+    _, per_task = meta_gradients(make_args(inner_detach=1), batched=False)
+    assert detached < kept
+    assert detached <= per_task
+
+
+def test_task_workers_keep_the_base_learner(make_args):
+    # the tasks on the pool each start from their own fresh head, the shared module is left alone
+    args = make_args(task_workers=3)
+    model = MtlLearner(args, mode='meta', in_chans=8, input_time_length=8)
+    base_learner = model.base_learner
+    weights = [w.detach().clone() for w in base_learner.parameters()]
+    data_shot, label_shot, data_query, _ = meta_batch(args)
+    logits = model((data_shot, label_shot, data_query))
+    assert len(logits) == args.meta_batch_size
+    assert model.base_learner is base_learner
+    for w, w0 in zip(base_learner.parameters(), weights):
+        assert torch.equal(w, w0)
+    pool = model.task_pool
+    model.shutdown_task_pool()
+    assert model.task_pool is None and pool._shutdown
+
+
+@pytest.mark.parametrize('mode', ['pre', 'meta'])
+def test_inner_lrs_only_in_meta_mode(make_args, mode):
+    model = MtlLearner(make_args(inner_lr_mode='per_layer'), mode=mode, num_cls=3, in_chans=8, input_time_length=8)
+    assert (model.inner_lrs is not None) == (mode == 'meta')
+    assert model.functional_head() == (mode == 'meta')
+
+
+@pytest.mark.parametrize('mode, options', [
+    ('meta', dict()),
+    ('meta', dict(inner_optim='flat_adam')),
+    ('meta', dict(inner_tol=0.05, inner_patience=1)),
+    ('meta', dict(inner_grad_tol=1.0, inner_optim='flat_adam')),
+    ('meta', dict(meta_grad='implicit', implicit_lam=2.0, inner_tol=0.02, inner_patience=1)),
+    ('meta', dict(meta_grad='truncated', inner_tol=0.1, inner_patience=1)),
+    ('meta', dict(meta_grad='second_order')),
+    ('meta', dict(inner_lr_mode='per_layer', inner_grad_tol=1.0)),
+    ('preval', dict(meta_grad='implicit', inner_lr_mode='per_param', inner_tol=0.05, inner_patience=1)),
+    ('meta', dict(head='proto')),
+    ('preval', dict(head='proto')),
+])
+def test_eval_episodes_matches_per_episode(make_args, mode, options):
+    # head_init='meta' starts every episode from the same weights, so both paths see the same initialization
+    args = make_args(head_init='meta', update_step=9, **options)
+    torch.manual_seed(0)
+    model = MtlLearner(args, mode='meta' if mode == 'meta' else 'pre', num_cls=args.way, in_chans=8,
+                       input_time_length=8)
+    model.mode = mode
+    model.eval()
+    data = spd_batch(30)
+    episodes = torch.stack([torch.randperm(30, generator=torch.Generator().manual_seed(i))[:15] for i in range(6)])
+    label_shot = torch.arange(args.way).repeat(args.shot)
+    k = label_shot.size(0)
+    per_episode = torch.stack([model((data[e[:k]], label_shot, data[e[k:]])).detach() for e in episodes])
+    per_episode_steps, model.inner_steps = model.inner_steps, []
+    batched = model.eval_episodes(data, episodes, label_shot)
+    torch.testing.assert_close(batched, per_episode, rtol=1e-4, atol=1e-5)
+    assert model.inner_steps == per_episode_steps
+    if args.inner_tol or args.inner_grad_tol:
+        assert min(per_episode_steps) < args.update_step + 1
+
+
+def test_proto_logits_are_distances_to_the_class_means(make_args):
+    args = make_args(head='proto')
+    torch.manual_seed(0)
+    model = MtlLearner(args, mode='meta', num_cls=args.way, in_chans=8, input_time_length=8)
+    data_shot, data_query = spd_batch(6), spd_batch(4, seed=1)
+    label_shot = torch.tensor([2, 0, 1, 1, 2, 0])
+    logits = model((data_shot, label_shot, data_query))
+    embedding_shot, embedding_query = model.encode(data_shot).detach(), model.encode(data_query).detach()
+    expected = torch.zeros(4, args.way)
+    for c in range(args.way):
+        mean = embedding_shot[label_shot == c].mean(0)
+        for q in range(4):
+            expected[q, c] = -((embedding_query[q] - mean) ** 2).mean()
+    torch.testing.assert_close(logits.detach(), expected, rtol=1e-5, atol=1e-6)
+    assert model.inner_steps[-1] == 0
+    # the prototypes and the queries both carry the encoder graph
+    logits.sum().backward()
+    assert any(p.grad is not None for p in model.encoder.parameters())
+
+
+@pytest.mark.parametrize('options', [dict(), dict(inner_detach=1), dict(meta_grad='second_order')])
+def test_meta_accumulate_matches_meta_batch_backward(make_args, options):
+    # MetaTrainer with --meta_accumulate back-propagates every task's loss / meta_batch_size right away
+    args = make_args(**options)
+    data_shot, label_shot, data_query, label_query = meta_batch(args)
+    grads = []
+    for meta_accumulate in [0, 1]:
+        torch.manual_seed(0)
+        model = MtlLearner(args, mode='meta', in_chans=8, input_time_length=8)
+        task_loss = []
+        for shot, query in zip(data_shot, data_query):
+            loss = F.cross_entropy(model((shot, label_shot, query)), label_query)
+            if meta_accumulate:
+                (loss / args.meta_batch_size).backward()
+                loss = loss.detach()
+            task_loss.append(loss)
+        if not meta_accumulate:
+            torch.stack(task_loss).mean().backward()
+        grads.append([p.grad for p in model.encoder.parameters() if p.grad is not None])
+    assert len(grads[0]) == len(grads[1]) > 0
+    for g, a in zip(*grads):
+        torch.testing.assert_close(a, g, rtol=1e-5, atol=1e-7)
+
+
+def test_segmented_batchnorm_matches_separate_calls():
+    torch.manual_seed(0)
+    module = torch.nn.Sequential(torch.nn.Conv2d(1, 4, 3), torch.nn.BatchNorm2d(4), torch.nn.ELU()).train()
+    joint_module = copy.deepcopy(module)
+    chunks = [torch.randn(n, 1, 8, 8) * (i + 1) for i, n in enumerate([6, 9, 4])]
+    separate = torch.cat([module(x) for x in chunks])
+    with segmented_batchnorm(joint_module, [x.size(0) for x in chunks]):
+        joint = joint_module(torch.cat(chunks))
+    torch.testing.assert_close(joint, separate)
+    torch.testing.assert_close(joint_module[1].running_mean, module[1].running_mean)
+    torch.testing.assert_close(joint_module[1].running_var, module[1].running_var)
+
+
+@pytest.mark.parametrize('head_init', ['random', 'meta'])
+def test_flat_adam_matches_adam(make_args, head_init):
+    label_shot = torch.arange(3).repeat(2)
+    weights = {}
+    for inner_optim in ['adam', 'flat_adam']:
+        args = make_args(inner_optim=inner_optim, head_init=head_init, num_cls_lay=2, update_step=9)
+        torch.manual_seed(0)
+        model = MtlLearner(args, mode='meta', in_chans=8, input_time_length=8)
+        with torch.no_grad():
+            embedding_shot = model.encode(spd_batch(6))
+        torch.manual_seed(1)  # the same random head for both
+        weights[inner_optim] = model.inner_loop(embedding_shot, label_shot)
+    for w, f in zip(weights['adam'], weights['flat_adam']):
+        torch.testing.assert_close(f, w.detach(), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('meta_grad', ['inplace', 'first_order', 'second_order'])
+def test_head_init_meta_learns_the_initialization(make_args, meta_grad):
+    # every task starts from a copy of the meta-learned head, which receives the query gradient
+    args = make_args(head_init='meta', meta_grad=meta_grad)
+    torch.manual_seed(0)
+    model = MtlLearner(args, mode='meta', in_chans=8, input_time_length=8)
+    init = [w.detach().clone() for w in model.base_learner.parameters()]
+    data_shot, label_shot, data_query, label_query = meta_batch(args)
+    with torch.no_grad():
+        embedding_shot, embedding_query = model.encode(data_shot[0]), model.encode(data_query[0])
+    logits = model.meta_head_forward(embedding_shot, label_shot, embedding_query)
+    for w, w0 in zip(model.base_learner.parameters(), init):
+        assert torch.equal(w.detach(), w0)
+    F.cross_entropy(logits, label_query).backward()
+    grads = [w.grad for w in model.base_learner.parameters()]
+    assert all(g is not None and g.abs().sum() > 0 for g in grads)
+    if meta_grad in ('inplace', 'first_order'):
+        # first-order: the initialization gets the query gradient at the adapted weights
+        fast_weights = [w.detach().requires_grad_() for w in model.inner_loop(embedding_shot, label_shot)]
+        query_grads = torch.autograd.grad(
+            F.cross_entropy(model.base_learner(embedding_query, fast_weights), label_query), fast_weights)
+        for g, q in zip(grads, query_grads):
+            torch.testing.assert_close(g, q)
+
+
+@pytest.mark.parametrize('model_type, in_chans, time_step', [
+    ('EEGNet', 22, 1125), ('EEGNet', 3, 500), ('Deep4', 22, 1125), ('Deep4', 3, 1000),
+    ('SPD_CNNnet', 12, 12), ('SPD_CNNnet', 22, 22), ('SPDNet', 12, 12), ('SPDNet', 44, 44), ('Tangent', 12, 12)])
+def test_encoder_output_shape_matches_forward(make_args, model_type, in_chans, time_step):
+    model = MtlLearner(make_args(model_type=model_type), mode='meta', in_chans=in_chans,
+                       input_time_length=time_step).eval()
+    with torch.no_grad():
+        out = model.encoder(torch.eye(in_chans).expand(2, 1, in_chans, in_chans) if time_step == in_chans
+                            else torch.randn(2, 1, time_step, in_chans))
+    assert encoder_output_shape(model_type, in_chans, time_step) == tuple(out.shape[1:])
+
+
+def test_bf16_embeddings_come_back_in_float32(make_args):
+    data = spd_batch(12, size=22)
+    label_shot = torch.arange(3).repeat(2)
+    logits = {}
+    for precision in ['fp32', 'bf16']:
+        args = make_args(model_type='SPD_CNNnet', precision=precision)
+        torch.manual_seed(0)
+        model = MtlLearner(args, mode='meta', num_cls=args.way, in_chans=22, input_time_length=22).eval()
+        with torch.no_grad(), autocast(args):
+            raw = model.encoder(data)
+        embedding = model.encode(data)
+        assert embedding.dtype == torch.float32
+        if precision == 'fp32':
+            # fp32 leaves the encoder as it is
+            with torch.no_grad():
+                torch.testing.assert_close(embedding.detach(), model.encoder(data), rtol=0, atol=0)
+        else:
+            assert raw.dtype == torch.bfloat16
+        logits[precision] = model((data[:6], label_shot, data[6:])).detach()
+        assert logits[precision].dtype == torch.float32
+        assert not grad_scaler(args).is_enabled()
+    torch.testing.assert_close(logits['bf16'], logits['fp32'], rtol=0.02, atol=0.02)
@@ -0,0 +1,56 @@
+import pytest
+import torch
+from models.mtl import MtlLearner
+from utils.quantize import quantize_static, fuse_mtl, fold_batchnorm
+
+SHAPES = {'EEGNet': (22, 256), 'SPD_CNNnet': (22, 22)}
+
+
+def float_model(make_args, model_type):
+    """The eval-mode pre-train model with trained-looking BatchNorm statistics, and random trials for it."""
+    torch.manual_seed(0)
+    in_chans, time_step = SHAPES[model_type]
+    model = MtlLearner(make_args(model_type=model_type), mode='pre', num_cls=4, in_chans=in_chans,
+                       input_time_length=time_step)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+                if module.affine:
+                    module.weight.uniform_(0.5, 1.5)
+                    module.bias.uniform_(-0.5, 0.5)
+    return torch.nn.Sequential(model.encoder, model.classifier).eval(), torch.randn(256, 1, time_step, in_chans)
+
+
+@pytest.mark.parametrize('model_type', sorted(SHAPES))
+def test_fuse_and_fold_keep_the_function(make_args, model_type):
+    model, x = float_model(make_args, model_type)
+    with torch.no_grad():
+        expected = model(x)
+        fused = fuse_mtl(model)
+        torch.testing.assert_close(fused(x), expected, rtol=1e-4, atol=1e-5)
+        torch.testing.assert_close(fold_batchnorm(fused)(x), expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('model_type', sorted(SHAPES))
+def test_quantize_static_error_bound(make_args, model_type):
+    model, x = float_model(make_args, model_type)
+    int8_model = quantize_static(model, x[:128])
+    with torch.no_grad():
+        expected, logits = model(x), int8_model(x)
+    assert (logits - expected).abs().max() <= 0.1 * expected.abs().max()
+    assert (logits.argmax(1) == expected.argmax(1)).float().mean() >= 0.9
+
+
+def test_quantize_static_restores_the_engine(make_args):
+    engines = [engine for engine in torch.backends.quantized.supported_engines if engine != 'none']
+    if len(engines) < 2:
+        pytest.skip('needs two quantized engines')
+    model, x = float_model(make_args, 'SPD_CNNnet')
+    previous = torch.backends.quantized.engine
+    backend = next(engine for engine in engines if engine != previous)
+    int8_model = quantize_static(model, x[:64], backend=backend)
+    assert torch.backends.quantized.engine == previous
+    with torch.no_grad():
+        assert (int8_model(x).argmax(1) == model(x).argmax(1)).float().mean() >= 0.9
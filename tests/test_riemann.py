@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from dataloader.spd_preprocess import pack_upper
+from models.riemann import as_covariances, MDM, TangentSpaceLR
+
+
+def class_covariances(count, n=6, bands=2, classes=3, seed=0):
+    """Covariances of signals whose channel mixing depends on the class, shaped (count, bands, n, n), and labels."""
+    rng = np.random.RandomState(seed)
+    mixing = np.eye(n) + 0.3 * np.random.RandomState(100).randn(classes, bands, n, n)
+    labels = np.arange(count) % classes
+    x = mixing[labels] @ rng.randn(count, bands, n, 4 * n)
+    return x @ np.swapaxes(x, -1, -2) / (4 * n), labels
+
+
+def test_as_covariances_unpacks():
+    covs, _ = class_covariances(4)
+    np.testing.assert_allclose(as_covariances(pack_upper(covs)), covs, rtol=1e-6)
+    assert as_covariances(covs.astype(np.float32)).dtype == np.float64
+
+
+@pytest.mark.filterwarnings('ignore:logm result may be inaccurate')
+def test_mdm_predicts_the_nearest_class_mean():
+    linalg = pytest.importorskip('scipy.linalg')
+    covs, labels = class_covariances(60)
+    test_covs, _ = class_covariances(30, seed=1)
+    mdm = MDM().fit(covs, labels)
+    expected = np.zeros((len(test_covs), len(mdm.classes)))
+    for i, cov in enumerate(test_covs):
+        for j, mean in enumerate(mdm.means):
+            for band in range(cov.shape[0]):
+                whiten = linalg.inv(linalg.sqrtm(mean[band]).real)
+                expected[i, j] += np.square(linalg.logm(whiten @ cov[band] @ whiten).real).sum()
+    np.testing.assert_allclose(mdm.distances(test_covs), np.sqrt(expected), rtol=1e-6)
+    np.testing.assert_array_equal(mdm.predict_proba(test_covs).argmax(1), expected.argmin(1))
+
+
+def test_tangent_space_lr_matches_sklearn():
+    linear_model = pytest.importorskip('sklearn.linear_model')
+    covs, labels = class_covariances(60)
+    test_covs, test_labels = class_covariances(60, seed=1)
+    model = TangentSpaceLR(C=1.0).fit(covs, labels)
+    reference = linear_model.LogisticRegression(C=1.0, max_iter=1000, tol=1e-10).fit(
+        model.features(covs).numpy(), labels)
+    proba = model.predict_proba(test_covs)
+    np.testing.assert_allclose(proba, reference.predict_proba(model.features(test_covs).numpy()), atol=1e-3)
+    assert (proba.argmax(1) == test_labels).mean() > 0.8
@@ -0,0 +1,49 @@
+import warnings
+import pytest
+import torch
+from dataloader.spd_preprocess import pack_upper
+from models.mtl import MtlLearner
+from models.SPD_CNNnet import symmetrize
+
+
+def spd_learner(make_args, packed, n=12):
+    return MtlLearner(make_args(model_type='SPD_CNNnet', spd_packed=packed), mode='pre', num_cls=3, in_chans=n,
+                      input_time_length=n).eval()
+
+
+def covariances(count, n=12):
+    x = torch.randn(count, 1, n, 2 * n)
+    return x @ x.transpose(2, 3) / x.size(3)
+
+
+def test_packed_matches_full_with_a_symmetric_kernel(make_args):
+    torch.manual_seed(0)
+    state = spd_learner(make_args, 0).state_dict()
+    state['encoder.conv1.weight'] = symmetrize(state['encoder.conv1.weight'])
+    full, packed = spd_learner(make_args, 0), spd_learner(make_args, 1)
+    full.load_state_dict(state)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        packed.load_state_dict(state)
+    x = covariances(16)
+    with torch.no_grad():
+        torch.testing.assert_close(packed(torch.from_numpy(pack_upper(x.numpy()))), full(x), rtol=1e-4, atol=1e-5)
+
+
+def test_packed_kernel_is_symmetric(make_args):
+    torch.manual_seed(0)
+    weight = spd_learner(make_args, 1).encoder.conv1.weight
+    assert torch.equal(weight, weight.transpose(2, 3))
+
+
+def test_packed_symmetrizes_an_unsymmetric_checkpoint(make_args):
+    torch.manual_seed(0)
+    state = spd_learner(make_args, 0).state_dict()
+    weight = state['encoder.conv1.weight'].clone()
+    assert not torch.allclose(weight, weight.transpose(2, 3))
+    packed = spd_learner(make_args, 1)
+    with pytest.warns(UserWarning, match='not symmetric'):
+        packed.load_state_dict(state)
+    torch.testing.assert_close(packed.encoder.conv1.weight, symmetrize(weight))
+    # the caller's checkpoint is left as it was
+    assert torch.equal(state['encoder.conv1.weight'], weight)
@@ -0,0 +1,126 @@
+import argparse
+import numpy as np
+import pytest
+from dataloader.spd_preprocess import ledoit_wolf, filter_bank_covariances, load_spd, log_euclidean_mean, \
+    riemannian_mean, recenter, pack_upper, unpack_upper, normalize, PackedSPD, save_packed, load_subject, \
+    read_manifest, load_cached, tangent_space
+
+
+def spd(count, n=6, seed=0):
+    """Widely spread SPD matrices shaped (count, n, n): covariances of short signals with random channel scales."""
+    rng = np.random.RandomState(seed)
+    x = rng.randn(count, n, 2 * n) * np.exp(rng.randn(count, n, 1))
+    return x @ np.swapaxes(x, -1, -2) / (2 * n) + 1e-3 * np.eye(n)
+
+
+@pytest.mark.parametrize('mean', ['riemann', 'logeuclid'])
+def test_load_spd_refuses_tangent_with_recenter(tmp_path, mean):
+    args = argparse.Namespace(spd_tangent=1, spd_recenter=mean)
+    with pytest.raises(ValueError, match='cannot be combined'):
+        load_spd(str(tmp_path), 'A01', args)
+
+
+def test_ledoit_wolf_matches_sklearn():
+    covariance = pytest.importorskip('sklearn.covariance')
+    x = np.random.RandomState(0).randn(5, 8, 40)
+    expected = np.stack([covariance.ledoit_wolf(trial.T)[0] for trial in x])
+    np.testing.assert_allclose(ledoit_wolf(x), expected, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('estimator', ['lwf', 'scm'])
+def test_filter_bank_covariances_match_band_by_band(estimator):
+    sfreq, bands = 250, [(4, 8), (8, 12), (12, 30), (100, 126)]
+    x = np.random.RandomState(0).randn(10, 6, 2 * sfreq)
+    freqs = np.fft.rfftfreq(x.shape[-1], 1. / sfreq)
+    expected = []
+    for low, high in bands:
+        mask = (freqs >= low) & (freqs < high) & (freqs > 0)
+        band = np.fft.irfft(np.fft.rfft(x, axis=-1) * mask, n=x.shape[-1], axis=-1)
+        expected.append(ledoit_wolf(band) if estimator == 'lwf' else band @ np.swapaxes(band, -1, -2) / x.shape[-1])
+    covs = filter_bank_covariances(x, sfreq, bands, estimator, chunk=4)
+    np.testing.assert_allclose(covs, np.stack(expected, 1), rtol=1e-8, atol=1e-12)
+
+
+def test_recentered_riemannian_mean_is_the_identity():
+    covs = spd(40)
+    mean, _ = riemannian_mean(covs)
+    recentered = unpack_upper(recenter(covs, mean), 6).astype(np.float64)
+    np.testing.assert_allclose(riemannian_mean(recentered)[0], np.eye(6), atol=1e-5)
+
+
+@pytest.mark.filterwarnings('ignore:logm result may be inaccurate')
+def test_log_euclidean_mean_matches_scipy():
+    linalg = pytest.importorskip('scipy.linalg')
+    covs = spd(10)
+    expected = linalg.expm(np.mean([linalg.logm(c).real for c in covs], 0))
+    np.testing.assert_allclose(log_euclidean_mean(covs), expected, rtol=1e-8, atol=1e-10)
+
+
+def test_riemannian_mean_stops_within_max_iter():
+    covs = spd(40)
+    _, iterations = riemannian_mean(covs)
+    assert iterations < 100
+    _, iterations = riemannian_mean(covs, tol=0, max_iter=3)
+    assert iterations == 3
+
+
+def test_unpack_inverts_pack():
+    covs = spd(5).astype(np.float32)
+    np.testing.assert_array_equal(unpack_upper(pack_upper(covs), 6), covs)
+
+
+def test_normalize_packed_matches_full():
+    covs = spd(5)
+    np.testing.assert_allclose(normalize(pack_upper(covs).astype(np.float64), packed=True),
+                               pack_upper(normalize(covs)), rtol=1e-5, atol=1e-5)
+
+
+def test_packed_spd_indexing():
+    covs = spd(5).astype(np.float32)
+    packed = PackedSPD(pack_upper(covs[:, None]))
+    assert len(packed) == 5 and packed.shape == (5, 1, 6, 6) and packed.ndim == 4
+    np.testing.assert_array_equal(packed[2], covs[2, None])
+    np.testing.assert_array_equal(packed[[0, 3]], covs[[0, 3], None])
+    np.testing.assert_array_equal(np.asarray(packed), covs[:, None])
+
+
+@pytest.mark.parametrize('bands', [None, 3])
+def test_save_packed_roundtrip(tmp_path, bands):
+    covs = spd(5) if bands is None else np.stack([spd(5, seed=band) for band in range(bands)], 1)
+    labels = np.array(['left_hand', 'right_hand', 'feet', 'left_hand', 'feet'])
+    save_packed(str(tmp_path), 'S1_SPD', covs, labels)
+    loaded, loaded_labels = load_subject(str(tmp_path), 'S1_SPD')
+    assert loaded.dtype == np.float32 and loaded.shape == (5, bands or 1, 21)
+    np.testing.assert_allclose(unpack_upper(loaded, 6), covs.reshape(5, bands or 1, 6, 6), rtol=1e-6)
+    np.testing.assert_array_equal(loaded_labels, labels)
+    entry = read_manifest(str(tmp_path))['subjects']['S1_SPD']
+    assert (entry['trials'], entry['chans'], entry['bands']) == (5, 6, bands or 1)
+
+
+def test_load_cached_hits_and_invalidates(tmp_path):
+    calls = []
+
+    def compute(covs):
+        calls.append(covs.shape)
+        return pack_upper(2 * covs)
+
+    save_packed(str(tmp_path), 'S1_SPD', spd(5), np.arange(5))
+    first, _ = load_cached(str(tmp_path), 'S1_SPD', 'double', compute)
+    second, _ = load_cached(str(tmp_path), 'S1_SPD', 'double', compute)
+    assert calls == [(5, 1, 6, 6)]
+    np.testing.assert_array_equal(first, second)
+    # new covariances for the subject change the digest of the source, the stage is computed again
+    save_packed(str(tmp_path), 'S1_SPD', spd(5, seed=1), np.arange(5))
+    third, _ = load_cached(str(tmp_path), 'S1_SPD', 'double', compute)
+    assert len(calls) == 2
+    np.testing.assert_allclose(unpack_upper(third, 6)[:, 0], 2 * spd(5, seed=1), rtol=1e-5)
+
+
+@pytest.mark.filterwarnings('ignore:logm result may be inaccurate')
+def test_tangent_space_matches_scipy():
+    linalg = pytest.importorskip('scipy.linalg')
+    covs = spd(5)
+    reference = log_euclidean_mean(covs)
+    whiten = linalg.inv(linalg.sqrtm(reference).real)
+    expected = np.stack([linalg.logm(whiten @ c @ whiten).real for c in covs])
+    np.testing.assert_allclose(unpack_upper(tangent_space(covs, reference), 6), expected, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,86 @@
+import pytest
+import torch
+from models.SPDNet import _EigFunction, BiMapMtl, LogEig, ReEig, SPDNet
+
+
+def spd(n, batch=3, seed=0, dtype=torch.float64):
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(batch, n, 2 * n, generator=generator, dtype=dtype)
+    return x @ x.transpose(-1, -2) / (2 * n) + 0.1 * torch.eye(n, dtype=dtype)
+
+
+def middle_eps(x):
+    """A threshold halfway between two eigenvalues, so the clamp is active on some of them and away from its kink."""
+    s = torch.linalg.eigvalsh(x)
+    middle = s.size(-1) // 2
+    return ((s[..., middle - 1] + s[..., middle]) / 2).median().item()
+
+
+def spectral_functions(eps):
+    return {'log': (lambda s: s.clamp(min=eps).log(), lambda s: (s > eps).to(s.dtype) / s),
+            'clamp': (lambda s: s.clamp(min=eps), lambda s: (s > eps).to(s.dtype))}
+
+
+@pytest.mark.parametrize('name', ['log', 'clamp'])
+def test_eig_backward_gradcheck(name):
+    x = spd(5)
+    eps = middle_eps(x)
+    fn, dfn = spectral_functions(eps)[name]
+    # eigh reads one triangle, the symmetrization makes the numerical jacobian that of a function of symmetric inputs
+    check = lambda a: _EigFunction.apply((a + a.transpose(-1, -2)) / 2, fn, dfn)
+    assert torch.autograd.gradcheck(check, (x.requires_grad_(),))
+
+
+@pytest.mark.parametrize('name', ['log', 'clamp'])
+def test_eig_backward_matches_eigh_autograd(name):
+    x = spd(6)
+    eps = middle_eps(x)
+    fn, dfn = spectral_functions(eps)[name]
+    weight = torch.randn(6, 6, dtype=torch.float64)
+    custom = x.clone().requires_grad_()
+    (_EigFunction.apply(custom, fn, dfn) * weight).sum().backward()
+    reference = x.clone().requires_grad_()
+    s, u = torch.linalg.eigh(reference)
+    (((u * fn(s).unsqueeze(-2)) @ u.transpose(-1, -2)) * weight).sum().backward()
+    torch.testing.assert_close(custom.grad, reference.grad, rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize('layer', [ReEig(), LogEig(4)])
+def test_eig_backward_finite_at_repeated_eigenvalues(layer):
+    x = torch.eye(4).repeat(2, 1, 1).requires_grad_()
+    layer(x).pow(2).sum().backward()
+    assert torch.isfinite(x.grad).all()
+
+
+def test_bimap_mtl_trains_only_the_ss_scale():
+    layer = BiMapMtl(8, 4)
+    out = layer(spd(8, dtype=torch.float32))
+    assert out.shape == (3, 4, 4)
+    assert torch.linalg.eigvalsh(out).min() > 0
+    out.sum().backward()
+    assert layer.weight.grad is None
+    assert layer.mtl_weight.grad is not None and torch.isfinite(layer.mtl_weight.grad).all()
+
+
+def test_spdnet_backward_is_finite():
+    torch.manual_seed(0)
+    model = SPDNet(in_chans=12, mtl=True)
+    x = spd(12, batch=4, dtype=torch.float32).unsqueeze(1)
+    out = model(x)
+    assert out.shape == (4,) + SPDNet.output_shape(12, 12)
+    out.pow(2).sum().backward()
+    grads = [p.grad for p in model.parameters() if p.requires_grad]
+    assert grads and all(g is not None and torch.isfinite(g).all() for g in grads)
+
+
+def test_eig_backward_stable_at_nearly_repeated_eigenvalues():
+    # float32 eigenvalues one ulp apart: their divided difference of log is rounding error, the derivative is used
+    q = torch.linalg.qr(torch.randn(4, 4, generator=torch.Generator().manual_seed(0), dtype=torch.float64))[0]
+    x = q @ torch.diag(torch.tensor([100., 100. + 8e-6, 1., 50.], dtype=torch.float64)) @ q.t()
+    weight = torch.randn(4, 4, generator=torch.Generator().manual_seed(1), dtype=torch.float64)
+    grads = []
+    for dtype in [torch.float32, torch.float64]:
+        a = x.to(dtype).requires_grad_()
+        (_EigFunction.apply(a, *spectral_functions(1e-4)['log']) * weight.to(dtype)).sum().backward()
+        grads.append(a.grad.double())
+    torch.testing.assert_close(grads[0], grads[1], rtol=1e-3, atol=1e-4)
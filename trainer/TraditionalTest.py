@@ -7,21 +7,22 @@
 """ TestModel for normal-train phase. """
 import os.path as osp
 import os
+import copy
 import tqdm
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from dataloader.samplers import CategoriesSampler
+from dataloader.samplers import CategoriesSampler, episode_batch
 from models.mtl import MtlLearner
-from sklearn.metrics import roc_auc_score, precision_score, recall_score, accuracy_score, f1_score
-from sklearn.preprocessing import LabelBinarizer
-from utils.misc import Averager, Timer, count_acc, compute_confidence_interval, ensure_path
+from utils.misc import Timer, count_acc, compute_confidence_interval, ensure_path, step_summary, chunked_inference
+from utils.metrics import confusion_matrix, accuracy, precision_recall_f1, roc_auc, episode_metrics
+from utils.quantize import quantize_static, calibration_subset, inference_latency
+from models.riemann import MDM, TangentSpaceLR, as_covariances
 from tensorboardX import SummaryWriter
 # from dataloader.dataset_loader_BCI_IV_c import DatasetLoader_BCI_IV_subjects as Dataset
 # from dataloader.DataSetLoader_BNCI2015004 import DataSetLoader_BNCI2015004 as Dataset
 import time
-from torch.autograd import Variable# for original test
 class TestModel(object):
     """The class that contains the code for the meta-train phase and meta-eval phase."""
 
@@ -53,8 +54,9 @@ class TestModel(object):
         num_class_pretrain = self.testset.num_class
         in_chans=self.testset.in_chans
         input_time_length=self.testset.time_step
+        in_bands=getattr(self.testset, 'bands', 1)  # only the SPD loaders have a band axis
         # Build test model #这
-        self.model = MtlLearner(self.args, mode='pre', num_cls=num_class_pretrain,in_chans=in_chans,input_time_length=input_time_length)
+        self.model = MtlLearner(self.args, mode='pre', num_cls=num_class_pretrain,in_chans=in_chans,input_time_length=input_time_length,in_bands=in_bands)
 
         # load pretrained model without classifier block #
         self.model_dict = self.model.state_dict()#
@@ -96,6 +98,11 @@ class TestModel(object):
         if torch.cuda.is_available():
             torch.backends.cudnn.benchmark = True
             self.model = self.model.cuda()
+        if self.args.compile != 'none':
+            print('Inference graphs:', self.model.compile_inference(self.args.compile))
+        if self.args.quantize and self.args.model_type not in ('SPD_CNNnet', 'EEGNet'):
+            raise ValueError('int8 quantization supports SPD_CNNnet and EEGNet, not ' + self.args.model_type)
+        self.quantized_model = None # the int8 pre-train model, calibrated on the first quantized_test call
 
     def test(self):
         """The function for the meta-eval phase."""
@@ -124,64 +131,58 @@ class TestModel(object):
         print('OriginalTest--Test accuracy-(ACC):', valid_results[0], 'F-mearsure:', valid_results[2],"loss:", loss.item())  #
         print('ACC:', valid_results[0])
         print('F-mearsure:', valid_results[2])
-    def val_orig(self, X_val, y_val):  # ML-validation
-        predicted_loss = []
-        inputs = torch.from_numpy(X_val)
-        labels = torch.FloatTensor(y_val * 1.0)
-        inputs, labels = Variable(inputs), Variable(labels)
-
-        results = []
-        predicted = []
-
+    def quantized_test(self):
+        """Accuracy and CPU latency of the int8 pre-train model against float32 on the test subject. The int8
+        model is calibrated once, on args.calib_samples trials of the training split."""
+        if self.args.dataset=='BNCI2015004':
+            from dataloader.DataSetLoader_BNCI2015004 import DataSetLoader_BNCI2015004 as Dataset
+        elif self.args.dataset == 'BNCI2014001':
+            from dataloader.DataSetLoader_BNCI2014001 import DataSetLoader_BNCI2014001 as Dataset
+        elif self.args.dataset == 'Schirrmeister2017':
+            from dataloader.DataSetLoader_Schirrmeister2017 import DataSetLoader_Schirrmeister2017 as Dataset
+        elif self.args.dataset == 'BNCI2014001_SPD':
+            from dataloader.DataSetLoader_BNCI2014001_SPD import DataSetLoader_BNCI2014001_SPD as Dataset
+        elif self.args.dataset == 'Schirrmeister2017_SPD':
+            from dataloader.DataSetLoader_Schirrmeister2017_SPD import DataSetLoader_Schirrmeister2017_SPD as Dataset
+        elif self.args.dataset == 'BNCI2015004_SPD':
+            from dataloader.DataSetLoader_BNCI2015004_SPD import DataSetLoader_BNCI2015004_SPD as Dataset
+        else:
+            assert print('wrong dataset input')
         self.model.eval()
-        self.model.mode = 'origval'
-
+        float_model = torch.nn.Sequential(self.model.encoder, self.model.classifier).cpu()
+        if self.quantized_model is None:
+            trainset = Dataset('train', self.args, train_aug=False, TrainSubjects=self.args.TrainSubjects, TestSubject=self.args.TestSubject, BinaryClassify=self.args.BinaryClassify)
+            self.quantized_model = quantize_static(float_model, calibration_subset(trainset.data, self.args.calib_samples))
+        testset = Dataset('test', self.args, train_aug=False, TrainSubjects=self.args.TrainSubjects, TestSubject=self.args.TestSubject, BinaryClassify=self.args.BinaryClassify)
+        print('-------Int8 quantized test for Pre-train phase---------------------------------------------')
+        print('test subject:', self.args.TestSubject[0])
+        for name, model in [('float32', float_model), ('int8', self.quantized_model)]:
+            start = time.time()
+            logits, _ = chunked_inference(model, testset.X_test, testset.y_test, self.args.val_chunk, device='cpu')
+            split_time = time.time() - start
+            acc = count_acc(logits, torch.as_tensor(np.asarray(testset.y_test)).long())
+            print('{}: ACC {:.4f}, latency {:.2f} ms per trial, {:.1f} ms for the {} test trials'.format(
+                name, acc, inference_latency(model, testset.X_test), split_time * 1000, len(testset.X_test)))
         if torch.cuda.is_available():
-            inputs = inputs.type(torch.cuda.FloatTensor)
-        else:
-            inputs = inputs.type(torch.FloatTensor)
-
-        predicted = self.model(inputs)
-        labels1 = torch.IntTensor(y_val * 1.0)
-        labels1 = labels1.type(torch.int64)  #
-        labels1 = labels1.cuda()
-        loss = F.cross_entropy(predicted, labels1)
-        predicted = predicted.data.cpu().numpy()
-
-        Y = labels.data.numpy()
-        predicted = np.argmax(predicted, axis=1)
+            self.model.cuda()
 
-        for param in ["acc", "recall", "precision","fmeasure", "auc"]:
-            if param == 'acc':
-                results.append(accuracy_score(Y, np.round(predicted)))
-            if param == "recall":
-                results.append(recall_score(Y, np.round(predicted), average='micro'))
-            if param == "fmeasure":
-                precision = precision_score(Y, np.round(predicted), average='micro')
-                recall = recall_score(Y, np.round(predicted), average='micro')
-                results.append(2*precision*recall/ (precision+recall))
-            if param == "auc":
-                # Y = label.data.cpu().numpy()#
-                def multiclass_roc_auc_score(y_test, y_pred, average="macro"):
-                    lb = LabelBinarizer()
-                    lb.fit(y_test)
-                    y_test = lb.transform(y_test)
-                    y_pred = lb.transform(y_pred)
-                    return roc_auc_score(y_test, y_pred, average=average)
-                auc = multiclass_roc_auc_score(Y, predicted)  ##
-                results.append(auc)
+    def val_orig(self, X_val, y_val):  # ML-validation
+        self.model.eval()
+        self.model.mode = 'origval'
+        # the split goes through the model in chunks, the activations of all its samples are never held at once
+        predicted, loss = chunked_inference(self.model, X_val, y_val, self.args.val_chunk, self.args.val_memory_mb)
+        labels = torch.as_tensor(np.asarray(y_val)).long()
+        # acc, recall and F-measure (micro, which for single-label data are all the accuracy) and AUC
+        cm = confusion_matrix(labels, predicted.argmax(1), predicted.size(1))
+        _, recall, fmeasure = precision_recall_f1(cm, average='micro')
+        auc = roc_auc(F.softmax(predicted, dim=1).numpy(), labels.numpy())
+        results = [accuracy(cm)[0], recall[0], fmeasure[0], auc[0]]
+        predicted = np.argmax(predicted.numpy(), axis=1)
         return predicted, results, loss
 
     def meta_test(self):#For meta-test to the Pre-train model
         """The function for the meta-eval phase."""
         # Load the logs
-        def multiclass_roc_auc_score(y_test, y_pred, average="macro"):
-            lb = LabelBinarizer()
-            lb.fit(y_test)
-            y_test = lb.transform(y_test)
-            y_pred = lb.transform(y_pred)
-            return roc_auc_score(y_test, y_pred, average=average)
-
         trlog = torch.load(osp.join(self.args.save_path, 'trlog'))
 
         # Load meta-test set#TODO: 也许可以更改数据集的方式，比如 ”train-meta" 作为输入等
@@ -208,18 +209,11 @@ class TestModel(object):
         sampler = CategoriesSampler(test_set.label, 20, self.args.way, self.args.shot + self.args.val_query)
         loader = DataLoader(test_set, batch_sampler=sampler, num_workers=8, pin_memory=True)
 
-        # Set test accuracy recorder
-        test_acc_record = np.zeros((20,))  #
-        test_f1_record = np.zeros((20,))
-        test_auc_record = np.zeros((20,))
         # Load model for meta-test phase
 
         # Set model to eval mode
         self.model.eval()
         self.model.mode = 'preval'
-        # Set accuracy averager
-        ave_acc = Averager()
-
         # Generate labels
         label = torch.arange(self.args.way).repeat(self.args.val_query)
         if torch.cuda.is_available():
@@ -232,35 +226,91 @@ class TestModel(object):
         else:
             label_shot = label_shot.type(torch.LongTensor)
 
-        Y = label.data.cpu().numpy()
-        # Start meta-test
-        for i, batch in enumerate(loader, 1):  ##
+        self.model.inner_steps = []
+        eval_start = time.time()
+        if self.args.eval_batched:
+            # Encode every trial once and adapt the heads of all episodes together
+            data, episodes = episode_batch(test_set, sampler)
             if torch.cuda.is_available():
-                data, _ = [_.cuda() for _ in batch]
-            else:
-                data = batch[0]
-            k = self.args.way * self.args.shot
-            data_shot, data_query = data[:k], data[k:]
-            logits = self.model((data_shot, label_shot, data_query))
-            acc = count_acc(logits, label)
-            logits = logits.data.cpu().numpy()  ##
-            predicted = np.argmax(logits, axis=1)
-            f1 = f1_score(Y, predicted, average='macro')
-            auc = multiclass_roc_auc_score(Y, predicted)  ##
-            ave_acc.add(acc)
-            test_acc_record[i - 1] = acc
-            test_f1_record[i - 1] = f1  #
-            test_auc_record[i - 1] = auc
-            if i % 100 == 0:
-                print('batch {}: {:.2f}({:.2f})'.format(i, ave_acc.item() * 100, acc * 100))
+                data, episodes = data.cuda(), episodes.cuda()
+            logits = self.model.eval_episodes(data, episodes, label_shot)
+        else:
+            # Start meta-test
+            logits = []
+            for i, batch in enumerate(loader, 1):  ##
+                if torch.cuda.is_available():
+                    data, _ = [_.cuda() for _ in batch]
+                else:
+                    data = batch[0]
+                k = self.args.way * self.args.shot
+                data_shot, data_query = data[:k], data[k:]
+                logits.append(self.model((data_shot, label_shot, data_query)).detach())
+            logits = torch.stack(logits)
+        # The metrics of all episodes at once, from the stacked logits
+        results = episode_metrics(logits, label, self.args.way)
+        print('Meta-test: {:.2f} s for {} episodes'.format(time.time() - eval_start, len(logits)))
 
         # Calculate the confidence interval, update the logs
-        m, pm = compute_confidence_interval(test_acc_record)
-        f1_m, f1_pm = compute_confidence_interval(test_f1_record)
-        auc_m, auc_pm = compute_confidence_interval(test_auc_record)
+        m, pm = compute_confidence_interval(results['acc'])
+        f1_m, f1_pm = compute_confidence_interval(results['f1'])
+        auc_m, auc_pm = compute_confidence_interval(results['auc'])
 
         print('Val Best Epoch {}, Acc {:.4f}, Test Acc {:.4f}'.format(trlog['max_acc_epoch'], trlog['max_acc'],
-                                                                      ave_acc.item()))
+                                                                      m))
         print('Test Acc {:.4f} + {:.4f}'.format(m, pm))
         print('Test f1 {:.4f} + {:.4f}'.format(f1_m, f1_pm))
-        print('Test auc {:.4f} + {:.4f}'.format(auc_m, auc_pm))
\ No newline at end of file
+        print('Test auc {:.4f} + {:.4f}'.format(auc_m, auc_pm))
+        print('Inner steps, test: ' + step_summary(self.model.inner_steps))
+
+
+def spd_dataset(dataset):
+    """The loader class of an SPD dataset."""
+    if dataset == 'BNCI2014001_SPD':
+        from dataloader.DataSetLoader_BNCI2014001_SPD import DataSetLoader_BNCI2014001_SPD as Dataset
+    elif dataset == 'Schirrmeister2017_SPD':
+        from dataloader.DataSetLoader_Schirrmeister2017_SPD import DataSetLoader_Schirrmeister2017_SPD as Dataset
+    elif dataset == 'BNCI2015004_SPD':
+        from dataloader.DataSetLoader_BNCI2015004_SPD import DataSetLoader_BNCI2015004_SPD as Dataset
+    else:
+        raise ValueError('The Riemannian baselines need an SPD dataset, not ' + dataset)
+    return Dataset
+
+
+class RiemannTest(object):
+    """Riemannian baselines on the splits of TestModel: minimum distance to mean (MDM) and tangent-space logistic
+    regression (TS+LR), fitted once on the training subjects. They take seconds, so every run reports them next to
+    the pre-train and MTL results."""
+
+    def __init__(self, args):
+        self.args = args
+        self.Dataset = spd_dataset(args.dataset)
+        trainset = self.Dataset('train', self.loader_args(), train_aug=False, TrainSubjects=args.TrainSubjects, TestSubject=args.TestSubject, BinaryClassify=args.BinaryClassify)
+        covs, labels = as_covariances(trainset.data), np.asarray(trainset.label)
+        self.classifiers = [('MDM', MDM()), ('TS+LR', TangentSpaceLR())]
+        self.fit_time = {}
+        for name, classifier in self.classifiers:
+            start = time.time()
+            classifier.fit(covs, labels)
+            self.fit_time[name] = time.time() - start
+
+    def loader_args(self):
+        """The args for the loaders: packed and unstandardized covariances, which stay SPD; a re-centering stage
+        still applies."""
+        args = copy.copy(self.args)
+        args.spd_packed, args.spd_standardize, args.spd_tangent = 1, 0, 0
+        return args
+
+    def test(self):
+        testset = self.Dataset('test', self.loader_args(), train_aug=False, TrainSubjects=self.args.TrainSubjects, TestSubject=self.args.TestSubject, BinaryClassify=self.args.BinaryClassify)
+        covs, labels = as_covariances(testset.X_test), torch.as_tensor(np.asarray(testset.y_test)).long()
+        print('-------Riemannian baselines----------------------------------------------------------------')
+        print('test subject:', self.args.TestSubject[0])
+        for name, classifier in self.classifiers:
+            start = time.time()
+            probs = classifier.predict_proba(covs)
+            predict_time = time.time() - start
+            cm = confusion_matrix(labels, torch.from_numpy(probs.argmax(1)), probs.shape[1])
+            _, _, fmeasure = precision_recall_f1(cm, average='micro')
+            auc = roc_auc(probs, labels.numpy())
+            print('{}: ACC {:.4f}, F-mearsure {:.4f}, auc {:.4f}; fitted in {:.2f} s, {} test trials in {:.1f} ms'.format(
+                name, accuracy(cm)[0], fmeasure[0], auc[0], self.fit_time[name], len(covs), predict_time * 1000))
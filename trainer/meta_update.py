@@ -12,11 +12,10 @@ import torch
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from dataloader.TaskSampler import TaskTrainingSampler
-from dataloader.samplers import CategoriesSampler
+from dataloader.samplers import CategoriesSampler, episode_batch
 from models.mtl import MtlLearner
-from sklearn.metrics import roc_auc_score, precision_score, recall_score, accuracy_score, f1_score
-from sklearn.preprocessing import LabelBinarizer
-from utils.misc import Averager, Timer, count_acc, compute_confidence_interval, ensure_path
+from utils.misc import Averager, Timer, count_acc, compute_confidence_interval, ensure_path, reset_peak_memory, memory_summary, SavedTensorMeter, step_summary, grad_scaler
+from utils.metrics import episode_metrics
 from tensorboardX import SummaryWriter
 import time
 
@@ -43,6 +42,15 @@ class MetaTrainer(object):
 
         # Set args to be shareable in the class
         self.args = args
+        if args.meta_accumulate and args.meta_grad == 'inplace' and not args.inner_detach and args.inner_lr_mode == 'none':
+            # the in-place inner loop writes encoder gradients that would pile up across the streamed tasks
+            raise ValueError('meta_accumulate needs inner_detach=1 or a functional meta_grad.')
+        if args.meta_accumulate and args.encode_batched:
+            # the joint encoder graph spans the whole meta-batch, there is nothing to free per task
+            raise ValueError('meta_accumulate and encode_batched cannot be combined.')
+        if args.inner_lr_mode != 'none' and args.meta_grad == 'implicit':
+            # the implicit meta-gradient only reaches the initial weights, not the step sizes
+            raise ValueError('inner_lr_mode cannot be combined with meta_grad=implicit.')
 
         # Load meta-train set
         if args.dataset == 'BNCI2015004':
@@ -81,18 +89,24 @@ class MetaTrainer(object):
         num_class_pretrain = self.trainset.num_class
         in_chans = self.trainset.in_chans
         input_time_length = self.trainset.time_step
+        in_bands = getattr(self.trainset, 'bands', 1)  # only the SPD loaders have a band axis
 
         # Build meta-transfer learning model
         self.model = MtlLearner(self.args, mode='meta', num_cls=num_class_pretrain, in_chans=in_chans,
-                                input_time_length=input_time_length)
+                                input_time_length=input_time_length, in_bands=in_bands)
 
         # Set optimizer
         self.optimizer = torch.optim.Adam(
             [{'params': filter(lambda p: p.requires_grad, self.model.encoder.parameters())}, \
              {'params': self.model.base_learner.parameters(), 'lr': self.args.meta_lr2}], lr=self.args.meta_lr1)
+        if self.model.inner_lrs is not None:
+            # the learned inner step sizes train at the rate of the SS weights
+            self.optimizer.add_param_group({'params': self.model.inner_lrs.parameters()})
         # Set learning rate scheduler
         self.lr_scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=self.args.step_size,
                                                             gamma=self.args.gamma)
+        # loss scaling for precision=fp16, a plain optimizer step otherwise
+        self.scaler = grad_scaler(self.args)
 
         # load pretrained model without classifier #
         self.model_dict = self.model.state_dict()
@@ -147,12 +161,6 @@ class MetaTrainer(object):
 
     def train(self):
         """The function for the meta-train phase."""
-        def multiclass_roc_auc_score(y_test, y_pred, average="macro"):
-            lb = LabelBinarizer()
-            lb.fit(y_test)
-            y_test = lb.transform(y_test)
-            y_pred = lb.transform(y_pred)
-            return roc_auc_score(y_test, y_pred, average=average)
         # Set the meta-train log
         trlog = {}
         trlog['args'] = vars(self.args)
@@ -191,12 +199,20 @@ class MetaTrainer(object):
             # Set averager classes to record training losses and accuracies
             train_loss_averager = Averager()
             train_acc_averager = Averager()
+            task_time_averager = Averager()
+            outer_time_averager = Averager()
+            outer_start = time.time()
+            reset_peak_memory()
+            # the peak of the autograd graphs of this epoch, comparable between the meta_grad variants on any device
+            self.model.saved_tensor_meter = SavedTensorMeter()
+            self.model.inner_steps = []
             # Using tqdm to read samples from train loader
             tqdm_gen = tqdm.tqdm(self.train_loader)
             # num_meta_batch=4
             num_meta_batch=self.args.meta_batch_size
             task_loss=[]
             task_acc=[]
+            task_data=[]
             for i, batch in enumerate(tqdm_gen, 1):
                 # Update global count number
                 global_count = global_count + 1
@@ -210,8 +226,23 @@ class MetaTrainer(object):
                 data_shot, data_query = data[:p], data[p:]
                 del data
                 # Output logits for model
-                logits = self.model((data_shot, label_shot, data_query))#innerloop update
-                del data_shot, data_query
+                if self.args.encode_batched or self.args.task_workers > 1:
+                    # Hold the tasks until the meta-batch is complete, then encode them in one call and/or
+                    # adapt them concurrently
+                    task_data.append((data_shot, data_query))
+                    del data_shot, data_query
+                    if i % num_meta_batch != 0:
+                        continue
+                    task_start = time.time()
+                    task_logits = self.model(([d[0] for d in task_data], label_shot, [d[1] for d in task_data]))
+                    for _ in task_data:
+                        task_time_averager.add((time.time() - task_start) / len(task_data))
+                    task_data = []
+                else:
+                    task_start = time.time()
+                    task_logits = [self.model((data_shot, label_shot, data_query))]#innerloop update
+                    task_time_averager.add(time.time() - task_start)
+                    del data_shot, data_query
                 torch.cuda.empty_cache()
 
                 #------------inner val loop --------#
@@ -221,38 +252,45 @@ class MetaTrainer(object):
                     label = label.type(torch.cuda.LongTensor)
                 else:
                     label = label.type(torch.LongTensor)
-                # Calculate inner-loop val loss and  inner-loop val acc /auc
-                loss = F.cross_entropy(logits, label)#innerloop-val loss
-                acc = count_acc(logits, label)# innerloop-val acc
-
-                #Collect loss and acc for outer loop or outdate outer loop
-                if i%num_meta_batch==0:
-
-                    task_loss.append(loss)
-                    task_acc.append(acc)
-
-                    # --Update outer loop--
-                    # Loss backwards and optimizer updattes
-                    self.optimizer.zero_grad()
-                    meta_batch_loss = torch.stack(task_loss).mean()
-                    meta_batch_loss.backward()  #
-                    self.optimizer.step()
-                    self.lr_scheduler.step()  #
-                    task_acc = np.mean(task_acc)  #
-
-                    writer.add_scalar('data/meta_train_loss', float(meta_batch_loss), global_count)
-                    writer.add_scalar('data/meta_train_acc', float(task_acc), global_count)
-
-                    # Add loss and accuracy for the averagers
-                    train_loss_averager.add(meta_batch_loss.item())
-                    train_acc_averager.add(task_acc)
-
-                    task_loss =[]
-                    task_acc = []
-                else:
+                for logits in task_logits:
+                    # Calculate inner-loop val loss and  inner-loop val acc /auc
+                    loss = F.cross_entropy(logits, label)#innerloop-val loss
+                    acc = count_acc(logits, label)# innerloop-val acc
+
+                    if self.args.meta_accumulate:
+                        # Back-propagate this task right away so its graph is freed before the next task runs
+                        if len(task_loss) == 0:
+                            self.optimizer.zero_grad()
+                        self.scaler.scale(loss / num_meta_batch).backward()
+                        loss = loss.detach()
+                    #Collect loss and acc for outer loop or outdate outer loop
                     task_loss.append(loss)#meta-loss
                     task_acc.append(acc)
-                del loss,acc
+                    if len(task_loss) == num_meta_batch:
+                        # --Update outer loop--
+                        # Loss backwards and optimizer updattes
+                        meta_batch_loss = torch.stack(task_loss).mean()
+                        if not self.args.meta_accumulate:
+                            self.optimizer.zero_grad()
+                            self.scaler.scale(meta_batch_loss).backward()  #
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
+                        self.lr_scheduler.step()  #
+                        outer_time_averager.add(time.time() - outer_start)
+                        outer_start = time.time()
+                        task_acc = np.mean(task_acc)  #
+
+                        writer.add_scalar('data/meta_train_loss', float(meta_batch_loss), global_count)
+                        writer.add_scalar('data/meta_train_acc', float(task_acc), global_count)
+
+                        # Add loss and accuracy for the averagers
+                        train_loss_averager.add(meta_batch_loss.item())
+                        train_acc_averager.add(task_acc)
+
+                        task_loss =[]
+                        task_acc = []
+                    del loss,acc
+                del task_logits
                 torch.cuda.empty_cache()
             torch.cuda.empty_cache()
             # Update the averagers
@@ -260,8 +298,14 @@ class MetaTrainer(object):
             train_acc_averager = train_acc_averager.item()
 
             print("--- %s seconds ---" % (time.time() - start_time))
+            print('Inner loop: {:.1f} ms per task, outer step ({}): {:.1f} ms, graph peak {:.1f} MB, {}'.format(
+                task_time_averager.item() * 1000, self.args.meta_grad, outer_time_averager.item() * 1000,
+                self.model.saved_tensor_meter.peak / 1024 / 1024, memory_summary()))
+            self.model.saved_tensor_meter = None
+            print('Inner steps, train: ' + step_summary(self.model.inner_steps))
             # Start validation for this epoch, set model to eval mode
             self.model.eval()
+            self.model.inner_steps = []
 
             # Set averager classes to record validation losses and accuracies
             val_loss_averager = Averager()
@@ -303,6 +347,7 @@ class MetaTrainer(object):
             writer.add_scalar('data/meta_val_acc', float(val_acc_averager), epoch)
             # Print loss and accuracy for this epoch
             print('Epoch {}, Val, Loss={:.4f} Acc={:.4f}'.format(epoch, val_loss_averager, val_acc_averager))
+            print('Inner steps, val: ' + step_summary(self.model.inner_steps))
 
             # Update best saved model
             if val_acc_averager > trlog['max_acc']:
@@ -326,19 +371,12 @@ class MetaTrainer(object):
                 print('Running Time: {}, Estimated Time: {}'.format(timer.measure(),
                                                                     timer.measure(epoch / self.args.max_epoch)))
         print("--------------End of meta train-------------")
+        self.model.shutdown_task_pool()
         writer.close()
 
     def eval(self):
         """The function for the meta-eval phase."""
-
         # Load the logs
-        def multiclass_roc_auc_score(y_test, y_pred, average="macro"):
-            lb = LabelBinarizer()
-            lb.fit(y_test)
-            y_test = lb.transform(y_test)
-            y_pred = lb.transform(y_pred)
-            return roc_auc_score(y_test, y_pred, average=average)
-
         trlog = torch.load(osp.join(self.args.save_path, 'trlog'))
 
         # Load meta-test set
@@ -365,10 +403,6 @@ class MetaTrainer(object):
                            TestSubject=self.args.TestSubject, BinaryClassify=args.BinaryClassify)
         sampler = CategoriesSampler(test_set.label, 20, self.args.way, self.args.shot + self.args.val_query)
         loader = DataLoader(test_set, batch_sampler=sampler, num_workers=8, pin_memory=True)
-        # Set test accuracy recorder
-        test_acc_record = np.zeros((20,))  #
-        test_f1_record = np.zeros((20,))
-        test_auc_record = np.zeros((20,))
         # Load model for meta-test phase
         if self.args.eval_weights is not None:
             self.model.load_state_dict(torch.load(self.args.eval_weights)['params'])
@@ -376,9 +410,8 @@ class MetaTrainer(object):
             self.model.load_state_dict(torch.load(osp.join(self.args.save_path, 'max_acc' + '.pth'))['params'])
         # Set model to eval mode
         self.model.eval()
-
-        # Set accuracy averager
-        ave_acc = Averager()
+        if self.args.compile != 'none':
+            print('Inference graphs:', self.model.compile_inference(self.args.compile))
 
         # Generate labels
         label = torch.arange(self.args.way).repeat(self.args.val_query)
@@ -392,38 +425,41 @@ class MetaTrainer(object):
         else:
             label_shot = label_shot.type(torch.LongTensor)
 
-        Y = label.data.cpu().numpy()
-        # Start meta-test
-        for i, batch in enumerate(loader, 1):  ##
+        self.model.inner_steps = []
+        eval_start = time.time()
+        if self.args.eval_batched:
+            # Encode every trial once and adapt the heads of all episodes together
+            data, episodes = episode_batch(test_set, sampler)
             if torch.cuda.is_available():
-                data, _ = [_.cuda() for _ in batch]
-            else:
-                data = batch[0]
-            k = self.args.way * self.args.shot
-            data_shot, data_query = data[:k], data[k:]
-            logits = self.model((data_shot, label_shot, data_query))
-            acc = count_acc(logits, label)
-            logits = logits.data.cpu().numpy()  ##
-            predicted = np.argmax(logits, axis=1)
-            f1 = f1_score(Y, predicted, average='macro')
-            auc = multiclass_roc_auc_score(Y, predicted)  ##
-            ave_acc.add(acc)
-            test_acc_record[i - 1] = acc
-            test_f1_record[i - 1] = f1  #
-            test_auc_record[i - 1] = auc
-            if i % 100 == 0:
-                print('batch {}: {:.2f}({:.2f})'.format(i, ave_acc.item() * 100, acc * 100))
+                data, episodes = data.cuda(), episodes.cuda()
+            logits = self.model.eval_episodes(data, episodes, label_shot)
+        else:
+            # Start meta-test
+            logits = []
+            for i, batch in enumerate(loader, 1):  ##
+                if torch.cuda.is_available():
+                    data, _ = [_.cuda() for _ in batch]
+                else:
+                    data = batch[0]
+                k = self.args.way * self.args.shot
+                data_shot, data_query = data[:k], data[k:]
+                logits.append(self.model((data_shot, label_shot, data_query)).detach())
+            logits = torch.stack(logits)
+        # The metrics of all episodes at once, from the stacked logits
+        results = episode_metrics(logits, label, self.args.way)
+        print('Meta-test: {:.2f} s for {} episodes'.format(time.time() - eval_start, len(logits)))
 
         # Calculate the confidence interval, update the logs
-        m, pm = compute_confidence_interval(test_acc_record)
-        f1_m, f1_pm = compute_confidence_interval(test_f1_record)
-        auc_m, auc_pm = compute_confidence_interval(test_auc_record)
+        m, pm = compute_confidence_interval(results['acc'])
+        f1_m, f1_pm = compute_confidence_interval(results['f1'])
+        auc_m, auc_pm = compute_confidence_interval(results['auc'])
 
         print('Val Best Epoch {}, Acc {:.4f}, Test Acc {:.4f}'.format(trlog['max_acc_epoch'], trlog['max_acc'],
-                                                                      ave_acc.item()))
+                                                                      m))
         print('Test Acc {:.4f} + {:.4f}'.format(m, pm))
         print('Test f1 {:.4f} + {:.4f}'.format(f1_m, f1_pm))
         print('Test auc {:.4f} + {:.4f}'.format(auc_m, auc_pm))
+        print('Inner steps, test: ' + step_summary(self.model.inner_steps))
 
 
 
@@ -9,19 +9,16 @@ import os.path as osp
 import os
 import tqdm
 import numpy as np
-from sklearn.metrics import roc_auc_score, precision_score, recall_score, accuracy_score
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import DataLoader
-from torch.autograd import Variable# for original validation
 from dataloader.samplers import CategoriesSampler
 from models.mtl import MtlLearner
 from utils.misc import Averager, Timer, count_acc, ensure_path
+from utils.metrics import confusion_matrix, accuracy, precision_recall_f1, roc_auc
 from tensorboardX import SummaryWriter
-from sklearn.metrics import roc_auc_score, precision_score, recall_score, accuracy_score, f1_score
-from sklearn.preprocessing import LabelBinarizer
-from utils.misc import Averager, Timer, count_acc, compute_confidence_interval, ensure_path
+from utils.misc import Averager, Timer, count_acc, compute_confidence_interval, ensure_path, step_summary, chunked_inference, grad_scaler
 # from dataloader.dataset_loader_BCI_IV_c import DatasetLoader_BCI_IV_subjects as Dataset
 # from dataloader.DataSetLoader_BNCI2015004_New import DataSetLoader_BNCI2015004 as Dataset
 
@@ -85,8 +82,9 @@ class PreTrainer(object):
         num_class_pretrain = self.trainset.num_class
         in_chans=self.trainset.in_chans
         input_time_length=self.trainset.time_step
+        in_bands=getattr(self.trainset, 'bands', 1)  # only the SPD loaders have a band axis
         # Build pretrain model #
-        self.model = MtlLearner(self.args, mode='pre', num_cls=num_class_pretrain,in_chans=in_chans,input_time_length=input_time_length)
+        self.model = MtlLearner(self.args, mode='pre', num_cls=num_class_pretrain,in_chans=in_chans,input_time_length=input_time_length,in_bands=in_bands)
         #self.model=self.model.float()
         # Set optimizer
         params=list(self.model.encoder.parameters())+list(self.model.classifier.parameters())
@@ -95,6 +93,8 @@ class PreTrainer(object):
 
         # Set learning rate scheduler
         self.lr_scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=self.args.pre_step_size, gamma=self.args.pre_gamma)
+        # loss scaling for precision=fp16, a plain optimizer step otherwise
+        self.scaler = grad_scaler(self.args)
         
         # Set model to GPU
         if torch.cuda.is_available():
@@ -111,12 +111,6 @@ class PreTrainer(object):
 
     def train(self):
         """The function for the pre-train phase."""
-        def multiclass_roc_auc_score(y_test, y_pred, average="macro"):
-            lb = LabelBinarizer()
-            lb.fit(y_test)
-            y_test = lb.transform(y_test)
-            y_pred = lb.transform(y_pred)
-            return roc_auc_score(y_test, y_pred, average=average)
         # Set the pretrain log
         trlog = {}
         trlog['args'] = vars(self.args)
@@ -179,8 +173,9 @@ class PreTrainer(object):
                 train_acc_averager.add(acc)
                 # Loss backwards and optimizer updates
                 self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
                 self.lr_scheduler.step()
 
                 del loss,acc
@@ -210,6 +205,7 @@ class PreTrainer(object):
           ### Start meta_validation for this epoch, set model to eval mode
             self.model.eval()
             self.model.mode = 'preval'
+            self.model.inner_steps = []
 
             # Set averager classes to record validation losses and accuracies
             meta_val_loss_averager = Averager()
@@ -277,6 +273,7 @@ class PreTrainer(object):
                 print('Meta-Validation--currentval_auc_averager',meta_val_acc_averager)
             else:
                 print('Meta-Validation--currentval_acc_averager', meta_val_acc_averager)
+            print('Meta-Validation--inner steps: ' + step_summary(self.model.inner_steps))
             # Save log
             torch.save(trlog, osp.join(self.args.save_path, 'trlog'))
 
@@ -290,53 +287,17 @@ class PreTrainer(object):
         # Save log
         torch.save(trlog, osp.join(self.args.save_path, 'trlog'))
     def val_orig(self, X_val, y_val):  # ml_validation
-        predicted_loss=[]
-        inputs = torch.from_numpy(X_val)
-        labels = torch.FloatTensor(y_val*1.0)
-        inputs, labels = Variable(inputs), Variable(labels)
-        
-        results = []
-        predicted = []
-                
         self.model.eval()
         self.model.mode = 'origval'
-        
-
-        if torch.cuda.is_available():
-            inputs= inputs.type(torch.cuda.FloatTensor)
-        else:
-            inputs = inputs.type(torch.FloatTensor)
-
-        predicted=self.model(inputs)
-        labels1=torch.IntTensor(y_val*1.0)
-        labels1=labels1.type(torch.int64)#
-        labels1=labels1.cuda() #
-        loss = F.cross_entropy(predicted, labels1)
-        predicted= predicted.data.cpu().numpy()
-
-        Y=labels.data.numpy()
-        predicted=np.argmax(predicted, axis=1)
-
-        del inputs
-        for param in ["acc", "recall", "precision","fmeasure", "auc"]:
-            if param == 'acc':
-                results.append(accuracy_score(Y, np.round(predicted)))
-            if param == "recall":
-                results.append(recall_score(Y, np.round(predicted), average='micro'))
-            if param == "fmeasure":
-                precision = precision_score(Y, np.round(predicted), average='micro')
-                recall = recall_score(Y, np.round(predicted), average='micro')
-                results.append(2*precision*recall/ (precision+recall))
-            if param == "auc":
-                # Y = label.data.cpu().numpy()#本来就是
-                def multiclass_roc_auc_score(y_test, y_pred, average="macro"):
-                    lb = LabelBinarizer()
-                    lb.fit(y_test)
-                    y_test = lb.transform(y_test)
-                    y_pred = lb.transform(y_pred)
-                    return roc_auc_score(y_test, y_pred, average=average)
-                auc = multiclass_roc_auc_score(Y, predicted)  ##
-                results.append(auc)
+        # the split goes through the model in chunks, the activations of all its samples are never held at once
+        predicted, loss = chunked_inference(self.model, X_val, y_val, self.args.val_chunk, self.args.val_memory_mb)
+        labels = torch.as_tensor(np.asarray(y_val)).long()
+        # acc, recall and F-measure (micro, which for single-label data are all the accuracy) and AUC
+        cm = confusion_matrix(labels, predicted.argmax(1), predicted.size(1))
+        _, recall, fmeasure = precision_recall_f1(cm, average='micro')
+        auc = roc_auc(F.softmax(predicted, dim=1).numpy(), labels.numpy())
+        results = [accuracy(cm)[0], recall[0], fmeasure[0], auc[0]]
+        predicted = np.argmax(predicted.numpy(), axis=1)
 
         return predicted, results,loss
 
@@ -0,0 +1,95 @@
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+##
+## This source code is licensed under the MIT-style license found in the
+## LICENSE file in the root directory of this source tree
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+""" ONNX export of trained models and an onnxruntime predictor. """
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+from utils.quantize import fuse_mtl
+
+
+class AdaptedLearner(nn.Module):
+    """The encoder with its SS weights fused into plain convs and the base learner holding the weights adapted to
+    one task, as a single module mapping trials to logits."""
+    def __init__(self, model, fast_weights):
+        super().__init__()
+        self.encoder = fuse_mtl(model.encoder)
+        self.base_learner = copy.deepcopy(model.base_learner)
+        with torch.no_grad():
+            for p, w in zip(self.base_learner.parameters(), fast_weights):
+                p.copy_(w)
+
+    def forward(self, x):
+        return self.base_learner(self.encoder(x))
+
+
+def adapt(model, data_shot, label_shot):
+    """Adapt the base learner of a meta-mode MtlLearner to the shot samples of a task, as in meta-test.
+    Returns:
+      the AdaptedLearner of the task, in eval mode
+    """
+    model.eval()
+    with torch.no_grad():
+        embedding_shot = model.encode(data_shot)
+    fast_weights = model.inner_loop(embedding_shot, label_shot)
+    return AdaptedLearner(model, [w.detach() for w in fast_weights]).eval()
+
+
+def export_onnx(model, path, example):
+    """Write an eval-mode model to ONNX with a dynamic batch size.
+    Args:
+      model: an AdaptedLearner, or an MtlLearner in 'pre' mode, whose encoder and classifier are exported
+      path: the .onnx file
+      example: an input batch used for tracing
+    """
+    if getattr(model, 'mode', None) == 'pre':
+        model = nn.Sequential(model.encoder, model.classifier)
+    model = copy.deepcopy(model).cpu().eval()
+    torch.onnx.export(model, (example.cpu(),), path, input_names=['input'], output_names=['logits'],
+                      dynamic_shapes=({0: torch.export.Dim('batch')},))
+
+
+class OnnxPredictor(object):
+    """Logits of an exported model from onnxruntime on the CPU. The input and output buffers of every batch size
+    are allocated once and bound to the session, so a prediction only copies the trials in and runs the graph.
+    Args:
+      path: the .onnx file written by export_onnx
+      max_batch: larger inputs are run in chunks of this size
+      threads: the intra-op threads of the session, 0 lets onnxruntime choose
+    """
+    def __init__(self, path, max_batch=256, threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.ort = ort
+        self.max_batch = max_batch
+        self.input_shape = self.session.get_inputs()[0].shape[1:]
+        self.num_out = self.session.get_outputs()[0].shape[1]
+        self.buffers = {} # batch size -> (input array, output array, io binding)
+
+    def bind(self, batch_size):
+        if batch_size not in self.buffers:
+            inputs = np.empty([batch_size] + list(self.input_shape), dtype=np.float32)
+            outputs = np.empty((batch_size, self.num_out), dtype=np.float32)
+            binding = self.session.io_binding()
+            binding.bind_ortvalue_input('input', self.ort.OrtValue.ortvalue_from_numpy(inputs))
+            binding.bind_ortvalue_output('logits', self.ort.OrtValue.ortvalue_from_numpy(outputs))
+            self.buffers[batch_size] = (inputs, outputs, binding)
+        return self.buffers[batch_size]
+
+    def __call__(self, x):
+        """The logits of a batch of trials, an array or tensor shaped like the model input, as a new array."""
+        x = x.detach().cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+        logits = []
+        for i in range(0, len(x), self.max_batch):
+            chunk = x[i:i + self.max_batch]
+            inputs, outputs, binding = self.bind(len(chunk))
+            np.copyto(inputs, chunk)
+            self.session.run_with_iobinding(binding)
+            logits.append(outputs.copy())
+        return np.concatenate(logits)
@@ -0,0 +1,98 @@
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+##
+## This source code is licensed under the MIT-style license found in the
+## LICENSE file in the root directory of this source tree
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+""" Classification metrics for many episodes at once, from batched confusion matrices. """
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy.stats import rankdata
+from utils.misc import compute_confidence_interval
+
+
+def confusion_matrix(y_true, y_pred, num_cls):
+    """Confusion matrices of a batch of episodes.
+    Args:
+      y_true: the labels, shaped (episodes, samples) or (samples,)
+      y_pred: the predicted classes, same shape
+      num_cls: the number of classes
+    Returns:
+      the counts shaped (episodes, num_cls, num_cls), rows are the true and columns the predicted classes
+    """
+    y_true = torch.as_tensor(y_true).long().reshape(-1, np.shape(y_true)[-1])
+    y_pred = torch.as_tensor(y_pred).long().reshape(y_true.shape).to(y_true.device)
+    n_episodes = y_true.size(0)
+    offset = torch.arange(n_episodes, device=y_true.device).unsqueeze(1) * num_cls * num_cls
+    index = (offset + y_true * num_cls + y_pred).reshape(-1)
+    counts = torch.bincount(index, minlength=n_episodes * num_cls * num_cls)
+    return counts.reshape(n_episodes, num_cls, num_cls).double()
+
+
+def accuracy(cm):
+    return (torch.diagonal(cm, dim1=1, dim2=2).sum(1) / cm.sum((1, 2))).numpy()
+
+
+def precision_recall_f1(cm, average='macro'):
+    """Precision, recall and F1 of every episode. 'macro' averages over the classes present in the labels or the
+    predictions, counting an undefined ratio as 0 as sklearn does; 'micro' pools the counts, which for single-label
+    multiclass data makes all three the accuracy."""
+    if average == 'micro':
+        acc = accuracy(cm)
+        return acc, acc, acc
+    tp = torch.diagonal(cm, dim1=1, dim2=2)
+    predicted = cm.sum(1)
+    actual = cm.sum(2)
+    precision = torch.where(predicted > 0, tp / predicted.clamp(min=1), torch.zeros_like(tp))
+    recall = torch.where(actual > 0, tp / actual.clamp(min=1), torch.zeros_like(tp))
+    f1 = torch.where(precision + recall > 0, 2 * precision * recall / (precision + recall).clamp(min=1e-12),
+                     torch.zeros_like(tp))
+    present = ((predicted > 0) | (actual > 0)).double()
+    n_present = present.sum(1)
+    return tuple(((m * present).sum(1) / n_present).numpy() for m in (precision, recall, f1))
+
+
+def roc_auc(probs, y_true):
+    """One-vs-rest macro AUC of the class probabilities of every episode, from the rank statistic (ties get the
+    average rank). Classes without positive or negative samples in an episode are left out of its average.
+    Args:
+      probs: the class probabilities, shaped (episodes, samples, classes) or (samples, classes)
+      y_true: the labels, shaped (episodes, samples) or (samples,)
+    Returns:
+      the AUC of every episode
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    probs = probs.reshape(-1, probs.shape[-2], probs.shape[-1])
+    y_true = np.asarray(y_true).reshape(probs.shape[:2])
+    positive = y_true[:, :, None] == np.arange(probs.shape[2])
+    ranks = rankdata(probs, axis=1)
+    n_pos = positive.sum(1)
+    n_neg = positive.shape[1] - n_pos
+    rank_sum = (ranks * positive).sum(1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auc = (rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+    auc[(n_pos == 0) | (n_neg == 0)] = np.nan
+    return np.nanmean(auc, axis=1)
+
+
+def episode_metrics(logits, label, num_cls):
+    """All metrics of a batch of episodes at once.
+    Args:
+      logits: the query logits, shaped (episodes, queries, classes) or (queries, classes)
+      label: the query labels, shaped (queries,) when shared by the episodes, or like the logits without classes
+      num_cls: the number of classes
+    Returns:
+      dict of per-episode arrays: acc, precision, recall, f1 (macro) and auc (probability-based)
+    """
+    logits = torch.as_tensor(logits).detach().float().cpu()
+    logits = logits.reshape(-1, logits.size(-2), logits.size(-1))
+    label = torch.as_tensor(label).cpu().long().expand(logits.shape[:2])
+    cm = confusion_matrix(label, logits.argmax(2), num_cls)
+    precision, recall, f1 = precision_recall_f1(cm)
+    return {'acc': accuracy(cm), 'precision': precision, 'recall': recall, 'f1': f1,
+            'auc': roc_auc(F.softmax(logits, dim=2).numpy(), label.numpy())}
+
+
+def summarize(metrics):
+    """Mean and 95% confidence interval over the episodes of every metric."""
+    return {k: compute_confidence_interval(v) for k, v in metrics.items()}
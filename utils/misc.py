@@ -30,6 +30,152 @@ class Averager():
     def item(self):
         return self.v
 
+def reset_peak_memory():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+def peak_memory():
+    """Peak memory in MB: the CUDA allocator peak since reset_peak_memory on GPU. On CPU it is the max RSS of the
+    process over its lifetime, which cannot be reset; SavedTensorMeter measures one block on either device."""
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 1024 / 1024
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def memory_summary():
+    """peak_memory labelled with what it measures on this device."""
+    if torch.cuda.is_available():
+        return 'peak memory {:.1f} MB'.format(peak_memory())
+    return 'process max RSS {:.1f} MB'.format(peak_memory())
+
+class _SavedTensor():
+    def __init__(self, meter, x):
+        self.meter = meter
+        self.x = x
+        self.nbytes = x.numel() * x.element_size()
+        meter.live += self.nbytes
+        meter.peak = max(meter.peak, meter.live)
+
+    def __del__(self):
+        self.meter.live -= self.nbytes
+
+class SavedTensorMeter():
+    """Tracks the bytes the autograd graph holds for backward, for graphs built inside a with-block.
+    `live` is what is still retained, `peak` the maximum over the block. The hooks are thread local: graphs built
+    on other threads are counted inside a `with meter.hooks():` block on those threads."""
+    def __init__(self):
+        self.live = 0
+        self.peak = 0
+
+    def hooks(self):
+        return torch.autograd.graph.saved_tensors_hooks(lambda x: _SavedTensor(self, x), lambda t: t.x)
+
+    def __enter__(self):
+        self.context = self.hooks()
+        self.context.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.context.__exit__(*exc)
+
+    def item(self):
+        return self.live / 1024 / 1024
+
+def step_summary(steps):
+    """One-line distribution of the inner steps the tasks used."""
+    if len(steps) == 0:
+        return 'no tasks'
+    steps = np.asarray(steps)
+    return 'mean {:.1f}, min {}, p10 {:.0f}, median {:.0f}, p90 {:.0f}, max {} over {} tasks'.format(
+        steps.mean(), steps.min(), np.percentile(steps, 10), np.median(steps), np.percentile(steps, 90),
+        steps.max(), len(steps))
+
+def activation_bytes(model, sample):
+    """Rough peak activation memory of a no_grad forward of one sample: twice the largest layer output, as a layer
+    holds its input and output at the same time."""
+    sizes = [sample.numel() * sample.element_size()]
+    def record(module, inp, out):
+        if torch.is_tensor(out):
+            sizes.append(out.numel() * out.element_size())
+    hooks = [m.register_forward_hook(record) for m in model.modules() if len(list(m.children())) == 0]
+    with torch.no_grad():
+        model(sample)
+    for hook in hooks:
+        hook.remove()
+    return 2 * max(sizes)
+
+def chunked_inference(model, inputs, labels, chunk_size=256, memory_mb=0, device=None):
+    """Logits and mean cross-entropy of a whole split, streamed through the model in chunks so its activations
+    are never all held at once.
+    Args:
+      inputs: the split as a numpy array, moved to the device chunk by chunk
+      labels: the labels of the split
+      chunk_size: the samples per forward
+      memory_mb: if set, the chunk size is instead derived from this activation budget
+      device: where the chunks go, the GPU if there is one by default
+    Returns:
+      the logits on the CPU and the loss
+    """
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    def to_device(x):
+        return torch.from_numpy(np.ascontiguousarray(x)).float().to(device)
+    if memory_mb:
+        chunk_size = max(1, int(memory_mb * 1024 * 1024 // activation_bytes(model, to_device(inputs[:1]))))
+    labels = torch.as_tensor(np.asarray(labels)).long()
+    logits = []
+    loss = 0.
+    with torch.no_grad():
+        for i in range(0, len(inputs), chunk_size):
+            out = model(to_device(inputs[i:i + chunk_size]))
+            label = labels[i:i + chunk_size].to(out.device)
+            loss += F.cross_entropy(out, label, reduction='sum').item()
+            logits.append(out.cpu())
+    return torch.cat(logits), torch.tensor(loss / len(inputs))
+
+def autocast(args):
+    """Autocast for args.precision (fp32, bf16 or fp16) on the device the models run on, disabled for fp32."""
+    device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dtype = torch.float16 if args.precision == 'fp16' else torch.bfloat16
+    return torch.autocast(device_type, dtype=dtype, enabled=args.precision != 'fp32')
+
+def grad_scaler(args):
+    """Loss scaling for fp16 on CUDA. Otherwise a disabled scaler whose step() is a plain optimizer step, as
+    bf16 keeps the float32 exponent range."""
+    enabled = args.precision == 'fp16' and torch.cuda.is_available()
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+def compile_for_inference(module, example, backend='trace', atol=1e-4):
+    """An optimized inference graph of an eval-mode module, or the module itself if the backend fails.
+    Args:
+      module: the module, its current weights are what the graph computes with
+      example: an input batch for tracing and the parity check
+      backend: 'trace' or 'script' (TorchScript, frozen and optimized for inference), 'compile' (torch.compile) or
+        'none'
+      atol: the largest absolute difference to the eager outputs that is accepted
+    Returns:
+      the compiled module and the backend that was used, 'none' after a fallback to eager
+    """
+    if backend == 'none':
+        return module, 'none'
+    module.eval()
+    try:
+        with torch.no_grad():
+            if backend == 'compile':
+                compiled = torch.compile(module)
+            else:
+                graph = torch.jit.trace(module, example) if backend == 'trace' else torch.jit.script(module)
+                compiled = torch.jit.optimize_for_inference(torch.jit.freeze(graph))
+            # the graph must match eager on the example batch and on a different batch size
+            for x in (example, torch.cat([example, example])):
+                if not torch.allclose(compiled(x), module(x), atol=atol, rtol=1e-4):
+                    raise RuntimeError('outputs differ from eager')
+    except Exception as e:
+        print('{} failed for {} ({}), running it eagerly'.format(backend, type(module).__name__, next((l for l in str(e).splitlines() if l.strip()), type(e).__name__)))
+        return module, 'none'
+    return compiled, backend
+
 def count_acc(logits, label):
     pred = F.softmax(logits, dim=1).argmax(dim=1)
     if torch.cuda.is_available():
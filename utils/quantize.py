@@ -0,0 +1,177 @@
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+##
+## This source code is licensed under the MIT-style license found in the
+## LICENSE file in the root directory of this source tree
+##+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+""" Post-training static int8 quantization of the encoders for CPU inference. """
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from models.conv2d_mtl import Conv2dMtl
+
+
+def fuse_mtl(module):
+    """A copy of the module with every Conv2dMtl replaced by an nn.Conv2d holding its effective weights, the
+    frozen weight scaled by the SS weight and the frozen bias shifted by the SS bias."""
+    module = copy.deepcopy(module)
+    for name, child in list(module.named_modules()):
+        if not isinstance(child, Conv2dMtl):
+            continue
+        conv = nn.Conv2d(child.in_channels, child.out_channels, child.kernel_size, child.stride, child.padding,
+                         child.dilation, child.groups, bias=child.bias is not None)
+        weight, bias = child.effective_weights()
+        with torch.no_grad():
+            conv.weight.copy_(weight)
+            if bias is not None:
+                conv.bias.copy_(bias)
+        parent = module.get_submodule(name.rpartition('.')[0])
+        setattr(parent, name.rpartition('.')[2], conv)
+    return module
+
+
+class FloatElu(nn.Module):
+    """An ELU kept in float32 inside a quantized graph. The FX lowering turns a plain ELU between quantized
+    tensors into quantized::elu, which on the CPU costs several times a dequantize, float ELU and quantize."""
+    def forward(self, x):
+        return F.elu(x)
+
+
+def _float_elus(graph):
+    """Replace the F.elu calls of an FX GraphModule by FloatElu modules."""
+    for i, node in enumerate(list(graph.graph.nodes)):
+        if node.op == 'call_function' and node.target is F.elu and node.kwargs.get('alpha', 1.0) == 1.0:
+            name = 'float_elu_{}'.format(i)
+            graph.add_submodule(name, FloatElu())
+            with graph.graph.inserting_after(node):
+                elu = graph.graph.call_module(name, (node.args[0],))
+            node.replace_all_uses_with(elu)
+            graph.graph.erase_node(node)
+    graph.recompile()
+    return graph
+
+
+def _passes_affine(node, modules, positive):
+    """Whether a per-channel affine map commutes with the op of the node: eval-mode dropout always, max pooling
+    when every scale is positive."""
+    if node.op == 'call_module':
+        module = modules[node.target]
+        return isinstance(module, nn.Dropout) or (isinstance(module, nn.MaxPool2d) and positive)
+    if node.op == 'call_function':
+        return node.target is F.dropout and not node.kwargs.get('training', True)
+    return False
+
+
+def fold_batchnorm(module):
+    """Fold the eval-mode BatchNorms into the layer they feed. In these encoders BN comes after the ELU, so it
+    cannot go into the conv before it; instead its per-channel scale and shift go into the input side of the next
+    unpadded conv, or of the linear layer behind the flatten. Only dropout, and max pooling when all scales are
+    positive, may lie in between. BatchNorms without such a consumer are kept.
+    Returns:
+      an FX GraphModule computing the same function as the eval-mode module
+    """
+    graph = torch.fx.symbolic_trace(copy.deepcopy(module).eval())
+    modules = dict(graph.named_modules())
+    for node in list(graph.graph.nodes):
+        if node.op != 'call_module' or not isinstance(modules[node.target], nn.BatchNorm2d):
+            continue
+        bn = modules[node.target]
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        if bn.affine:
+            scale = scale * bn.weight.detach()
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            shift = shift + bn.bias.detach()
+        user, flatten = node, False
+        while True:
+            # shape queries such as x.size(0) for the flatten do not consume the values
+            consumers = [u for u in user.users if not (u.op == 'call_method' and u.target == 'size')]
+            if len(consumers) != 1:
+                break
+            user = consumers[0]
+            if _passes_affine(user, modules, bool((scale > 0).all())) or \
+                    (user.op == 'call_method' and user.target == 'contiguous'):
+                continue
+            if not flatten and user.op in ('call_method', 'call_function') and \
+                    user.target in ('view', 'reshape', 'flatten', torch.flatten):
+                flatten = True
+                continue
+            break
+        target = modules.get(user.target) if user.op == 'call_module' else None
+        if flatten and isinstance(target, nn.Linear):
+            repeat = target.in_features // scale.numel()
+            scale, shift = scale.repeat_interleave(repeat), shift.repeat_interleave(repeat)
+            with torch.no_grad():
+                target.bias.add_(target.weight @ shift)
+                target.weight.mul_(scale)
+        elif not flatten and isinstance(target, nn.Conv2d) and target.groups == 1 and \
+                all(p == 0 for p in target.padding):
+            with torch.no_grad():
+                bias = (target.weight * shift.view(1, -1, 1, 1)).sum((1, 2, 3))
+                if target.bias is None:
+                    target.bias = nn.Parameter(bias)
+                else:
+                    target.bias.add_(bias)
+                target.weight.mul_(scale.view(1, -1, 1, 1))
+        else:
+            continue
+        node.replace_all_uses_with(node.args[0])
+        graph.graph.erase_node(node)
+        graph.delete_submodule(node.target)
+    graph.recompile()
+    return graph
+
+
+def quantize_static(model, calibration, backend=None, batch_size=64):
+    """Post-training static int8 quantization of an eval-mode model.
+    The SS weights are fused into plain convs and the BatchNorms folded (fold_batchnorm), then FX graph mode
+    quantization observes the calibration samples. The ELUs, and BatchNorms that could not be folded, stay in
+    float32 between the int8 convs: the quantized ELU and BN kernels cost several times a dequantize, float op and
+    quantize.
+    Args:
+      model: the float32 model, it is not modified
+      calibration: the calibration inputs, an array or tensor shaped like the model input
+      backend: the quantized engine, the current torch.backends.quantized.engine by default; the global engine
+        is restored on return
+      batch_size: the calibration batch size
+    Returns:
+      the int8 model, it runs on the CPU
+    """
+    previous = torch.backends.quantized.engine
+    backend = backend or previous
+    torch.backends.quantized.engine = backend
+    try:
+        float_model = _float_elus(fold_batchnorm(fuse_mtl(model).cpu().eval()))
+        calibration = torch.as_tensor(np.asarray(calibration)).float()
+        qconfig_mapping = get_default_qconfig_mapping(backend).set_object_type(FloatElu, None) \
+            .set_object_type(nn.BatchNorm2d, None)
+        prepared = prepare_fx(float_model, qconfig_mapping, (calibration[:1],),
+                              PrepareCustomConfig().set_non_traceable_module_classes([FloatElu]))
+        with torch.no_grad():
+            for i in range(0, len(calibration), batch_size):
+                prepared(calibration[i:i + batch_size])
+        return convert_fx(prepared)
+    finally:
+        torch.backends.quantized.engine = previous
+
+
+def calibration_subset(data, num_samples=256, seed=0):
+    """A fixed random subset of a split for calibration, e.g. the data of the 'train' dataset of a loader."""
+    index = np.random.RandomState(seed).permutation(len(data))[:num_samples]
+    return np.asarray(data[np.sort(index)])
+
+
+def inference_latency(model, inputs, batch_size=1, repeats=20):
+    """Mean CPU time in ms of one forward of batch_size samples of inputs, after a warm-up forward."""
+    x = torch.as_tensor(np.asarray(inputs[:batch_size])).float()
+    with torch.no_grad():
+        model(x)
+        start = time.time()
+        for _ in range(repeats):
+            model(x)
+    return (time.time() - start) / repeats * 1000